@@ -1,78 +1,35 @@
-import pandas as pd
 import os
-import glob
 import time
 from multiprocessing import Pool, cpu_count
 
+import schema
+from scheduler import choose_pool_size, format_timing_report, run_scheduled
+from unified_preprocess import merge_one_proxy as merge_one_proxy_sorted
+from unified_preprocess import find_raw_files, raw_size_bytes
+from unified_preprocess import process_one_file as process_one_raw_file
+
 input_folder = "inbound"
 temp_base_folder = "temp_output_inbound"
 final_output_folder = "individual_proxy_inbound"
 
+# Per-worker memory budget (MB): raw daily files are read in chunks sized to fit it
+memory_budget_mb = 512
+
 os.makedirs(temp_base_folder, exist_ok=True)
 os.makedirs(final_output_folder, exist_ok=True)
 
-columns_to_extract = [
-    "Timestamp", "ProxyId",
-    "response1xxForwardedCounter",
-    "response2xxForwardedCounter",
-    "response3xxForwardedCounter",
-    "response4xxForwardedCounter",
-    "response5xxForwardedCounter",
-    "response400ForwardedCounter",
-    "response404ForwardedCounter",
-    "response408ForwardedCounter",
-    "response424ForwardedCounter",
-    "response429ForwardedCounter"
-]
-
-dtype_map = {
-    'ProxyId': 'category',
-    'response1xxForwardedCounter': 'Int32',
-    'response2xxForwardedCounter': 'Int32',
-    'response3xxForwardedCounter': 'Int32',
-    'response4xxForwardedCounter': 'Int32',
-    'response5xxForwardedCounter': 'Int32',
-    'response400ForwardedCounter': 'Int32',
-    'response404ForwardedCounter': 'Int32',
-    'response408ForwardedCounter': 'Int32',
-    'response424ForwardedCounter': 'Int32',
-    'response429ForwardedCounter': 'Int32'
-}
+# Columns and compact dtypes come from the shared schema registry
+columns_to_extract = schema.columns_to_extract("inbound")
+dtype_map = schema.dtype_map("inbound")
 
 
 def process_one_file(file_path):
-    try:
-        day_name = os.path.basename(file_path).replace(".csv", "")
-        day_output_folder = os.path.join(temp_base_folder, day_name)
-        os.makedirs(day_output_folder, exist_ok=True)
-
-        df = pd.read_csv(
-            file_path,
-            usecols=columns_to_extract,
-            dtype=dtype_map,
-            parse_dates=["Timestamp"],
-            date_format="%Y-%m-%d %H:%M:%S"
-        )
-
-        for proxy_id, group_df in df.groupby("ProxyId", observed=True):
-            safe_proxy_id = str(proxy_id).replace("/", "_").replace("\\", "_")
-            output_path = os.path.join(day_output_folder, f"{safe_proxy_id}.csv")
-            group_df.to_csv(output_path, index=False)
-
-    except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-    else:
-        print(f"Done: {file_path}")
+    process_one_raw_file((file_path, temp_base_folder, columns_to_extract, dtype_map, memory_budget_mb))
 
 
 def merge_one_proxy(proxy_file_and_paths):
-    proxy_file, file_list = proxy_file_and_paths
-    try:
-        combined_df = pd.concat([pd.read_csv(f) for f in file_list])
-        combined_df.to_csv(os.path.join(final_output_folder, proxy_file), index=False)
-        print(f"Merged: {proxy_file}")
-    except Exception as e:
-        print(f"Error merging {proxy_file}: {e}")
+    # Streaming k-way merge of the sorted day pieces into one time-ordered, deduplicated file
+    merge_one_proxy_sorted(proxy_file_and_paths, final_output_folder)
 
 
 def merge_all_proxy_files_parallel():
@@ -87,19 +44,25 @@ def merge_all_proxy_files_parallel():
             proxy_map[file].append(os.path.join(full_path, file))
 
     proxy_items = list(proxy_map.items())
+    tasks = [(item[0], item, sum(os.path.getsize(f) for f in item[1])) for item in proxy_items]
 
-    with Pool(processes=80) as pool:
-        pool.map(merge_one_proxy, proxy_items)
+    with Pool(processes=choose_pool_size(len(tasks))) as pool:
+        run_scheduled(pool, merge_one_proxy, tasks, kind="merge")
 
 
 if __name__ == "__main__":
     start_time = time.time()
 
-    all_files = sorted(glob.glob(os.path.join(input_folder, "*.csv")))
+    # Plain .csv plus .csv.gz/.csv.zst/.csv.bz2, decompressed as a stream while parsing
+    all_files = find_raw_files(input_folder)
     print(f"Found {len(all_files)} files.")
 
-    with Pool(processes=80) as pool:
-        pool.map(process_one_file, all_files)
+    # Largest files first, on as many workers as cores and the per-worker memory budget allow
+    num_processes = choose_pool_size(len(all_files), task_memory_mb=memory_budget_mb)
+    print(f"Using {num_processes} processes.")
+    with Pool(processes=num_processes) as pool:
+        records = run_scheduled(pool, process_one_file, [(f, f, raw_size_bytes(f)) for f in all_files], kind="ingest")
+    print(f"Slowest files: {format_timing_report(records)}")
 
     print("\nMerging all proxy outputs in parallel...")
     merge_all_proxy_files_parallel()
@@ -1,33 +1,80 @@
 import pandas as pd
 import os
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.base import clone
 from sklearn.ensemble import IsolationForest
 import numpy as np
-import plotly.graph_objs as go  # Add this import
 
-def detect_anomalies(file_path, column_name, output_dir=None, plot_dir=None, start_date=None, end_date=None, **iso_params):
-    df = pd.read_csv(file_path)
-    df['Timestamp'] = pd.to_datetime(df['Timestamp'], format="%d-%m-%Y-%H-%M", errors='coerce')
+from proxy_store import MISSING_COLUMN, is_sorted_series, load_proxy_frame, proxy_name_from_path, safe_proxy_name
+from schema import parse_timestamps
+from model_store import fit_predict_segment
+from prescreen import candidate_mask, prescreen_predict_segment
+from seasonal_baseline import add_seasonal_residual
+from scheduler import split_jobs
+from anomaly_store import ANOMALY_STORE_DIR, write_anomalies
+from plot_data import anomaly_figure, plot_data, plot_file_path, save_plot_data, write_plot_html
+
+CALENDAR_FEATURES = ['hour', 'day_of_week', 'is_weekend']
+
+def detection_range(start_date=None, end_date=None):
+    # end_date is a day and includes all of it
+    range_start = pd.Timestamp(start_date) if start_date else None
+    range_end = pd.Timestamp(end_date) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1) if end_date else None
+    return range_start, range_end
+
+def load_detection_frame(file_path, column_names, start_date=None, end_date=None):
+    """Load the given counters of one proxy once, date-filtered and time-ordered, with calendar features"""
+    range_start, range_end = detection_range(start_date, end_date)
+    # Only the columns detection needs; binary series are sliced to the range before loading
+    df = load_proxy_frame(file_path, columns=['Timestamp', 'ProxyId', *column_names, MISSING_COLUMN], start=range_start, end=range_end)
+    # Unparseable timestamps are reported by parse_timestamps before their rows are dropped
+    df['Timestamp'] = parse_timestamps(df['Timestamp'], file_path)
     df.dropna(subset=['Timestamp'], inplace=True)
+    # Dense-grid outputs carry filler rows for minutes without a sample; only real samples are fitted
+    if MISSING_COLUMN in df.columns:
+        df = df[~df[MISSING_COLUMN].astype(bool)].drop(columns=[MISSING_COLUMN])
     # Filter by date range if provided
     if start_date:
-        df = df[df['Timestamp'] >= pd.Timestamp(start_date)]
+        df = df[df['Timestamp'] >= range_start]
     if end_date:
-        df = df[df['Timestamp'] <= pd.Timestamp(end_date) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)]
-    df = df.sort_values(by='Timestamp').reset_index(drop=True)
-
-    # Ensure the counter column exists, if not, create it with zeros
-    if column_name not in df.columns:
-        df[column_name] = 0
-
+        df = df[df['Timestamp'] <= range_end]
+    # Merged outputs marked sorted are already in time order
+    if not is_sorted_series(file_path):
+        df = df.sort_values(by='Timestamp')
+    df = df.reset_index(drop=True)
+
+    # Ensure the counter columns exist, if not, create them with zeros
+    for column_name in column_names:
+        if column_name not in df.columns:
+            df[column_name] = 0
+    return add_calendar_features(df)
+
+def add_calendar_features(df):
     df['hour'] = df['Timestamp'].dt.hour
     df['day_of_week'] = df['Timestamp'].dt.dayofweek
     df['is_weekend'] = df['day_of_week'] >= 5
     df['day'] = df['Timestamp'].dt.day
     df['monthend_flag'] = df['day'].between(26, 30)
-
-    feature_cols = [column_name, 'hour', 'day_of_week', 'is_weekend']
-    df_regular = df[~df['monthend_flag']].copy()
-    df_monthend = df[df['monthend_flag']].copy()
+    return df
+
+def score_counter(df, column_name, model_store_dir=None, train_end=None, prescreen=False, baseline_dir=None, **iso_params):
+    """Fit one model per segment (regular days, month end) on a counter plus the calendar features
+
+    With model_store_dir, forests already fitted on the same rows and parameters are reused
+    instead of refitted; with train_end, only rows up to it are fitted on and later rows are
+    scored. With prescreen, only minutes a rolling/robust z-score marks as candidates (plus a
+    background sample for the threshold) are scored. With baseline_dir, the distance from the
+    proxy's hour-of-week baseline is added as a feature when one has been built. Returns the
+    frame's shared columns with this counter, its anomaly/is_anomaly labels and each minute's
+    anomaly_score (IsolationForest score_samples, lower is more anomalous; NaN where prescreen
+    skipped it).
+    """
+    feature_cols = [column_name, *CALENDAR_FEATURES]
+    proxy = str(df['ProxyId'].iloc[0]) if len(df) else ""
+    if baseline_dir and len(df):
+        df = df.copy()
+        if add_seasonal_residual(df, column_name, baseline_dir, proxy):
+            feature_cols.append('seasonal_residual')
 
     # Use passed parameters or defaults
     model = IsolationForest(
@@ -40,129 +87,157 @@ def detect_anomalies(file_path, column_name, output_dir=None, plot_dir=None, sta
         random_state=iso_params.get("random_state", 42)
     )
 
-    df_regular['anomaly'] = model.fit_predict(df_regular[feature_cols])
-    df_regular['is_anomaly'] = df_regular['anomaly'] == -1
+    train_mask = None if train_end is None else (df['Timestamp'] <= pd.Timestamp(train_end)).to_numpy()
+    candidates = None
+    if prescreen:
+        candidates = candidate_mask(df[column_name], df['hour'], contamination=model.contamination, features=df[feature_cols])
+    segments = [
+        (segment_name, segment.to_numpy())
+        for segment_name, segment in (("regular", ~df['monthend_flag']), ("monthend", df['monthend_flag']))
+        if segment.any()
+    ]
+
+    def segment_labels(segment_name, segment, segment_model):
+        segment_train_mask = None if train_mask is None else train_mask[segment]
+        if prescreen:
+            return prescreen_predict_segment(
+                segment_model, df.loc[segment, feature_cols], candidates[segment], proxy, column_name, segment_name,
+                model_store_dir, segment_train_mask, random_state=segment_model.random_state, return_scores=True
+            )
+        return fit_predict_segment(
+            segment_model, df.loc[segment, feature_cols], proxy, column_name, segment_name, model_store_dir, segment_train_mask,
+            return_scores=True
+        )
 
-    df_monthend['anomaly'] = model.fit_predict(df_monthend[feature_cols])
-    df_monthend['is_anomaly'] = df_monthend['anomaly'] == -1
+    labels = np.ones(len(df), dtype=int)
+    scores = np.full(len(df), np.nan, dtype=np.float32)
+    n_jobs = model.n_jobs or 1
+    if n_jobs >= len(segments) > 1:
+        # Several cores: both segments are fitted at once (tree building releases the GIL), cores shared by size
+        jobs = split_jobs(n_jobs, [int(segment.sum()) for _, segment in segments])
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [
+                executor.submit(segment_labels, segment_name, segment, clone(model).set_params(n_jobs=segment_jobs))
+                for (segment_name, segment), segment_jobs in zip(segments, jobs)
+            ]
+            for (_, segment), future in zip(segments, futures):
+                labels[segment], scores[segment] = future.result()
+    else:
+        for segment_name, segment in segments:
+            labels[segment], scores[segment] = segment_labels(segment_name, segment, model)
 
-    df_combined = pd.concat([df_regular, df_monthend]).sort_index().reset_index(drop=True)
-    anomaly_df = df_combined[df_combined['is_anomaly']]
+    df_combined = df[['Timestamp', 'ProxyId', column_name, 'hour', 'day_of_week', 'is_weekend', 'day', 'monthend_flag']].copy()
+    df_combined['anomaly'] = labels
+    df_combined['is_anomaly'] = labels == -1
+    df_combined['anomaly_score'] = scores
+    return df_combined
 
-    # === PLOT ===
+def resolve_plot_dir(plot_dir, file_path, column_name):
     # Ensure plot_dir is set to anomaly_plots_inbound/outbound_<counter>
     if plot_dir is None:
         if "inbound" in file_path:
-            plot_dir = f"anomaly_plots_inbound_{column_name}"
+            return f"anomaly_plots_inbound_{column_name}"
         elif "outbound" in file_path:
-            plot_dir = f"anomaly_plots_outbound_{column_name}"
-        else:
-            plot_dir = f"anomaly_plots_{column_name}"
+            return f"anomaly_plots_outbound_{column_name}"
+        return f"anomaly_plots_{column_name}"
+    # If plot_dir is just anomaly_plots_inbound or anomaly_plots_outbound, append counter
+    if plot_dir.endswith("anomaly_plots_inbound") or plot_dir.endswith("anomaly_plots_outbound"):
+        return f"{plot_dir}_{column_name}"
+    return plot_dir
+
+def write_anomaly_plot(df_combined, anomaly_df, column_name, file_path, plot_dir, plot_format="html"):
+    # "html" writes the interactive plot; "data" only the arrays it is drawn from, rendered on demand
+    os.makedirs(plot_dir, exist_ok=True)
+    data = plot_data(df_combined, anomaly_df, column_name)
+    plot_file = plot_file_path(plot_dir, proxy_name_from_path(file_path), column_name, plot_format)
+    if plot_format == "data":
+        save_plot_data(data, plot_file)
     else:
-        # If plot_dir is just anomaly_plots_inbound or anomaly_plots_outbound, append counter
-        if plot_dir.endswith("anomaly_plots_inbound") or plot_dir.endswith("anomaly_plots_outbound"):
-            plot_dir = f"{plot_dir}_{column_name}"
-
-    if plot_dir:
-        os.makedirs(plot_dir, exist_ok=True)
-        fig = go.Figure()
-
-        # Downsample main series if too large
-        max_points = 10000
-        if len(df_combined) > max_points:
-            plot_idx = np.linspace(0, len(df_combined) - 1, max_points, dtype=int)
-            plot_df = df_combined.iloc[plot_idx]
-        else:
-            plot_df = df_combined
-
-        # Main time series (downsampled if needed)
-        fig.add_trace(go.Scatter(
-            x=plot_df['Timestamp'],
-            y=plot_df[column_name],
-            mode='lines',
-            name=column_name,
-            line=dict(color='blue'),
-            hoverinfo='skip'
-        ))
-
-        # Anomalies: red dots and vertical lines to x-axis
-        if not anomaly_df.empty:
-            # Red dots
-            fig.add_trace(go.Scatter(
-                x=anomaly_df['Timestamp'],
-                y=anomaly_df[column_name],
-                mode='markers',
-                name='Anomalies',
-                marker=dict(color='red', size=8, symbol='circle'),
-                hovertemplate="Timestamp: %{x}<br>Value: %{y}<extra></extra>"
-            ))
-            # Vertical lines to x-axis
-            for ts, val in zip(anomaly_df['Timestamp'], anomaly_df[column_name]):
-                fig.add_trace(go.Scatter(
-                    x=[ts, ts],
-                    y=[0, val],
-                    mode='lines',
-                    line=dict(color='red', width=1, dash='dot'),
-                    hoverinfo='skip',
-                    showlegend=False
-                ))
-
-        fig.update_layout(
-            showlegend=False,
-            margin=dict(l=40, r=20, t=40, b=40),
-            xaxis_title="Timestamp",
-            yaxis_title=column_name,
-            template="simple_white",
-            dragmode="zoom"
-        )
+        write_plot_html(anomaly_figure(data, column_name), plot_file)
+    return plot_file
+
+def _detect_counter(df, file_path, column_name, plot_dir, iso_params, model_store_dir=None, train_end=None, baseline_dir=None,
+                    plot_format="html"):
+    df_combined = score_counter(df, column_name, model_store_dir, train_end, baseline_dir=baseline_dir, **iso_params)
+    anomaly_df = df_combined[df_combined['is_anomaly']]
 
+    # === PLOT ===
+    counter_plot_dir = resolve_plot_dir(plot_dir, file_path, column_name)
+    if counter_plot_dir:
+        write_anomaly_plot(df_combined, anomaly_df, column_name, file_path, counter_plot_dir, plot_format)
 
-        proxy_name = os.path.splitext(os.path.basename(file_path))[0]
-        plot_file = os.path.join(plot_dir, f"{proxy_name}_{column_name}_plot.html")
-        fig.write_html(plot_file, include_plotlyjs="cdn")
-        # Inject config for modebar after saving (removes box/lasso select, enables scroll zoom)
-        with open(plot_file, "r", encoding="utf-8") as f:
-            html_content = f.read()
-        config_script = """
-<script type="text/javascript">
-document.addEventListener("DOMContentLoaded", function() {
-    var gd = document.querySelectorAll('.js-plotly-plot');
-    if(gd.length > 0 && window.Plotly) {
-        Plotly.newPlot(gd[0], gd[0].data, gd[0].layout, {
-            displayModeBar: true,
-            modeBarButtonsToRemove: ["select2d", "lasso2d"],
-            scrollZoom: true
-        });
-    }
-});
-</script>
-"""
-        html_content = html_content.replace("</body>", config_script + "\n</body>")
-        with open(plot_file, "w", encoding="utf-8") as f:
-            f.write(html_content)
-
-    columns_to_keep = ['Timestamp', 'ProxyId', column_name, 'hour', 'day_of_week', 'is_weekend', 'day', 'monthend_flag', 'anomaly', 'is_anomaly']
+    columns_to_keep = ['Timestamp', 'ProxyId', column_name, 'hour', 'day_of_week', 'is_weekend', 'day', 'monthend_flag', 'anomaly',
+                       'is_anomaly', 'anomaly_score']
     columns_to_keep = [col for col in columns_to_keep if col in anomaly_df.columns]
     return anomaly_df[columns_to_keep]
 
-
-def filter_anomalies_df(df, output_file, column_name=None):
-    # Save filtered anomalies to the directory specified by output_file
-    output_dir = os.path.dirname(output_file)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
+def detect_anomalies(file_path, column_name, output_dir=None, plot_dir=None, start_date=None, end_date=None,
+                     model_store_dir=None, train_end=None, baseline_dir=None, plot_format="html", **iso_params):
+    df = load_detection_frame(file_path, [column_name], start_date, end_date)
+    return _detect_counter(df, file_path, column_name, plot_dir, iso_params, model_store_dir, train_end, baseline_dir, plot_format)
+
+def detect_anomalies_multi(file_path, column_names, plot_dir=None, start_date=None, end_date=None,
+                           model_store_dir=None, train_end=None, baseline_dir=None, plot_format="html", **iso_params):
+    """Detect anomalies for several counters of one proxy from a single load
+
+    The file is read and the calendar features built once; each counter then gets its own
+    models and plot, exactly as detect_anomalies would produce. With n_jobs above 1 the
+    counters are processed in parallel threads. Returns {counter: anomalies}.
+    """
+    df = load_detection_frame(file_path, column_names, start_date, end_date)
+    n_jobs = iso_params.get("n_jobs", 1) or 1
+    if n_jobs < 2 or len(column_names) < 2:
+        return {
+            column_name: _detect_counter(
+                df, file_path, column_name, plot_dir, iso_params, model_store_dir, train_end, baseline_dir, plot_format
+            )
+            for column_name in column_names
+        }
+    # Several cores: counters are fitted side by side, each with an even share of the cores
+    workers = min(n_jobs, len(column_names))
+    counter_params = dict(iso_params, n_jobs=max(1, n_jobs // workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            column_name: executor.submit(
+                _detect_counter, df, file_path, column_name, plot_dir, counter_params, model_store_dir, train_end, baseline_dir,
+                plot_format
+            )
+            for column_name in column_names
+        }
+        return {column_name: future.result() for column_name, future in futures.items()}
+
+
+def filter_anomaly_columns(df, column_name):
     # Only keep relevant columns, exclude rolling statistics
+    columns_to_keep = ['Timestamp', 'ProxyId', column_name, 'day', 'anomaly_score']
+    return df[[col for col in columns_to_keep if col in df.columns]]
+
+def direction_from_path(path):
+    if "inbound" in path:
+        return "inbound"
+    if "outbound" in path:
+        return "outbound"
+    return ""
+
+def filter_anomalies_df(df, output_file, column_name=None, start_date=None, end_date=None, store_dir=ANOMALY_STORE_DIR,
+                        proxy_name=None):
+    # With a counter the filtered anomalies go to the anomaly store under proxy_name (else the
+    # frame's ProxyId), with output_file's folder giving the direction. Without one, output_file is written as is
+    output_dir = os.path.dirname(output_file)
     filtered_df = df
     if column_name:
-        columns_to_keep = ['Timestamp', 'ProxyId', column_name, 'day']
-        columns_to_keep = [col for col in columns_to_keep if col in filtered_df.columns]
-        filtered_df = filtered_df[columns_to_keep]
-        # Change output_file to proxyname_countername.csv format, but keep in the same directory
-        base = os.path.splitext(os.path.basename(output_file))[0]
-        if "_" in base:
-            proxy_name = "_".join(base.split("_")[:-1])
-        else:
-            proxy_name = base
-        output_file = os.path.join(output_dir, f"{proxy_name}_{column_name}.csv")
+        filtered_df = filter_anomaly_columns(filtered_df, column_name)
+        if proxy_name is None and 'ProxyId' in filtered_df.columns and len(filtered_df):
+            proxy_name = safe_proxy_name(filtered_df['ProxyId'].iloc[0])
+        if proxy_name is None:
+            # Nothing flagged to name it: the old proxyname_countername.csv convention
+            base = os.path.splitext(os.path.basename(output_file))[0]
+            proxy_name = "_".join(base.split("_")[:-1]) if "_" in base else base
+        direction = direction_from_path(output_file)
+        write_anomalies({proxy_name: filtered_df}, direction, column_name, start_date, end_date, store_dir)
+        print(f"Filtered anomalies of {proxy_name} stored in '{store_dir}' ({direction or 'unknown'}/{column_name})")
+        return
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
     filtered_df.to_csv(output_file, index=False)
     print(f"Filtered data saved to '{output_file}'")
\ No newline at end of file
@@ -5,6 +5,8 @@ import time
 from datetime import datetime
 
 from ag import detect_anomalies, filter_anomalies_df
+from anomaly_store import ANOMALY_STORE_DIR
+from proxy_store import proxy_name_from_path
 
 def get_user_choices():
     while True:
@@ -46,12 +48,15 @@ def process_file(args):
     file_path, column_name, output_dir, plot_dir, start_date, end_date = args
     try:
         print(f"Processing: {file_path}")
-        anomaly_df = detect_anomalies(file_path, column_name, plot_dir, start_date, end_date)
+        anomaly_df = detect_anomalies(file_path, column_name, plot_dir=plot_dir, start_date=start_date, end_date=end_date)
 
         base_name = os.path.basename(file_path).replace(".csv", "_anomalies_filtered.csv")
         final_output = os.path.join(output_dir, base_name)
 
-        filter_anomalies_df(anomaly_df, final_output, column_name)
+        # The store entry covers the analysed range, so stored days outside it stay visible
+        filter_anomalies_df(
+            anomaly_df, final_output, column_name, start_date=start_date, end_date=end_date, proxy_name=proxy_name_from_path(file_path)
+        )
 
         print(f"Done: {file_path}")
         return final_output
@@ -92,5 +97,5 @@ end_time = time.time()
 elapsed = end_time - start_time
 
 successful = [r for r in results if r]
-print(f"\nCompleted processing {len(successful)} files. Output stored in '{OUTPUT_DIR}'.")
+print(f"\nCompleted processing {len(successful)} files. Anomalies stored in '{ANOMALY_STORE_DIR}'.")
 print(f"Total execution time: {elapsed:.2f} seconds.")
\ No newline at end of file
@@ -0,0 +1,208 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from collections import defaultdict
+
+import pandas as pd
+
+from proxy_store import DATE_PARTITION_PREFIX
+from schema import dtypes_for
+
+# Every detection run's anomalies, appended to one store instead of a CSV per proxy and counter:
+#   <store>/<direction>/<counter>/date=YYYY-MM-DD/part-<write>.parquet   that day's rows of one write, by proxy
+#   <store>/<direction>/<counter>/_index/<write>.parquet                 the write's proxy index
+# Index rows give each proxy's rows in a part file (date, row_start, rows), plus one row per proxy
+# with no date recording the days the write covered (cover_start..cover_end, empty for all days).
+# A later write covering a proxy's day replaces what earlier writes stored for it, even when it
+# found no anomalies there. Write ids sort by time, and the index file is written last, so readers
+# never see half a write.
+ANOMALY_STORE_DIR = "anomaly_store"
+INDEX_DIR = "_index"
+INDEX_COLUMNS = ["write_id", "proxy", "date", "row_start", "rows", "cover_start", "cover_end"]
+
+
+def counter_dir(direction, counter, store_dir=ANOMALY_STORE_DIR):
+    return os.path.join(store_dir, direction or "unknown", counter)
+
+
+def _day(value):
+    return pd.Timestamp(value).strftime("%Y-%m-%d") if value is not None else None
+
+
+def _part_path(root, date, write_id):
+    return os.path.join(root, f"{DATE_PARTITION_PREFIX}{date}", f"part-{write_id}.parquet")
+
+
+def _write_parquet(df, path, compression="zstd"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False, compression=compression)
+    os.replace(tmp_path, path)
+
+
+def write_anomalies(frames, direction, counter, start_date=None, end_date=None, store_dir=ANOMALY_STORE_DIR):
+    """Append {proxy: anomaly frame} for one counter as a single write; returns its write id
+
+    The write covers each given proxy from start_date to end_date (days, None for unbounded).
+    """
+    root = counter_dir(direction, counter, store_dir)
+    write_id = f"{time.time_ns():020d}-{os.getpid()}"
+    index = []
+    days = defaultdict(list)
+    for proxy, df in frames.items():
+        index.append({"proxy": proxy, "date": None, "row_start": 0, "rows": 0})
+        if df is None or df.empty:
+            continue
+        if "ProxyId" in df.columns:
+            df = df.assign(ProxyId=df["ProxyId"].astype(str))
+        for date, day_df in df.groupby(df["Timestamp"].dt.strftime("%Y-%m-%d"), sort=True):
+            days[date].append((proxy, day_df.sort_values("Timestamp")))
+
+    for date, parts in days.items():
+        row_start = 0
+        for proxy, day_df in parts:
+            index.append({"proxy": proxy, "date": date, "row_start": row_start, "rows": len(day_df)})
+            row_start += len(day_df)
+        _write_parquet(pd.concat([day_df for _, day_df in parts], ignore_index=True), _part_path(root, date, write_id))
+
+    index_df = pd.DataFrame(index, columns=INDEX_COLUMNS[1:5])
+    index_df.insert(0, "write_id", write_id)
+    index_df["cover_start"] = _day(start_date)
+    index_df["cover_end"] = _day(end_date)
+    _write_parquet(index_df.astype({"proxy": str, "date": object, "cover_start": object, "cover_end": object}),
+                   os.path.join(root, INDEX_DIR, f"{write_id}.parquet"))
+    return write_id
+
+
+def load_index(direction, counter, store_dir=ANOMALY_STORE_DIR):
+    index_files = sorted(glob.glob(os.path.join(counter_dir(direction, counter, store_dir), INDEX_DIR, "*.parquet")))
+    if not index_files:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    return pd.concat([pd.read_parquet(path) for path in index_files], ignore_index=True)
+
+
+def visible_entries(index):
+    """Index rows of part files still current: no later write covers their proxy and day"""
+    coverage = index[index["date"].isna()][["proxy", "write_id", "cover_start", "cover_end"]]
+    entries = index[index["date"].notna()]
+    pairs = entries.reset_index().merge(coverage, on="proxy", suffixes=("", "_later"))
+    replaced = (
+        (pairs["write_id_later"] > pairs["write_id"])
+        & (pairs["cover_start_later"].isna() | (pairs["cover_start_later"] <= pairs["date"]))
+        & (pairs["cover_end_later"].isna() | (pairs["date"] <= pairs["cover_end_later"]))
+    )
+    return entries.drop(index=pairs.loc[replaced, "index"].unique())
+
+
+def list_proxies(direction, counter, store_dir=ANOMALY_STORE_DIR):
+    """{proxy: anomaly count} for every proxy the store has results for, from the index alone"""
+    index = load_index(direction, counter, store_dir)
+    counts = visible_entries(index).groupby("proxy")["rows"].sum()
+    return {proxy: int(counts.get(proxy, 0)) for proxy in sorted(index["proxy"].unique())}
+
+
+def read_anomalies(direction, counter, proxies=None, start_date=None, end_date=None, columns=None, store_dir=ANOMALY_STORE_DIR):
+    """Current anomalies of the given proxies (all by default) between two days, in one frame
+
+    Only the part files of matching days are opened, and only the index's row ranges are kept.
+    """
+    root = counter_dir(direction, counter, store_dir)
+    entries = visible_entries(load_index(direction, counter, store_dir))
+    if proxies is not None:
+        entries = entries[entries["proxy"].isin(list(proxies))]
+    if start_date is not None:
+        entries = entries[entries["date"] >= _day(start_date)]
+    if end_date is not None:
+        entries = entries[entries["date"] <= _day(end_date)]
+
+    frames = []
+    for (date, write_id), group in entries.groupby(["date", "write_id"], sort=True):
+        part = pd.read_parquet(_part_path(root, date, write_id))
+        if columns is not None:
+            part = part[[col for col in columns if col in part.columns]]
+        if group["rows"].sum() == len(part):
+            frames.append(part)
+        else:
+            frames.extend(part.iloc[start:start + rows] for start, rows in zip(group["row_start"], group["rows"]))
+    if not frames:
+        return pd.DataFrame(columns=columns if columns is not None else ["Timestamp", "ProxyId", counter])
+    df = pd.concat(frames, ignore_index=True)
+    df = df.astype(dtypes_for(df.columns))
+    sort_by = [col for col in ["ProxyId", "Timestamp"] if col in df.columns]
+    return df.sort_values(sort_by).reset_index(drop=True) if sort_by else df
+
+
+def export_csv(direction, counter, output_dir, proxies=None, store_dir=ANOMALY_STORE_DIR):
+    """Write the stored anomalies as one <proxy>_<counter>.csv per proxy; returns the paths written"""
+    os.makedirs(output_dir, exist_ok=True)
+    df = read_anomalies(direction, counter, proxies, store_dir=store_dir)
+    paths = []
+    for proxy, proxy_df in df.groupby("ProxyId", observed=True):
+        path = os.path.join(output_dir, f"{proxy}_{counter}.csv")
+        proxy_df.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def compact_store(direction, counter, store_dir=ANOMALY_STORE_DIR):
+    """Rewrite a counter's current anomalies as one write and remove the replaced files
+
+    Not to be run while results are being written to the same counter. Returns the files removed.
+    """
+    root = counter_dir(direction, counter, store_dir)
+    index = load_index(direction, counter, store_dir)
+    if index["write_id"].nunique() < 2:
+        return 0
+    entries = visible_entries(index)
+    frames = {proxy: [] for proxy in index["proxy"].unique()}
+    for (date, write_id), group in entries.groupby(["date", "write_id"]):
+        part = pd.read_parquet(_part_path(root, date, write_id))
+        for proxy, start, rows in zip(group["proxy"], group["row_start"], group["rows"]):
+            frames[proxy].append(part.iloc[start:start + rows])
+    write_id = write_anomalies(
+        {proxy: pd.concat(parts, ignore_index=True) if parts else None for proxy, parts in frames.items()},
+        direction, counter, store_dir=store_dir
+    )
+    # The new write already replaces everything, so readers are unaffected by the removals
+    old_parts = index.dropna(subset=["date"])[["date", "write_id"]].drop_duplicates()
+    old_files = [os.path.join(root, INDEX_DIR, f"{old_id}.parquet") for old_id in index["write_id"].unique()]
+    old_files += [_part_path(root, date, old_id) for date, old_id in old_parts.itertuples(index=False)]
+    removed = 0
+    for path in old_files:
+        if write_id not in path and os.path.exists(path):
+            os.remove(path)
+            removed += 1
+            day_dir = os.path.dirname(path)
+            if os.path.basename(day_dir).startswith(DATE_PARTITION_PREFIX) and not os.listdir(day_dir):
+                os.rmdir(day_dir)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List, export or compact the consolidated anomaly store")
+    parser.add_argument("action", choices=["list", "export", "compact"])
+    parser.add_argument("direction", choices=["inbound", "outbound"])
+    parser.add_argument("counter", help="Counter column, e.g. response2xxForwardedCounter")
+    parser.add_argument("--store", default=ANOMALY_STORE_DIR, help="Store folder")
+    parser.add_argument("--output", default=None, help="Folder for export (default anomaly_export_<direction>_<counter>)")
+    parser.add_argument("--proxy", action="append", default=None, help="Only this proxy (repeatable)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(counter_dir(args.direction, args.counter, args.store)):
+        print(f"Error: no stored anomalies for {args.direction}/{args.counter} in {args.store}")
+        sys.exit(1)
+    if args.action == "list":
+        for proxy, count in list_proxies(args.direction, args.counter, args.store).items():
+            print(f"{proxy}: {count}")
+    elif args.action == "export":
+        output_dir = args.output or f"anomaly_export_{args.direction}_{args.counter}"
+        paths = export_csv(args.direction, args.counter, output_dir, args.proxy, args.store)
+        print(f"Exported {len(paths)} proxies to {output_dir}")
+    else:
+        print(f"Removed {compact_store(args.direction, args.counter, args.store)} replaced files")
+
+
+if __name__ == "__main__":
+    main()
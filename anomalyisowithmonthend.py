@@ -5,16 +5,30 @@ import os
 import plotly.graph_objs as go  # Add this import
 import numpy as np  # Add this import
 
-def detect_anomalies(file_path, column_name, plot_dir=None, start_date=None, end_date=None, **iso_params):
-    df = pd.read_csv(file_path)
-    df['Timestamp'] = pd.to_datetime(df['Timestamp'], format="%d-%m-%Y-%H-%M", errors='coerce')
+from proxy_store import MISSING_COLUMN, is_sorted_series, load_proxy_frame, proxy_name_from_path
+from schema import parse_timestamps
+from model_store import fit_predict_segment
+from prescreen import candidate_mask, prescreen_predict_segment
+from seasonal_baseline import add_seasonal_residual
+
+def detect_anomalies(file_path, column_name, plot_dir=None, start_date=None, end_date=None, model_store_dir=None, train_end=None,
+                     prescreen=False, baseline_dir=None, **iso_params):
+    range_start = pd.to_datetime(start_date) if start_date else None
+    range_end = pd.to_datetime(end_date) if end_date else None
+    # Only the columns detection needs; binary series are sliced to the range before loading
+    df = load_proxy_frame(file_path, columns=['Timestamp', 'ProxyId', column_name, MISSING_COLUMN], start=range_start, end=range_end)
+    # Unparseable timestamps are reported by parse_timestamps before their rows are dropped
+    df['Timestamp'] = parse_timestamps(df['Timestamp'], file_path)
     df.dropna(subset=['Timestamp'], inplace=True)
     # === Date filtering ===
     if start_date:
-        df = df[df['Timestamp'] >= pd.to_datetime(start_date)]
+        df = df[df['Timestamp'] >= range_start]
     if end_date:
-        df = df[df['Timestamp'] <= pd.to_datetime(end_date)]
-    df = df.sort_values(by='Timestamp').reset_index(drop=True)
+        df = df[df['Timestamp'] <= range_end]
+    # Merged outputs marked sorted are already in time order
+    if not is_sorted_series(file_path):
+        df = df.sort_values(by='Timestamp')
+    df = df.reset_index(drop=True)
 
     # Ensure the counter column exists, if not, create it with zeros
     if column_name not in df.columns:
@@ -27,12 +41,21 @@ def detect_anomalies(file_path, column_name, plot_dir=None, start_date=None, end
     df['monthend_flag'] = df['day'].between(26, 30)
 
     window = 200
-    df['rolling_mean'] = df[column_name].rolling(window).mean()
-    df['rolling_std'] = df[column_name].rolling(window).std()
+    # On a dense grid the window spans 200 real minutes; gap rows are empty, so half of it must hold samples
+    dense = MISSING_COLUMN in df.columns
+    min_periods = window // 2 if dense else None
+    df['rolling_mean'] = df[column_name].rolling(window, min_periods=min_periods).mean()
+    df['rolling_std'] = df[column_name].rolling(window, min_periods=min_periods).std()
     df['z_score'] = (df[column_name] - df['rolling_mean']) / df['rolling_std']
     df['z_score'] = df['z_score'].fillna(0)
+    # Filler rows only shape the windows; the model sees real samples
+    if dense:
+        df = df[~df[MISSING_COLUMN].astype(bool)].drop(columns=[MISSING_COLUMN]).reset_index(drop=True)
 
     feature_cols = [column_name, 'hour', 'day_of_week', 'is_weekend', 'z_score']
+    # Distance from the proxy's hour-of-week baseline, when one has been built
+    if baseline_dir and add_seasonal_residual(df, column_name, baseline_dir, proxy_name_from_path(file_path)):
+        feature_cols.append('seasonal_residual')
 
     df_regular = df[~df['monthend_flag']].copy()
     df_monthend = df[df['monthend_flag']].copy()
@@ -48,16 +71,35 @@ def detect_anomalies(file_path, column_name, plot_dir=None, start_date=None, end
         random_state=iso_params.get("random_state", 42)
     )
 
+    # Optional prescreen: the rolling z-score above (and hourly MAD) picks the minutes the forest scores
+    if prescreen:
+        df['candidate'] = candidate_mask(
+            df[column_name], df['hour'], z_score=df['z_score'], contamination=model.contamination, features=df[feature_cols]
+        )
+        df_regular['candidate'] = df.loc[df_regular.index, 'candidate']
+        df_monthend['candidate'] = df.loc[df_monthend.index, 'candidate']
+
+    # Cached forests are reused for unchanged training rows; rows after train_end are scored only
+    proxy_name = proxy_name_from_path(file_path)
+    def segment_labels(segment_df, segment_name):
+        train_mask = None if train_end is None else (segment_df['Timestamp'] <= pd.Timestamp(train_end)).to_numpy()
+        if prescreen:
+            return prescreen_predict_segment(
+                model, segment_df[feature_cols], segment_df['candidate'].to_numpy(), proxy_name, column_name, segment_name,
+                model_store_dir, train_mask, random_state=model.random_state
+            )
+        return fit_predict_segment(model, segment_df[feature_cols], proxy_name, column_name, segment_name, model_store_dir, train_mask)
+
     # Only fit if there is at least one sample
     if not df_regular.empty:
-        df_regular['anomaly'] = model.fit_predict(df_regular[feature_cols])
+        df_regular['anomaly'] = segment_labels(df_regular, "regular")
         df_regular['is_anomaly'] = df_regular['anomaly'] == -1
     else:
         df_regular['anomaly'] = pd.Series([False] * len(df_regular), index=df_regular.index)
         df_regular['is_anomaly'] = pd.Series([False] * len(df_regular), index=df_regular.index)
 
     if not df_monthend.empty:
-        df_monthend['anomaly'] = model.fit_predict(df_monthend[feature_cols])
+        df_monthend['anomaly'] = segment_labels(df_monthend, "monthend")
         df_monthend['is_anomaly'] = df_monthend['anomaly'] == -1
     else:
         df_monthend['anomaly'] = pd.Series([False] * len(df_monthend), index=df_monthend.index)
@@ -95,7 +137,7 @@ def detect_anomalies(file_path, column_name, plot_dir=None, start_date=None, end
 
     excel_dir = os.path.join("anomaly_excels", direction) if direction else "anomaly_excels"
     os.makedirs(excel_dir, exist_ok=True)
-    proxy_name = os.path.splitext(os.path.basename(file_path))[0]
+    proxy_name = proxy_name_from_path(file_path)
     output_file = os.path.join(excel_dir, f"{proxy_name}_{column_name}.csv")
     anomaly_df.to_csv(output_file, index=False)
     print(f"Anomalies saved to '{output_file}'")
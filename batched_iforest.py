@@ -0,0 +1,340 @@
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from ag import CALENDAR_FEATURES, load_detection_frame, resolve_plot_dir, write_anomaly_plot
+from proxy_store import list_proxy_paths, proxy_name_from_path
+
+# Same defaults as ag.score_counter
+DEFAULT_ISO_PARAMS = dict(
+    n_estimators=25, max_samples=0.1, contamination=0.0075, max_features=0.80, bootstrap=True, random_state=42
+)
+# Upper bound on (row, tree) pairs walked through the forests at once, to keep scoring memory flat
+SCORE_CHUNK_PAIRS = 250_000
+# Proxies packed into one engine call from detect_anomalies_batch
+PROXIES_PER_BATCH = 256
+OUTPUT_COLUMNS = ['Timestamp', 'ProxyId', 'hour', 'day_of_week', 'is_weekend', 'day', 'monthend_flag', 'anomaly', 'is_anomaly',
+                  'anomaly_score']
+EULER_GAMMA = np.euler_gamma
+
+
+def average_path_length(n_samples):
+    """Expected path length of an unsuccessful search in a binary tree of n samples (as sklearn)"""
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    result = np.zeros_like(n_samples)
+    result[n_samples == 2] = 1.0
+    large = n_samples > 2
+    n = n_samples[large]
+    result[large] = 2.0 * (np.log(n - 1.0) + EULER_GAMMA) - 2.0 * (n - 1.0) / n
+    return result
+
+
+def _sample_sizes(sizes, max_samples):
+    if max_samples == "auto":
+        return np.minimum(256, sizes)
+    if isinstance(max_samples, float):
+        return np.maximum(1, (max_samples * sizes).astype(np.int64))
+    return np.minimum(int(max_samples), sizes)
+
+
+class BatchedForest:
+    """Isolation forests for many independent groups of rows, built and scored level by level
+
+    Every group (one proxy segment) gets its own n_estimators trees drawn from its own rows,
+    exactly as one sklearn IsolationForest per group would, but all trees of all groups grow
+    together: each level is a handful of NumPy operations over every node at that depth.
+    Trees are stored flat: feature (-1 for leaves), threshold, left child (right is left + 1)
+    and, for leaves, the path length credited to samples ending there.
+    """
+
+    def __init__(self, n_estimators=25, max_samples=0.1, max_features=0.80, bootstrap=True, random_state=42):
+        self.n_estimators = n_estimators
+        self.max_samples = max_samples
+        self.max_features = max_features
+        self.bootstrap = bootstrap
+        self.rng = np.random.default_rng(random_state)
+
+    def _draw_samples(self, offsets, sizes):
+        trees = self.n_estimators
+        per_tree = np.repeat(self.psi_, trees)
+        tree_of_sample = np.repeat(np.arange(len(per_tree)), per_tree)
+        group_of_sample = tree_of_sample // trees
+        if self.bootstrap:
+            local = (self.rng.random(len(tree_of_sample)) * sizes[group_of_sample]).astype(np.int64)
+        else:
+            local = np.concatenate([
+                self.rng.permutation(sizes[tree // trees])[:per_tree[tree]] for tree in range(len(per_tree))
+            ]) if len(per_tree) else np.empty(0, dtype=np.int64)
+        return offsets[group_of_sample] + local, tree_of_sample
+
+    def _feature_masks(self, num_trees, num_features):
+        if isinstance(self.max_features, float):
+            per_tree = max(1, int(self.max_features * num_features))
+        else:
+            per_tree = min(int(self.max_features), num_features)
+        # Each tree sees its own random subset of the features, as sklearn draws per estimator
+        chosen = np.argsort(self.rng.random((num_trees, num_features)), axis=1)[:, :per_tree]
+        masks = np.zeros((num_trees, num_features), dtype=bool)
+        np.put_along_axis(masks, chosen, True, axis=1)
+        return masks
+
+    def fit(self, X, sizes):
+        """Grow n_estimators trees per group; X holds the groups' training rows back to back"""
+        # Feature-major copy: per-node reductions run along contiguous rows
+        columns = np.ascontiguousarray(np.asarray(X, dtype=np.float64).T)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        self.psi_ = _sample_sizes(sizes, self.max_samples)
+        self.max_depth_ = np.ceil(np.log2(np.maximum(self.psi_, 2))).astype(np.int64)
+        num_trees = len(sizes) * self.n_estimators
+        num_features = len(columns)
+        allowed = self._feature_masks(num_trees, num_features)
+
+        sample_rows, sample_node = self._draw_samples(offsets, sizes)
+        feature, threshold, left, value = [], [], [], []
+        level_start, level_tree = 0, np.arange(num_trees)
+        depth = 0
+        while len(level_tree):
+            num_nodes = len(level_tree)
+            local = sample_node - level_start
+            counts = np.bincount(local, minlength=num_nodes)
+            # Samples are kept grouped by node, so per-node ranges are reductions over slices
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            values = columns[:, sample_rows]
+            node_min = np.minimum.reduceat(values, starts, axis=1).T
+            node_max = np.maximum.reduceat(values, starts, axis=1).T
+            varying = (node_max > node_min) & allowed[level_tree]
+            group = level_tree // self.n_estimators
+            split = (counts > 1) & (depth < self.max_depth_[group]) & varying.any(axis=1)
+
+            # A random varying feature and a uniform threshold between its min and max per node
+            node_feature = np.argmax(self.rng.random(varying.shape) * varying, axis=1)
+            low = node_min[np.arange(num_nodes), node_feature]
+            high = node_max[np.arange(num_nodes), node_feature]
+            node_threshold = low + self.rng.random(num_nodes) * (high - low)
+            node_threshold = np.where(node_threshold >= high, low, node_threshold)
+
+            level_end = level_start + num_nodes
+            rank = np.cumsum(split) - 1
+            node_left = np.where(split, level_end + 2 * rank, -1)
+            feature.append(np.where(split, node_feature, -1))
+            threshold.append(np.where(split, node_threshold, 0.0))
+            left.append(node_left)
+            value.append(np.where(split, 0.0, depth + average_path_length(counts)))
+
+            # Route the samples of split nodes to their children; the rest stop here
+            keep = split[local]
+            sample_rows, local = sample_rows[keep], local[keep]
+            go_right = columns.ravel()[node_feature[local] * columns.shape[1] + sample_rows] > node_threshold[local]
+            sample_node = node_left[local] + go_right
+            order = np.argsort(sample_node, kind="stable")
+            sample_rows, sample_node = sample_rows[order], sample_node[order]
+
+            level_start, level_tree = level_end, np.repeat(level_tree[split], 2)
+            depth += 1
+
+        self.feature_ = np.concatenate(feature)
+        self.threshold_ = np.concatenate(threshold)
+        self.left_ = np.concatenate(left)
+        self.value_ = np.concatenate(value)
+        # Scoring walks a fixed number of levels: leaves point back at themselves and never go right
+        leaves = self.feature_ < 0
+        self._route_feature = np.where(leaves, 0, self.feature_).astype(np.int32)
+        self._route_threshold = np.where(leaves, np.inf, self.threshold_)
+        self._route_left = np.where(leaves, np.arange(len(leaves)), self.left_).astype(np.int32)
+        return self
+
+    def score_samples(self, X, sizes):
+        """Opposite of the anomaly score for each row, scored by its own group's trees (as sklearn)"""
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        flat = X.ravel()
+        sizes = np.asarray(sizes, dtype=np.int64)
+        trees = self.n_estimators
+        scores = np.empty(len(X))
+        group_of_row = np.repeat(np.arange(len(sizes)), sizes)
+        # A single sample per tree gives no path length to normalise by; such rows score -1
+        normaliser = average_path_length(self.psi_)
+        normaliser[normaliser == 0] = np.inf
+        rows_per_chunk = max(1, SCORE_CHUNK_PAIRS // trees)
+        for start in range(0, len(X), rows_per_chunk):
+            rows = np.arange(start, min(start + rows_per_chunk, len(X)))
+            groups = group_of_row[rows]
+            pair_base = np.repeat(rows * X.shape[1], trees)
+            # Roots are numbered by tree, and a group's trees are consecutive
+            node = (np.repeat(groups * trees, trees) + np.tile(np.arange(trees), len(rows))).astype(np.int32)
+            for _ in range(int(self.max_depth_[groups].max())):
+                go_right = flat[pair_base + self._route_feature[node]] > self._route_threshold[node]
+                node = self._route_left[node] + go_right
+            depths = self.value_[node].reshape(len(rows), trees).mean(axis=1)
+            scores[rows] = -(2.0 ** (-depths / normaliser[groups]))
+        return scores
+
+
+def fit_predict_groups(groups, train_masks=None, contamination=0.0075, return_scores=False, **forest_params):
+    """Labels (1 normal, -1 anomaly) for each feature matrix in groups, each with its own forest
+
+    Same semantics as fitting one IsolationForest per group and calling predict on it: the
+    threshold is the contamination percentile of the training rows' scores ("auto": -0.5).
+    With train_masks, each group is fitted on its masked rows only and all its rows are scored.
+    With return_scores, (labels, scores) with the score_samples of every row (NaN when unfitted).
+    """
+    groups = [np.asarray(group, dtype=np.float64) for group in groups]
+    if train_masks is None:
+        train_groups = groups
+    else:
+        train_groups = [group[mask] for group, mask in zip(groups, train_masks)]
+    # Groups with no training rows get no model and stay all normal
+    fitted = [i for i, group in enumerate(train_groups) if len(group)]
+    labels = [np.ones(len(group), dtype=int) for group in groups]
+    all_scores = [np.full(len(group), np.nan, dtype=np.float32) for group in groups]
+    if not fitted:
+        return (labels, all_scores) if return_scores else labels
+
+    train_sizes = [len(train_groups[i]) for i in fitted]
+    forest = BatchedForest(**forest_params).fit(np.concatenate([train_groups[i] for i in fitted]), train_sizes)
+    score_sizes = [len(groups[i]) for i in fitted]
+    scores = np.split(forest.score_samples(np.concatenate([groups[i] for i in fitted]), score_sizes), np.cumsum(score_sizes)[:-1])
+    if train_masks is None:
+        train_scores = scores
+    else:
+        train_scores = [score[train_masks[i]] for i, score in zip(fitted, scores)]
+    for i, score, train_score in zip(fitted, scores, train_scores):
+        offset = -0.5 if contamination == "auto" else np.percentile(train_score, 100.0 * contamination)
+        labels[i] = np.where(score < offset, -1, 1)
+        all_scores[i] = score.astype(np.float32)
+    return (labels, all_scores) if return_scores else labels
+
+
+def _forest_params(iso_params):
+    params = {**DEFAULT_ISO_PARAMS, **iso_params}
+    params.pop("n_jobs", None)
+    # Scoring every row is already cheap here, so the prescreen option has nothing to skip
+    params.pop("prescreen", None)
+    contamination = params.pop("contamination")
+    return contamination, params
+
+
+def score_frames(frames, column_name, train_end=None, **iso_params):
+    """ag.score_counter for many loaded proxies at once; returns the labelled frames in order"""
+    contamination, forest_params = _forest_params(iso_params)
+    feature_cols = [column_name, *CALENDAR_FEATURES]
+    groups, masks, places = [], [], []
+    for frame_index, df in enumerate(frames):
+        features = df[feature_cols].to_numpy(dtype=np.float64)
+        monthend = df['monthend_flag'].to_numpy(dtype=bool)
+        train = None if train_end is None else (df['Timestamp'] <= pd.Timestamp(train_end)).to_numpy()
+        for segment in (~monthend, monthend):
+            if segment.any():
+                groups.append(features[segment])
+                masks.append(None if train is None else train[segment])
+                places.append((frame_index, segment))
+
+    labels = [np.ones(len(df), dtype=int) for df in frames]
+    scores = [np.full(len(df), np.nan, dtype=np.float32) for df in frames]
+    group_labels, group_scores = fit_predict_groups(
+        groups, None if train_end is None else masks, contamination, return_scores=True, **forest_params
+    )
+    for (frame_index, segment), segment_labels, segment_scores in zip(places, group_labels, group_scores):
+        labels[frame_index][segment] = segment_labels
+        scores[frame_index][segment] = segment_scores
+
+    results = []
+    for df, frame_labels, frame_scores in zip(frames, labels, scores):
+        df_combined = df[['Timestamp', 'ProxyId', column_name, 'hour', 'day_of_week', 'is_weekend', 'day', 'monthend_flag']].copy()
+        df_combined['anomaly'] = frame_labels
+        df_combined['is_anomaly'] = frame_labels == -1
+        df_combined['anomaly_score'] = frame_scores
+        results.append(df_combined)
+    return results
+
+
+def detect_anomalies_batch(file_paths, column_name, plot_dir=None, start_date=None, end_date=None,
+                           train_end=None, proxies_per_batch=PROXIES_PER_BATCH, fleet=None, plot_format="html", **iso_params):
+    """ag.detect_anomalies for many proxy files, with the forests of each batch built together
+
+    Returns {file_path: anomalies} with the same columns as ag.detect_anomalies; plots (or with
+    plot_format "data", plot data) are written per proxy as usual unless plot_dir is False. With fleet (a fleet_matrix.FleetMatrix
+    of this counter), proxies are sliced from its rows instead of being loaded from their files.
+    """
+    results = {}
+    for start in range(0, len(file_paths), proxies_per_batch):
+        batch = file_paths[start:start + proxies_per_batch]
+        if fleet is not None:
+            frames = [fleet.detection_frame(proxy_name_from_path(file_path), start_date, end_date) for file_path in batch]
+        else:
+            frames = [load_detection_frame(file_path, [column_name], start_date, end_date) for file_path in batch]
+        for file_path, df_combined in zip(batch, score_frames(frames, column_name, train_end, **iso_params)):
+            anomaly_df = df_combined[df_combined['is_anomaly']]
+            counter_plot_dir = resolve_plot_dir(plot_dir, file_path, column_name) if plot_dir is not False else None
+            if counter_plot_dir:
+                write_anomaly_plot(df_combined, anomaly_df, column_name, file_path, counter_plot_dir, plot_format)
+            results[file_path] = anomaly_df[[OUTPUT_COLUMNS[0], OUTPUT_COLUMNS[1], column_name, *OUTPUT_COLUMNS[2:]]]
+    return results
+
+
+def benchmark(file_paths, column_name, repeats=1, **iso_params):
+    """Time per-proxy sklearn scoring (ag.score_counter) against the batched engine on the same frames
+
+    Loading is done once up front and excluded, so only fitting and scoring are compared.
+    Returns a dict with both timings, proxies per second and how far the flagged minutes agree.
+    """
+    from ag import score_counter
+
+    frames = [load_detection_frame(file_path, [column_name]) for file_path in file_paths]
+    params = {**DEFAULT_ISO_PARAMS, **iso_params}
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        reference = [score_counter(df, column_name, **params) for df in frames]
+    sklearn_seconds = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        batched = score_frames(frames, column_name, **params)
+    batched_seconds = (time.perf_counter() - start) / repeats
+
+    # Both engines are random, so agreement is judged against sklearn with another seed
+    reseeded = [score_counter(df, column_name, **{**params, "random_state": params["random_state"] + 1}) for df in frames]
+    return {
+        "proxies": len(frames),
+        "rows": sum(len(df) for df in frames),
+        "sklearn_seconds": round(sklearn_seconds, 3),
+        "batched_seconds": round(batched_seconds, 3),
+        "sklearn_proxies_per_second": round(len(frames) / sklearn_seconds, 1) if sklearn_seconds else None,
+        "batched_proxies_per_second": round(len(frames) / batched_seconds, 1) if batched_seconds else None,
+        "speedup": round(sklearn_seconds / batched_seconds, 2) if batched_seconds else None,
+        "flagged_sklearn": sum(int(df['is_anomaly'].sum()) for df in reference),
+        "flagged_batched": sum(int(df['is_anomaly'].sum()) for df in batched),
+        "overlap_batched_vs_sklearn": _flagged_overlap(reference, batched),
+        "overlap_sklearn_vs_reseeded": _flagged_overlap(reference, reseeded),
+    }
+
+
+def _flagged_overlap(first, second):
+    # Share of minutes flagged by either run that both flagged
+    both = sum(int((a['is_anomaly'] & b['is_anomaly']).sum()) for a, b in zip(first, second))
+    either = sum(int((a['is_anomaly'] | b['is_anomaly']).sum()) for a, b in zip(first, second))
+    return round(both / either, 3) if either else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched isolation-forest engine against per-proxy sklearn")
+    parser.add_argument("input_dir", help="Folder of per-proxy files, e.g. individual_proxy_inbound")
+    parser.add_argument("counter", help="Counter column to score")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first N proxies")
+    parser.add_argument("--repeats", type=int, default=1)
+    args = parser.parse_args()
+
+    file_paths = sorted(list_proxy_paths(args.input_dir).values())[:args.limit]
+    if not file_paths:
+        print(f"Error: no proxy files found in {args.input_dir}")
+        sys.exit(1)
+    for key, value in benchmark(file_paths, args.counter, args.repeats).items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
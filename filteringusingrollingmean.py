@@ -1,34 +1,27 @@
 # file: filter_anomalies.py
-import pandas as pd
 import numpy as np
 import os
 
+from schema import read_result_csv
+from anomaly_store import ANOMALY_STORE_DIR, counter_dir, write_anomalies
+
 def rolling_zscore_filter(df, window=10, zscore_threshold=2.0):
     # No longer used
     return df
 
-def filter_anomalies(input_file, output_file, column_name=None):
-    df = pd.read_csv(input_file)
-    # Save filtered anomalies to a subfolder if not already in one
-    output_dir = os.path.dirname(output_file)
-    if not output_dir:
-        output_dir = "anomaly_excels"
-        os.makedirs(output_dir, exist_ok=True)
-        output_file = os.path.join(output_dir, output_file)
-    elif not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
+def filter_anomalies(input_file, output_file, column_name=None, start_date=None, end_date=None, store_dir=ANOMALY_STORE_DIR):
+    # With a counter the filtered anomalies go to the anomaly store, and its folder for them is returned
+    df = read_result_csv(input_file)
     # Only keep relevant columns, exclude rolling statistics
     filtered_df = df
     if column_name:
         columns_to_keep = ['Timestamp', 'ProxyId', column_name, 'day']
         columns_to_keep = [col for col in columns_to_keep if col in filtered_df.columns]
         filtered_df = filtered_df[columns_to_keep]
-        # Change output_file to proxyname_countername.csv format
-        base = os.path.splitext(os.path.basename(output_file))[0]
-        if "_" in base:
-            proxy_name = "_".join(base.split("_")[:-1])
-        else:
-            proxy_name = base
+        # The detection output is named proxyname_countername.csv
+        proxy_name = os.path.splitext(os.path.basename(input_file))[0]
+        if proxy_name.endswith(f"_{column_name}"):
+            proxy_name = proxy_name[:-len(column_name) - 1]
 
         # Determine direction from input_file or output_file path
         direction = ""
@@ -36,9 +29,18 @@ def filter_anomalies(input_file, output_file, column_name=None):
             direction = "inbound"
         elif "outbound" in input_file or "outbound" in output_file:
             direction = "outbound"
-        excel_dir = os.path.join("anomaly_excels", direction) if direction else "anomaly_excels"
-        os.makedirs(excel_dir, exist_ok=True)
-        output_file = os.path.join(excel_dir, f"{proxy_name}_{column_name}.csv")
+        write_anomalies({proxy_name: filtered_df}, direction, column_name, start_date, end_date, store_dir)
+        output_location = counter_dir(direction, column_name, store_dir)
+        print(f"Filtered anomalies of {proxy_name} stored in '{output_location}'")
+        return output_location
+    # Save filtered anomalies to a subfolder if not already in one
+    output_dir = os.path.dirname(output_file)
+    if not output_dir:
+        output_dir = "anomaly_excels"
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(output_dir, output_file)
+    elif not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
     filtered_df.to_csv(output_file, index=False)
     print(f"Filtered data saved to '{output_file}'")
     return output_file
\ No newline at end of file
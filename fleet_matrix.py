@@ -0,0 +1,287 @@
+import os
+import json
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from ag import add_calendar_features, detection_range
+from proxy_store import (
+    BINARY_TIMESTAMPS_FILE, MISSING_COLUMN, is_binary_path, list_proxy_paths, load_proxy_frame,
+    read_series_meta, to_epoch_minutes
+)
+from schema import COUNTER_DTYPE, parse_timestamps
+
+# One counter of every proxy in a folder as a proxies x minutes array, NaN where a proxy has no sample:
+#   <matrix_dir>/values.npy   float64, same precision as the binary series
+#   <matrix_dir>/meta.json    proxies, source paths, first minute, range and build time
+# Rows are memory-mapped from disk, so worker processes share one copy instead of each loading CSVs
+FLEET_MATRIX_DIR = "fleet_matrix"
+VALUES_FILE = "values.npy"
+META_FILE = "meta.json"
+# Matrices larger than this are built straight into a mapped file even when no folder was asked for
+MEMMAP_THRESHOLD_MB = 256
+# Same window as the month-end detector's rolling z-score; on a minute grid half of it must hold samples
+ROLLING_WINDOW = 200
+# Rows per block for the rolling and cross-proxy passes, bounding their temporary arrays
+ROWS_PER_BLOCK = 64
+MINUTES_PER_BLOCK = 24 * 60
+
+
+def default_matrix_dir(data_folder, counter):
+    return os.path.join(FLEET_MATRIX_DIR, os.path.basename(os.path.normpath(data_folder)), counter)
+
+
+def city_of(proxy):
+    # Same split as the proxy hierarchy in the dashboard: the last name part is the city
+    return proxy.split('_')[-1]
+
+
+def _newest_mtime(path):
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    return max((os.path.getmtime(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files), default=0.0)
+
+
+def _series_bounds(path):
+    """(first, last) epoch minute of a proxy series, from its index or metadata where possible"""
+    if is_binary_path(path):
+        timestamps = np.load(os.path.join(path, BINARY_TIMESTAMPS_FILE), mmap_mode="r")
+        return (int(timestamps[0]), int(timestamps[-1])) if len(timestamps) else None
+    meta = read_series_meta(path)
+    if meta.get("first_key") and meta.get("last_key"):
+        keys = pd.to_datetime(pd.Series([meta["first_key"], meta["last_key"]]), format="%Y%m%d%H%M")
+        first, last = to_epoch_minutes(keys)
+        return int(first), int(last)
+    timestamps = parse_timestamps(load_proxy_frame(path, columns=['Timestamp'])['Timestamp'], path).dropna()
+    if timestamps.empty:
+        return None
+    minutes = to_epoch_minutes(timestamps)
+    return int(minutes.min()), int(minutes.max())
+
+
+class FleetMatrix:
+    """A proxies x minutes array of one counter with the proxy names and the minute of column 0"""
+
+    def __init__(self, values, proxies, start_minute, counter, sources=None, path=None):
+        self.values = values
+        self.proxies = list(proxies)
+        self.start_minute = int(start_minute)
+        self.counter = counter
+        self.sources = list(sources) if sources is not None else [None] * len(self.proxies)
+        self.path = path
+        self._rows = {proxy: row for row, proxy in enumerate(self.proxies)}
+
+    @property
+    def timestamps(self):
+        minutes = np.arange(self.start_minute, self.start_minute + self.values.shape[1], dtype=np.int64)
+        return pd.DatetimeIndex(minutes.astype("datetime64[m]").astype("datetime64[ns]"))
+
+    def row(self, proxy):
+        return self._rows[proxy]
+
+    def columns_for(self, start=None, end=None):
+        """Column slice covering [start, end] (inclusive)"""
+        lo, hi = 0, self.values.shape[1]
+        if start is not None:
+            lo = int(np.clip(to_epoch_minutes(pd.Series([pd.Timestamp(start).ceil("min")]))[0] - self.start_minute, 0, hi))
+        if end is not None:
+            hi = int(np.clip(to_epoch_minutes(pd.Series([pd.Timestamp(end)]))[0] - self.start_minute + 1, lo, hi))
+        return slice(lo, hi)
+
+    def detection_frame(self, proxy, start_date=None, end_date=None, features=None):
+        """The frame ag.load_detection_frame builds for this proxy and counter, from its row
+
+        features optionally maps column names to arrays shaped like the matrix (see
+        rolling_features); their values at the proxy's samples are added as columns.
+        """
+        columns = self.columns_for(*detection_range(start_date, end_date))
+        values = np.asarray(self.values[self.row(proxy), columns])
+        present = np.flatnonzero(~np.isnan(values))
+        minutes = self.start_minute + columns.start + present
+        counts = values[present]
+        df = pd.DataFrame({
+            'Timestamp': pd.to_datetime(minutes.astype("datetime64[m]").astype("datetime64[ns]")),
+            'ProxyId': proxy,
+            # Whole counts load as the same nullable integers the CSV reader produces
+            self.counter: pd.array(counts).astype(COUNTER_DTYPE) if np.array_equal(counts, np.round(counts)) else counts
+        })
+        for name, array in (features or {}).items():
+            df[name] = np.asarray(array[self.row(proxy), columns])[present]
+        return add_calendar_features(df)
+
+
+def build_fleet_matrix(data_folder, counter, start=None, end=None, matrix_dir=None, proxies=None):
+    """Assemble one counter of every proxy in data_folder (or just proxies) into a FleetMatrix
+
+    Columns run from the earliest to the latest minute of any proxy, clipped to [start, end].
+    With matrix_dir, or when the array would exceed MEMMAP_THRESHOLD_MB, it is written to disk
+    and returned memory-mapped.
+    """
+    proxy_paths = list_proxy_paths(data_folder)
+    if proxies is not None:
+        proxy_paths = {proxy: proxy_paths[proxy] for proxy in proxies if proxy in proxy_paths}
+    names = sorted(proxy_paths)
+    start_minute = None if start is None else int(to_epoch_minutes(pd.Series([pd.Timestamp(start).ceil("min")]))[0])
+    end_minute = None if end is None else int(to_epoch_minutes(pd.Series([pd.Timestamp(end)]))[0])
+
+    # First pass only finds the time span, mostly from series metadata
+    bounds = [b for b in (_series_bounds(proxy_paths[name]) for name in names) if b is not None]
+    first = min((b[0] for b in bounds), default=0) if start_minute is None else start_minute
+    last = max((b[1] for b in bounds), default=first - 1) if end_minute is None else end_minute
+    shape = (len(names), max(last - first + 1, 0))
+
+    size_mb = shape[0] * shape[1] * 8 / (1024 * 1024)
+    if matrix_dir is None and size_mb > MEMMAP_THRESHOLD_MB:
+        matrix_dir = default_matrix_dir(data_folder, counter)
+    if matrix_dir:
+        os.makedirs(matrix_dir, exist_ok=True)
+        tmp_path = os.path.join(matrix_dir, f"{VALUES_FILE}.{os.getpid()}.tmp.npy")
+        values = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float64, shape=shape)
+        values[:] = np.nan
+    else:
+        values = np.full(shape, np.nan, dtype=np.float64)
+
+    range_start = None if start is None else pd.Timestamp(start)
+    range_end = None if end is None else pd.Timestamp(end)
+    for row, name in enumerate(names):
+        path = proxy_paths[name]
+        df = load_proxy_frame(path, columns=['Timestamp', counter, MISSING_COLUMN], start=range_start, end=range_end)
+        if counter not in df.columns or df.empty:
+            continue
+        timestamps = parse_timestamps(df['Timestamp'], path)
+        keep = timestamps.notna().to_numpy()
+        if MISSING_COLUMN in df.columns:
+            keep &= ~df[MISSING_COLUMN].astype(bool).to_numpy()
+        offsets = to_epoch_minutes(timestamps[keep]) - first
+        counts = pd.to_numeric(df[counter][keep], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        inside = (offsets >= 0) & (offsets < shape[1])
+        values[row, offsets[inside]] = counts[inside]
+
+    if not matrix_dir:
+        return FleetMatrix(values, names, first, counter, [proxy_paths[name] for name in names])
+    values.flush()
+    del values
+    os.replace(tmp_path, os.path.join(matrix_dir, VALUES_FILE))
+    meta = {
+        "counter": counter, "proxies": names, "sources": [proxy_paths[name] for name in names], "start_minute": first,
+        "start": None if start is None else str(start), "end": None if end is None else str(end), "built": max(
+            (_newest_mtime(path) for path in proxy_paths.values()), default=0.0
+        )
+    }
+    with open(os.path.join(matrix_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return load_fleet_matrix(matrix_dir)
+
+
+def load_fleet_matrix(matrix_dir):
+    """A saved FleetMatrix, memory-mapped read-only; None when there is none"""
+    meta_file = os.path.join(matrix_dir, META_FILE)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    values = np.load(os.path.join(matrix_dir, VALUES_FILE), mmap_mode="r")
+    return FleetMatrix(values, meta["proxies"], meta["start_minute"], meta["counter"], meta["sources"], matrix_dir)
+
+
+def fleet_matrix(data_folder, counter, start=None, end=None, matrix_dir=None):
+    """The saved matrix for this folder, counter and range if no source changed since, else a rebuilt one"""
+    matrix_dir = matrix_dir or default_matrix_dir(data_folder, counter)
+    meta_file = os.path.join(matrix_dir, META_FILE)
+    if os.path.exists(meta_file):
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        proxy_paths = list_proxy_paths(data_folder)
+        if (meta["start"] == (None if start is None else str(start)) and meta["end"] == (None if end is None else str(end))
+                and meta["sources"] == [proxy_paths[name] for name in sorted(proxy_paths)]
+                and all(_newest_mtime(path) <= meta["built"] for path in proxy_paths.values())):
+            return load_fleet_matrix(matrix_dir)
+    return build_fleet_matrix(data_folder, counter, start, end, matrix_dir)
+
+
+def rolling_features(values, window=ROLLING_WINDOW, min_periods=None, out_dir=None):
+    """Rolling mean, std and z-score of every row along the time axis, NaN samples skipped
+
+    Matches pandas rolling(window, min_periods).mean()/.std() per row, computed with cumulative
+    sums over blocks of rows. The z-score is 0 where it is undefined, like the month-end
+    detector's. With out_dir the float32 outputs are memory-mapped files there.
+    """
+    min_periods = window // 2 if min_periods is None else min_periods
+    names = ('rolling_mean', 'rolling_std', 'z_score')
+    if out_dir:
+        outputs = {name: np.lib.format.open_memmap(os.path.join(out_dir, f"{name}.npy"), mode="w+", dtype=np.float32,
+                                                   shape=values.shape) for name in names}
+    else:
+        outputs = {name: np.empty(values.shape, dtype=np.float32) for name in names}
+
+    def window_sums(array):
+        cumulative = np.cumsum(array, axis=1)
+        shifted = np.zeros_like(cumulative)
+        shifted[:, window:] = cumulative[:, :-window]
+        return cumulative - shifted
+
+    for lo in range(0, values.shape[0], ROWS_PER_BLOCK):
+        block = np.asarray(values[lo:lo + ROWS_PER_BLOCK], dtype=np.float64)
+        present = ~np.isnan(block)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            # Centred per row first, so the sums of squares don't cancel out for large counters
+            centre = np.nan_to_num(np.nanmean(block, axis=1, keepdims=True))
+        centred = np.where(present, block - centre, 0.0)
+        count = window_sums(present.astype(np.float64))
+        total = window_sums(centred)
+        squares = window_sums(centred * centred)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / count
+            variance = np.maximum(squares - total * mean, 0.0) / (count - 1)
+            std = np.sqrt(variance)
+            enough = count >= max(min_periods, 1)
+            mean = np.where(enough, mean + centre, np.nan)
+            std = np.where(enough & (count > 1), std, np.nan)
+            z_score = (block - mean) / std
+        outputs['rolling_mean'][lo:lo + ROWS_PER_BLOCK] = mean
+        outputs['rolling_std'][lo:lo + ROWS_PER_BLOCK] = std
+        outputs['z_score'][lo:lo + ROWS_PER_BLOCK] = np.nan_to_num(z_score, nan=0.0, posinf=0.0, neginf=0.0)
+    return outputs
+
+
+def fleet_median(values):
+    """Median over proxies for every minute, NaN where no proxy has a sample"""
+    median = np.full(values.shape[1], np.nan, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for lo in range(0, values.shape[1], MINUTES_PER_BLOCK):
+            median[lo:lo + MINUTES_PER_BLOCK] = np.nanmedian(values[:, lo:lo + MINUTES_PER_BLOCK], axis=0)
+    return median
+
+
+def group_totals(matrix, group_of=city_of):
+    """Per-minute sum of the counter over each group of proxies (cities by default), as a frame"""
+    groups = pd.Series([group_of(proxy) for proxy in matrix.proxies])
+    totals = {}
+    for group, rows in groups.groupby(groups).groups.items():
+        totals[group] = np.zeros(matrix.values.shape[1], dtype=np.float64)
+        for lo in range(0, len(rows), ROWS_PER_BLOCK):
+            totals[group] += np.nansum(matrix.values[np.asarray(rows[lo:lo + ROWS_PER_BLOCK])], axis=0)
+    return pd.DataFrame(totals, index=matrix.timestamps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the proxy x minute matrix of one counter")
+    parser.add_argument("data_folder", help="Per-proxy CSVs, partitioned dataset or binary series")
+    parser.add_argument("counter")
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    parser.add_argument("--matrix-dir")
+    args = parser.parse_args()
+
+    matrix = fleet_matrix(args.data_folder, args.counter, args.start, args.end, args.matrix_dir)
+    present = int(np.count_nonzero(~np.isnan(matrix.values)))
+    print(f"{len(matrix.proxies)} proxies x {matrix.values.shape[1]} minutes from {matrix.timestamps[0] if matrix.values.shape[1] else '-'}, "
+          f"{present} samples, saved in {matrix.path}")
+
+
+if __name__ == "__main__":
+    main()
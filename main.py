@@ -1,11 +1,16 @@
 import os
-import glob
 import multiprocessing
 import time
 from datetime import datetime
 
-from ag import detect_anomalies, filter_anomalies_df
-from summary import generate_proxy_summary
+from collections import defaultdict
+
+from ag import detect_anomalies, detect_anomalies_multi, filter_anomaly_columns
+from anomaly_store import ANOMALY_STORE_DIR, write_anomalies
+from result_transport import new_run_prefix, publish_frame, receive_frame, release_frames
+from summary import generate_store_summary
+from proxy_store import list_proxy_paths, proxy_name_from_path
+from unified_preprocess import get_input_dir
 
 def get_user_choices():
     while True:
@@ -13,8 +18,8 @@ def get_user_choices():
         if dir_choice in ("inbound", "outbound"):
             break
         print("Invalid input. Please enter 'inbound' or 'outbound'.")
+    input_dir = get_input_dir(dir_choice)
     if dir_choice == "inbound":
-        input_dir = "individual_proxy_inbound"
         output_dir_base = "anomaly_output_inbound"
         counter_map = {
             "2xx": "response2xxForwardedCounter",
@@ -22,7 +27,6 @@ def get_user_choices():
             "5xx": "response5xxForwardedCounter"
         }
     else:
-        input_dir = "individual_proxy_outbound"
         output_dir_base = "anomaly_output_outbound"
         counter_map = {
             "2xx": "response2xxReceivedCounter",
@@ -30,42 +34,56 @@ def get_user_choices():
             "5xx": "response5xxReceivedCounter"
         }
     while True:
-        counter_choice = input("Enter counter (2xx/4xx/5xx): ").strip().lower()
-        if counter_choice in counter_map:
+        counter_choice = input("Enter counter (2xx/4xx/5xx/all): ").strip().lower()
+        if counter_choice in counter_map or counter_choice == "all":
             break
-        print("Invalid input. Please enter '2xx', '4xx' or '5xx'.")
-    column_name = counter_map[counter_choice]
-    output_dir = f"{output_dir_base}_{counter_choice}"
+        print("Invalid input. Please enter '2xx', '4xx', '5xx' or 'all'.")
+    # "all" detects every counter from one load of each proxy file
+    counters = dict(counter_map) if counter_choice == "all" else {counter_choice: counter_map[counter_choice]}
     # Prompt for date range
     start_date_str = input("Enter start date (YYYY-MM-DD) or leave blank for earliest: ").strip()
     end_date_str = input("Enter end date (YYYY-MM-DD) or leave blank for latest: ").strip()
     start_date = datetime.strptime(start_date_str, "%Y-%m-%d") if start_date_str else None
     end_date = datetime.strptime(end_date_str, "%Y-%m-%d") if end_date_str else None
-    return input_dir, output_dir, column_name, counter_choice, start_date, end_date
+    return dir_choice, input_dir, output_dir_base, counters, start_date, end_date
 
+# Workers hand their filtered anomalies back through shared memory; the parent stores each counter in one write
 def process_file(args):
-    file_path, column_name, output_dir, plot_dir, start_date, end_date = args
+    file_path, column_name, plot_dir, start_date, end_date, frame_prefix = args
+    try:
+        print(f"Processing: {file_path}")
+        anomaly_df = detect_anomalies(file_path, column_name, plot_dir=plot_dir, start_date=start_date, end_date=end_date, plot_format="data")
+        print(f"Done: {file_path}")
+        return file_path, {column_name: publish_frame(filter_anomaly_columns(anomaly_df, column_name), frame_prefix)}
+    except Exception as e:
+        print(f"Failed processing {file_path}: {e}")
+        return None
+
+def process_file_multi(args):
+    file_path, counters, plot_dir, start_date, end_date, frame_prefix = args
     try:
         print(f"Processing: {file_path}")
-        anomaly_df = detect_anomalies(file_path, column_name, plot_dir, start_date, end_date)
-        base_name = os.path.basename(file_path).replace(".csv", "_anomalies_filtered.csv")
-        final_output = os.path.join(output_dir, base_name)
-        filter_anomalies_df(anomaly_df, final_output, column_name)
+        anomaly_dfs = detect_anomalies_multi(
+            file_path, list(counters.values()), plot_dir=plot_dir, start_date=start_date, end_date=end_date, plot_format="data"
+        )
         print(f"Done: {file_path}")
-        return final_output
+        return file_path, {
+            column_name: publish_frame(filter_anomaly_columns(anomaly_dfs[column_name], column_name), frame_prefix)
+            for column_name in counters.values()
+        }
     except Exception as e:
         print(f"Failed processing {file_path}: {e}")
         return None
 
 def main():
-    input_dir, output_dir, column_name, counter_choice, start_date, end_date = get_user_choices()
-    os.makedirs(output_dir, exist_ok=True)
-    all_files = glob.glob(os.path.join(input_dir, "*.csv"))
+    direction, input_dir, output_dir_base, counters, start_date, end_date = get_user_choices()
+    # Both modes plot to anomaly_plots_<direction>_<counter name>, as the dashboard does
+    plot_dir = output_dir_base.replace("anomaly_output", "anomaly_plots")
+    for column_name in counters.values():
+        os.makedirs(f"{plot_dir}_{column_name}", exist_ok=True)
+    all_files = list(list_proxy_paths(input_dir).values())
     print(f"Found {len(all_files)} files in {input_dir}.")
 
-    plot_dir = output_dir.replace("anomaly_output", "anomaly_plots")
-    os.makedirs(plot_dir, exist_ok=True)
-
     cpu_count = multiprocessing.cpu_count()
     try:
         user_input = input(f"Enter number of processes to use (1-{cpu_count}, default={cpu_count}): ")
@@ -80,22 +98,41 @@ def main():
     print(f"Using {num_processes} CPU cores for multiprocessing.")
 
     start_time = time.time()
-    # Pass date range to process_file
-    args_list = [(file_path, column_name, output_dir, plot_dir, start_date, end_date) for file_path in all_files]
+    frame_prefix = new_run_prefix()
+    if len(counters) == 1:
+        column_name = next(iter(counters.values()))
+        # Pass date range to process_file
+        args_list = [(file_path, column_name, plot_dir, start_date, end_date, frame_prefix) for file_path in all_files]
+        process_func = process_file
+    else:
+        # Each proxy file is loaded once for all counters
+        args_list = [(file_path, counters, plot_dir, start_date, end_date, frame_prefix) for file_path in all_files]
+        process_func = process_file_multi
 
-    with multiprocessing.Pool(num_processes) as pool:
-        results = pool.map(process_file, args_list)
+    frames = defaultdict(dict)
+    try:
+        with multiprocessing.Pool(num_processes) as pool:
+            results = pool.map(process_func, args_list)
 
-    successful = [r for r in results if r]
-    print(f"\nCompleted processing {len(successful)} files. Output stored in '{output_dir}'.")
+        successful = [r for r in results if r]
+        for file_path, handles in successful:
+            for column_name, handle in handles.items():
+                frames[column_name][proxy_name_from_path(file_path)] = receive_frame(handle)
+    finally:
+        # Blocks of an interrupted run are never received
+        release_frames(frame_prefix)
+    for column_name, proxy_frames in frames.items():
+        write_anomalies(proxy_frames, direction, column_name, start_date, end_date)
+    print(f"\nCompleted processing {len(successful)} files. Anomalies stored in '{ANOMALY_STORE_DIR}'.")
 
     # Run summary
-    summary_output_file = f"final_summary_{counter_choice}.csv"
     print("\nGenerating summary...")
-    generate_proxy_summary(output_dir, summary_output_file)
+    for counter_choice, column_name in counters.items():
+        generate_store_summary(direction, column_name, f"final_summary_{counter_choice}.csv")
 
     elapsed = time.time() - start_time
     print(f"Total execution time: {elapsed:.2f} seconds.")
+    print("Plots are kept as plot data; render HTML with: python plot_data.py <plot folder> <counter> [--top N]")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,7 @@
 from anomalyisowithmonthend import detect_anomalies
 from filteringusingrollingmean import filter_anomalies
+from proxy_store import list_proxy_paths
+from unified_preprocess import get_input_dir
 import os
 import time
 from collections import defaultdict
@@ -7,11 +9,7 @@ from collections import defaultdict
 start_time = time.time()
 
 def get_all_proxies(data_folder):
-    proxies = []
-    for fname in os.listdir(data_folder):
-        if fname.endswith('.csv'):
-            proxies.append(fname[:-4])
-    return proxies
+    return list(list_proxy_paths(data_folder).keys())
 
 def build_proxy_hierarchy(all_proxies):
     hierarchy = defaultdict(lambda: defaultdict(list))
@@ -55,11 +53,10 @@ def main():
     direction = ""
     while direction.lower() not in ["inbound", "outbound"]:
         direction = input("Select direction (inbound/outbound): ").strip().lower()
+    data_folder = get_input_dir(direction)
     if direction == "inbound":
-        data_folder = "individual_proxy_inbound"
         column_hint = "response4xxForwardedCounter"
     else:
-        data_folder = "individual_proxy_outbound"
         column_hint = "response4xxReceivedCounter"
 
     proxy_id = choose_proxy(data_folder)
@@ -73,7 +70,7 @@ def main():
 
     print(f"Starting pipeline for ProxyId: {proxy_id}, Column: {column_name}")
 
-    excel_file = os.path.join(data_folder, f"{proxy_id}.csv")
+    excel_file = list_proxy_paths(data_folder).get(proxy_id, os.path.join(data_folder, f"{proxy_id}.csv"))
     if not os.path.exists(excel_file):
         print(f"Data file for proxy '{proxy_id}' not found at {excel_file}")
         return
@@ -87,13 +84,14 @@ def main():
     step2_output = detect_anomalies(excel_file, column_name, plot_dir=plot_dir, start_date=start_date, end_date=end_date)
     print("Anomaly detection completed.")
     # Step 3: Filtering Anomalies
-    final_output = f"{proxy_id}_{column_name}_final_filtered.csv"
-    filter_anomalies(step2_output, final_output, column_name=column_name)
+    final_output = filter_anomalies(
+        step2_output, f"{proxy_id}_{column_name}_final_filtered.csv", column_name=column_name, start_date=start_date, end_date=end_date
+    )
     print("Anomaly filtering completed.")
 
     print("\nPipeline Complete.")
     print(f"Proxy Data File: {excel_file}")
-    print(f"Filtered Anomaly File: {final_output}")
+    print(f"Filtered Anomalies Stored In: {final_output}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,195 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import joblib
+import numpy as np
+
+from proxy_store import safe_proxy_name
+
+# Fitted IsolationForest models, one file per proxy, counter, segment, parameter set and training window:
+#   <store_dir>/<proxy>/<counter>/<segment>-<key>.joblib
+# The key hashes the model parameters and the training rows themselves, so a rerun over the
+# same data reuses the forest and any change to either fits a new one
+MODEL_STORE_DIR = "model_store"
+MODEL_SUFFIX = ".joblib"
+# Raw score_samples of the scored rows, float32, next to the model that produced them:
+#   <store_dir>/<proxy>/<counter>/<segment>-<key>-<rows key>.scores.npy
+SCORES_SUFFIX = ".scores.npy"
+# Least recently used models and scores are evicted once the store grows past this
+MODEL_STORE_BUDGET_MB = 512
+# Parameters that don't change the fitted trees are left out of the key. Contamination only
+# places the decision threshold, so changing it re-thresholds cached scores instead of refitting
+_UNKEYED_PARAMS = ("n_jobs", "verbose", "warm_start", "contamination")
+
+
+def _update_with_rows(digest, features):
+    if hasattr(features, "to_numpy"):
+        values = features.to_numpy(dtype=np.float64, na_value=np.nan)
+    else:
+        values = np.asarray(features, dtype=np.float64)
+    digest.update(str(values.shape).encode())
+    digest.update(np.ascontiguousarray(values).tobytes())
+
+
+def model_key(params, train_features):
+    digest = hashlib.sha256()
+    keyed = {name: value for name, value in params.items() if name not in _UNKEYED_PARAMS}
+    digest.update(json.dumps(keyed, sort_keys=True, default=str).encode())
+    _update_with_rows(digest, train_features)
+    return digest.hexdigest()[:32]
+
+
+def rows_key(features):
+    digest = hashlib.sha256()
+    _update_with_rows(digest, features)
+    return digest.hexdigest()[:16]
+
+
+def model_path(store_dir, proxy, counter, segment, key):
+    return os.path.join(store_dir, safe_proxy_name(proxy), counter, f"{segment}-{key}{MODEL_SUFFIX}")
+
+
+def scores_path(store_dir, proxy, counter, segment, key, features):
+    return os.path.join(store_dir, safe_proxy_name(proxy), counter, f"{segment}-{key}-{rows_key(features)}{SCORES_SUFFIX}")
+
+
+def load_model(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        model = joblib.load(path)
+    except Exception as e:
+        print(f"Ignoring unreadable cached model {path}: {e}")
+        return None
+    # The modification time doubles as last use for eviction
+    os.utime(path)
+    return model
+
+
+def save_model(path, model):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_scores(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        scores = np.load(path)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cached scores {path}: {e}")
+        return None
+    os.utime(path)
+    return scores
+
+
+def save_scores(path, scores):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, scores.astype(np.float32))
+    os.replace(tmp_path, path)
+
+
+def score_threshold(train_scores, contamination):
+    # Same rule IsolationForest uses for offset_: "auto" is fixed, otherwise the contamination quantile
+    if contamination == "auto":
+        return -0.5
+    return np.percentile(train_scores, 100.0 * contamination)
+
+
+def fit_or_load(model, train_features, proxy, counter, segment, store_dir=MODEL_STORE_DIR, budget_mb=MODEL_STORE_BUDGET_MB,
+                key=None):
+    """The cached forest for these parameters and training rows, else model fitted on them and stored"""
+    path = model_path(store_dir, proxy, counter, segment, key or model_key(model.get_params(), train_features))
+    cached = load_model(path)
+    if cached is not None:
+        return cached
+    model.fit(train_features)
+    save_model(path, model)
+    evict_models(store_dir, budget_mb)
+    return model
+
+
+def fit_predict_segment(model, features, proxy, counter, segment, store_dir=None, train_mask=None, return_scores=False):
+    """Labels (-1 anomaly, 1 normal) for one segment, or (labels, scores) with return_scores
+
+    Only rows in train_mask are fitted on (all rows when it is None or selects nothing); the
+    rest are scored only. With a store_dir the forest for the same training rows is reused and
+    the raw scores of these rows are kept, so a run differing only in contamination just
+    re-thresholds them. Scores are score_samples (lower is more anomalous).
+    """
+    use_all_rows = train_mask is None or not train_mask.any()
+    train_features = features if use_all_rows else features[train_mask]
+    if store_dir is not None:
+        params = model.get_params()
+        key = model_key(params, train_features)
+        path = scores_path(store_dir, proxy, counter, segment, key, features)
+        scores = load_scores(path)
+        if scores is None:
+            fitted = fit_or_load(model, train_features, proxy, counter, segment, store_dir, key=key)
+            scores = fitted.score_samples(features).astype(np.float32)
+            save_scores(path, scores)
+        threshold = score_threshold(scores if use_all_rows else scores[train_mask], params["contamination"])
+        labels = np.where(scores < threshold, -1, 1)
+        return (labels, scores) if return_scores else labels
+    if return_scores:
+        # Same rule as predict, on the float64 scores: below the fitted offset is an anomaly
+        fitted = model.fit(train_features)
+        raw_scores = fitted.score_samples(features)
+        return np.where(raw_scores - fitted.offset_ < 0, -1, 1), raw_scores.astype(np.float32)
+    if train_features is features:
+        return model.fit_predict(features)
+    return model.fit(train_features).predict(features)
+
+
+def list_models(store_dir=MODEL_STORE_DIR):
+    return glob.glob(os.path.join(store_dir, "*", "*", f"*{MODEL_SUFFIX}"))
+
+
+def list_store_files(store_dir=MODEL_STORE_DIR):
+    return list_models(store_dir) + glob.glob(os.path.join(store_dir, "*", "*", f"*{SCORES_SUFFIX}"))
+
+
+def store_size_mb(store_dir=MODEL_STORE_DIR):
+    return sum(os.path.getsize(path) for path in list_store_files(store_dir)) / (1024 * 1024)
+
+
+def evict_models(store_dir=MODEL_STORE_DIR, budget_mb=MODEL_STORE_BUDGET_MB):
+    """Remove least recently used models and scores until the store fits its budget; returns how many were removed"""
+    entries = []
+    for path in list_store_files(store_dir):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    budget = budget_mb * 1024 * 1024
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            # Another worker evicted it first
+            pass
+        total -= size
+    return removed
+
+
+def invalidate_models(store_dir=MODEL_STORE_DIR, proxy=None, counter=None):
+    """Drop cached models for one proxy, one counter (of one or all proxies) or everything"""
+    proxy_dirs = [os.path.join(store_dir, safe_proxy_name(proxy))] if proxy else glob.glob(os.path.join(store_dir, "*"))
+    targets = [os.path.join(d, counter) for d in proxy_dirs] if counter else proxy_dirs
+    removed = 0
+    for target in targets:
+        if os.path.isdir(target):
+            removed += len(glob.glob(os.path.join(target, "**", f"*{MODEL_SUFFIX}"), recursive=True))
+            shutil.rmtree(target, ignore_errors=True)
+    return removed
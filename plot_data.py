@@ -0,0 +1,158 @@
+import os
+import sys
+import glob
+import argparse
+
+import numpy as np
+import plotly.graph_objs as go
+
+# Batch runs keep each proxy's plot as data, <proxy>_<counter>_plot.npz next to where the HTML would
+# go: the series downsampled to MAX_PLOT_POINTS and the anomaly points. The figure is built when
+# someone opens the proxy; render_plot_file turns the data into the usual _plot.html.
+PLOT_FORMATS = ("html", "data")
+PLOT_SUFFIXES = {"html": "_plot.html", "data": "_plot.npz"}
+MAX_PLOT_POINTS = 10000
+# Modebar without box/lasso select, with scroll zoom
+PLOT_CONFIG = {"displayModeBar": True, "modeBarButtonsToRemove": ["select2d", "lasso2d"], "scrollZoom": True}
+
+
+def plot_file_path(plot_dir, proxy_name, column_name, plot_format="html"):
+    return os.path.join(plot_dir, f"{proxy_name}_{column_name}{PLOT_SUFFIXES[plot_format]}")
+
+
+def _times(values):
+    return values.to_numpy(dtype="datetime64[ns]")
+
+
+def _floats(values):
+    return values.astype("float64").to_numpy(na_value=np.nan)
+
+
+def plot_data(df_combined, anomaly_df, column_name, max_points=MAX_PLOT_POINTS):
+    """The arrays a proxy's anomaly plot is drawn from"""
+    if len(df_combined) > max_points:
+        plot_idx = np.linspace(0, len(df_combined) - 1, max_points, dtype=int)
+        plot_df = df_combined.iloc[plot_idx]
+    else:
+        plot_df = df_combined
+    data = {
+        "series_time": _times(plot_df['Timestamp']),
+        "series_value": _floats(plot_df[column_name]),
+        "anomaly_time": _times(anomaly_df['Timestamp']),
+        "anomaly_value": _floats(anomaly_df[column_name]),
+    }
+    if 'anomaly_score' in anomaly_df.columns:
+        data["anomaly_score"] = _floats(anomaly_df['anomaly_score']).astype(np.float32)
+    return data
+
+
+def save_plot_data(data, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Written under a temporary name (np.savez keeps the .npz suffix) and renamed into place
+    tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+    np.savez(tmp_path, **data)
+    os.replace(tmp_path, path)
+
+
+def load_plot_data(path):
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def anomaly_figure(data, column_name):
+    fig = go.Figure()
+    # Main time series (downsampled if needed)
+    fig.add_trace(go.Scatter(
+        x=data["series_time"],
+        y=data["series_value"],
+        mode='lines',
+        name=column_name,
+        line=dict(color='blue'),
+        hoverinfo='skip'
+    ))
+
+    # Anomalies: red dots and vertical lines to x-axis
+    if len(data["anomaly_time"]):
+        fig.add_trace(go.Scatter(
+            x=data["anomaly_time"],
+            y=data["anomaly_value"],
+            mode='markers',
+            name='Anomalies',
+            marker=dict(color='red', size=8, symbol='circle'),
+            hovertemplate="Timestamp: %{x}<br>Value: %{y}<extra></extra>"
+        ))
+        # All the vertical lines in one trace, broken by gaps, instead of a trace per anomaly
+        count = len(data["anomaly_time"])
+        line_x = np.empty(3 * count, dtype=object)
+        line_y = np.empty(3 * count, dtype=object)
+        line_x[0::3] = line_x[1::3] = np.datetime_as_string(data["anomaly_time"])
+        line_y[0::3] = 0
+        line_y[1::3] = data["anomaly_value"]
+        fig.add_trace(go.Scatter(
+            x=line_x,
+            y=line_y,
+            mode='lines',
+            line=dict(color='red', width=1, dash='dot'),
+            hoverinfo='skip',
+            showlegend=False,
+            connectgaps=False
+        ))
+
+    fig.update_layout(
+        showlegend=False,
+        margin=dict(l=40, r=20, t=40, b=40),
+        xaxis_title="Timestamp",
+        yaxis_title=column_name,
+        template="simple_white",
+        dragmode="zoom"
+    )
+    return fig
+
+
+def write_plot_html(fig, plot_file):
+    fig.write_html(plot_file, include_plotlyjs="cdn", config=PLOT_CONFIG)
+
+
+def render_plot_file(data_path, column_name):
+    """Write the HTML plot for a plot-data file next to it; returns the HTML path"""
+    plot_file = data_path[:-len(PLOT_SUFFIXES["data"])] + PLOT_SUFFIXES["html"]
+    write_plot_html(anomaly_figure(load_plot_data(data_path), column_name), plot_file)
+    return plot_file
+
+
+def prerender_plots(plot_dir, column_name, anomaly_counts, top_n):
+    """Render the HTML plots of the top_n proxies with the most anomalies ({proxy: count})"""
+    worst = sorted(anomaly_counts, key=lambda proxy: anomaly_counts[proxy], reverse=True)[:top_n]
+    rendered = []
+    for proxy in worst:
+        data_path = plot_file_path(plot_dir, proxy, column_name, "data")
+        if os.path.exists(data_path):
+            rendered.append(render_plot_file(data_path, column_name))
+    return rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render HTML anomaly plots from a batch run's plot data")
+    parser.add_argument("plot_dir", help="Folder of <proxy>_<counter>_plot.npz files, e.g. anomaly_plots_inbound_<counter>")
+    parser.add_argument("counter", help="Counter column the plots show")
+    parser.add_argument("--top", type=int, default=None, help="Only the N proxies with the most anomalies")
+    parser.add_argument("--proxy", action="append", default=None, help="Only this proxy (repeatable)")
+    args = parser.parse_args()
+
+    suffix = f"_{args.counter}{PLOT_SUFFIXES['data']}"
+    data_paths = glob.glob(os.path.join(args.plot_dir, f"*{suffix}"))
+    if not data_paths:
+        print(f"Error: no plot data for {args.counter} in {args.plot_dir}")
+        sys.exit(1)
+    counts = {}
+    for data_path in data_paths:
+        proxy = os.path.basename(data_path)[:-len(suffix)]
+        if args.proxy is None or proxy in args.proxy:
+            with np.load(data_path, allow_pickle=False) as data:
+                counts[proxy] = len(data["anomaly_time"])
+    rendered = prerender_plots(args.plot_dir, args.counter, counts, args.top or len(counts))
+    print(f"Rendered {len(rendered)} plots in {args.plot_dir}")
+
+
+if __name__ == "__main__":
+    main()
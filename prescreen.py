@@ -0,0 +1,227 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from model_store import fit_or_load
+
+# Candidate minutes: far from the recent rolling mean, or far from what is usual for that hour of day
+PRESCREEN_WINDOW = 200
+Z_THRESHOLD = 3.0
+MAD_THRESHOLD = 3.5
+# Besides those, the most deviating minutes are always kept: CANDIDATE_FACTOR times the share the
+# forest will flag (contamination), at least MIN_CANDIDATE_SHARE, ranked once by counter deviation
+# and once by distance from the centre of the forest's feature space (where calendar edges count)
+CANDIDATE_FACTOR = 20
+MIN_CANDIDATE_SHARE = 0.02
+# Neighbouring minutes kept with each candidate, so a short spike is scored with its edges
+CANDIDATE_PAD = 2
+# Share of the remaining minutes scored as background to place the decision threshold
+BACKGROUND_FRACTION = 0.05
+MIN_BACKGROUND = 512
+# Scales the median absolute deviation to a standard deviation for normal data
+MAD_SCALE = 1.4826
+
+
+def rolling_z(values, window=PRESCREEN_WINDOW, min_periods=None):
+    values = pd.Series(values, dtype=np.float64)
+    rolling = values.rolling(window, min_periods=min_periods)
+    z_score = (values - rolling.mean()) / rolling.std()
+    return z_score.replace([np.inf, -np.inf], np.nan).fillna(0).to_numpy()
+
+
+def robust_z(values, groups=None):
+    """Distance from the median in MADs, within each group (e.g. hour of day) when given"""
+    values = pd.Series(values, dtype=np.float64).reset_index(drop=True)
+    if groups is None:
+        groups = np.zeros(len(values), dtype=int)
+    grouped = values.groupby(np.asarray(groups))
+    median = grouped.transform("median")
+    mad = (values - median).abs().groupby(np.asarray(groups)).transform("median") * MAD_SCALE
+    z_score = (values - median) / mad.where(mad > 0)
+    # A group with no spread flags any value off its median
+    z_score = z_score.where(mad > 0, np.where(values != median, np.inf, 0.0))
+    return z_score.fillna(0).to_numpy()
+
+
+def feature_distance(features):
+    """Euclidean distance of each row from the column means, in column standard deviations"""
+    features = np.asarray(features, dtype=np.float64)
+    if not len(features):
+        return np.zeros(0)
+    std = features.std(axis=0)
+    standardized = (features - features.mean(axis=0)) / np.where(std > 0, std, 1.0)
+    return np.sqrt((standardized ** 2).sum(axis=1))
+
+
+def _top_share(deviation, share):
+    top = np.zeros(len(deviation), dtype=bool)
+    count = int(np.ceil(share * len(deviation)))
+    if count:
+        # Exactly count minutes, however many tie at the cut
+        top[np.argpartition(-deviation, count - 1)[:count]] = True
+    return top
+
+
+def candidate_mask(values, hours=None, z_score=None, contamination=None, features=None, window=PRESCREEN_WINDOW,
+                   z_threshold=Z_THRESHOLD, mad_threshold=MAD_THRESHOLD, pad=CANDIDATE_PAD):
+    """Minutes worth scoring with the forest, from vectorized statistics over the whole series
+
+    z_score can pass a rolling z-score the caller already computed (anomalyisowithmonthend does);
+    features are the forest's own feature columns, for the feature-space ranking.
+    """
+    if z_score is None:
+        z_score = rolling_z(values, window)
+    z_score = np.abs(np.asarray(z_score, dtype=np.float64))
+    hourly_z = np.abs(robust_z(values, hours))
+    candidates = (z_score >= z_threshold) | (hourly_z >= mad_threshold)
+    share = MIN_CANDIDATE_SHARE
+    if contamination is not None and contamination != "auto":
+        share = min(1.0, max(share, CANDIDATE_FACTOR * float(contamination)))
+    if pad and candidates.any():
+        candidates = np.convolve(candidates, np.ones(2 * pad + 1), mode="same") > 0
+    candidates |= _top_share(np.maximum(z_score, hourly_z), share)
+    if features is not None:
+        candidates |= _top_share(feature_distance(features), share)
+    return candidates
+
+
+def weighted_percentile(values, weights, q):
+    """np.percentile (linear) of values with each one repeated weight times"""
+    order = np.argsort(values, kind="stable")
+    values, cumulative = values[order], np.cumsum(weights[order])
+    position = (cumulative[-1] - 1) * q / 100.0
+    below = np.searchsorted(cumulative, np.floor(position), side="right")
+    above = np.searchsorted(cumulative, np.floor(position) + 1, side="right")
+    below, above = min(below, len(values) - 1), min(above, len(values) - 1)
+    return values[below] + (position - np.floor(position)) * (values[above] - values[below])
+
+
+def prescreen_predict_segment(model, features, candidates, proxy, counter, segment, store_dir=None, train_mask=None,
+                              background_fraction=BACKGROUND_FRACTION, min_background=MIN_BACKGROUND, random_state=42,
+                              return_scores=False):
+    """Labels (-1 anomaly, 1 normal) for one segment, scoring only candidates and a background sample
+
+    The forest is fitted exactly as model_store.fit_predict_segment fits it, so candidates get
+    the scores a full run would give them. The threshold is the contamination percentile of
+    the training rows' scores, estimated from the candidates plus the background sample
+    weighted up to the non-candidates it stands for. Minutes never scored are normal. With
+    return_scores, (labels, scores) where minutes never scored have a NaN score.
+    """
+    use_all_rows = train_mask is None or not train_mask.any()
+    train = np.ones(len(features), dtype=bool) if use_all_rows else np.asarray(train_mask, dtype=bool)
+    train_features = features if use_all_rows else features[train]
+    if store_dir is not None:
+        fitted = fit_or_load(model, train_features, proxy, counter, segment, store_dir)
+    else:
+        fitted = model.fit(train_features)
+
+    others = np.flatnonzero(~candidates)
+    sample_size = min(len(others), max(min_background, int(background_fraction * len(others))))
+    background = np.random.default_rng(random_state).choice(others, sample_size, replace=False)
+    scored = candidates.copy()
+    scored[background] = True
+    scored_rows = np.flatnonzero(scored)
+    labels = np.ones(len(features), dtype=int)
+    all_scores = np.full(len(features), np.nan, dtype=np.float32)
+    if not len(scored_rows):
+        return (labels, all_scores) if return_scores else labels
+    scores = fitted.score_samples(features.iloc[scored_rows] if hasattr(features, "iloc") else features[scored_rows])
+
+    contamination = fitted.get_params()["contamination"]
+    if contamination == "auto":
+        threshold = -0.5
+    else:
+        threshold = _estimate_threshold(scores, candidates[scored_rows], train[scored_rows], int(train.sum()),
+                                        int((train & ~candidates).sum()), contamination)
+    labels[scored_rows] = np.where(scores < threshold, -1, 1)
+    if return_scores:
+        all_scores[scored_rows] = scores
+        return labels, all_scores
+    return labels
+
+
+def _estimate_threshold(scores, is_candidate, in_train, train_rows, other_train_rows, contamination):
+    # When the lowest-scoring training rows are all candidates (no background row scores as low),
+    # the percentile is read straight off the candidates' order statistics, exactly as a full run
+    # would compute it; otherwise the background sample stands in for the unscored minutes
+    q = 100.0 * contamination
+    position = (train_rows - 1) * q / 100.0
+    candidate_scores = np.sort(scores[is_candidate & in_train])
+    background_scores = scores[~is_candidate & in_train]
+    upper = int(np.floor(position)) + 1
+    if upper < len(candidate_scores):
+        low, high = candidate_scores[upper - 1], candidate_scores[upper]
+        threshold = low + (position - np.floor(position)) * (high - low)
+        if not len(background_scores) or background_scores.min() >= high:
+            return threshold
+    weights = np.where(is_candidate, 1.0, other_train_rows / max(len(background_scores), 1))
+    return weighted_percentile(scores[in_train], weights[in_train], q)
+
+
+def recall_report(file_paths, column_name, **iso_params):
+    """Run ag's detection with and without the prescreen on each proxy and compare
+
+    Recall is the share of minutes the full run flags that the prescreened run flags too.
+    Returns one row per proxy plus a TOTAL row.
+    """
+    from ag import CALENDAR_FEATURES, load_detection_frame, score_counter
+
+    rows = []
+    for file_path in file_paths:
+        df = load_detection_frame(file_path, [column_name])
+        start = time.perf_counter()
+        full = score_counter(df, column_name, **iso_params)
+        full_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        screened = score_counter(df, column_name, prescreen=True, **iso_params)
+        screened_seconds = time.perf_counter() - start
+        both = int((full['is_anomaly'] & screened['is_anomaly']).sum())
+        rows.append({
+            "proxy": os.path.basename(os.path.normpath(file_path)),
+            "rows": len(df),
+            "candidate_share": round(float(candidate_mask(
+                df[column_name], df['hour'], contamination=iso_params.get("contamination", 0.0075),
+                features=df[[column_name, *CALENDAR_FEATURES]]
+            ).mean()), 4) if len(df) else 0.0,
+            "flagged_full": int(full['is_anomaly'].sum()),
+            "flagged_prescreen": int(screened['is_anomaly'].sum()),
+            "flagged_both": both,
+            "full_seconds": round(full_seconds, 3),
+            "prescreen_seconds": round(screened_seconds, 3),
+        })
+    report = pd.DataFrame(rows)
+    if report.empty:
+        return report
+    total = report.sum(numeric_only=True)
+    total["candidate_share"] = round(float((report["candidate_share"] * report["rows"]).sum() / max(total["rows"], 1)), 4)
+    report = pd.concat([report, pd.DataFrame([{"proxy": "TOTAL", **total.to_dict()}])], ignore_index=True)
+    report["recall"] = (report["flagged_both"] / report["flagged_full"].where(report["flagged_full"] > 0)).round(4).fillna(1.0)
+    return report
+
+
+def main():
+    from proxy_store import list_proxy_paths
+
+    parser = argparse.ArgumentParser(description="Recall and speed of prescreened detection against full runs")
+    parser.add_argument("input_dir", help="Folder of per-proxy files, e.g. individual_proxy_inbound")
+    parser.add_argument("counter", help="Counter column to score")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first N proxies")
+    parser.add_argument("--output", default=None, help="Also save the report as CSV")
+    args = parser.parse_args()
+
+    file_paths = sorted(list_proxy_paths(args.input_dir).values())[:args.limit]
+    if not file_paths:
+        print(f"Error: no proxy files found in {args.input_dir}")
+        sys.exit(1)
+    report = recall_report(file_paths, args.counter)
+    print(report.to_string(index=False))
+    if args.output:
+        report.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
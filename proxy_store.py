@@ -0,0 +1,350 @@
+import io
+import os
+import glob
+import json
+import bisect
+import numpy as np
+import pandas as pd
+
+from schema import COLUMN_DTYPES, TIMESTAMP_FORMAT
+
+# Layout of the partitioned per-proxy dataset:
+#   <dataset_folder>/ProxyId=<proxy>/date=<day>/part-0.parquet
+PROXY_PARTITION_PREFIX = "ProxyId="
+DATE_PARTITION_PREFIX = "date="
+PARTITION_FILE_PATTERN = "part-*.parquet"
+
+# Layout of the memory-mappable binary per-proxy series:
+#   <binary_folder>/<proxy>/timestamps.npy   int64 minutes since the epoch, sorted
+#   <binary_folder>/<proxy>/<counter>.npy    float64 per counter, NaN where missing
+#   <binary_folder>/<proxy>/meta.json        proxy id, counters, row count
+BINARY_TIMESTAMPS_FILE = "timestamps.npy"
+BINARY_META_FILE = "meta.json"
+
+# Dense minute grid: one row per minute between a proxy's first and last sample, gaps filled
+# with empty counters and is_missing set, so a minute's row is at offset (minute - first minute)
+MISSING_COLUMN = "is_missing"
+BINARY_MISSING_FILE = "is_missing.npy"
+# How several rows for the same minute are resolved
+DUPLICATE_POLICIES = ("last", "first", "max", "mean")
+
+# Merged per-proxy CSVs carry a sidecar <proxy>.csv.meta.json ({"sorted": true, ...}), including
+# day_offsets ({YYYYmmdd: byte offset of the day's first row}) so a date range is read by seeking
+SERIES_META_SUFFIX = ".meta.json"
+
+
+def safe_proxy_name(proxy_id):
+    return str(proxy_id).replace("/", "_").replace("\\", "_")
+
+
+def proxy_partition_dir(dataset_folder, proxy_id):
+    return os.path.join(dataset_folder, f"{PROXY_PARTITION_PREFIX}{safe_proxy_name(proxy_id)}")
+
+
+def is_partition_path(path):
+    return os.path.isdir(path) and os.path.basename(os.path.normpath(path)).startswith(PROXY_PARTITION_PREFIX)
+
+
+def is_binary_path(path):
+    return os.path.isfile(os.path.join(path, BINARY_TIMESTAMPS_FILE))
+
+
+def proxy_name_from_path(path):
+    """Proxy name for a per-proxy CSV file, dataset partition or binary series"""
+    base = os.path.basename(os.path.normpath(path))
+    if base.startswith(PROXY_PARTITION_PREFIX):
+        return base[len(PROXY_PARTITION_PREFIX):]
+    return os.path.splitext(base)[0]
+
+
+def timestamp_sort_key(text):
+    """Sortable key for a timestamp as written in per-proxy CSVs (%d-%m-%Y-%H-%M, else as-is)"""
+    if len(text) == 16 and text[2] == "-" and text[5] == "-":
+        return text[6:10] + text[3:5] + text[0:2] + text[11:13] + text[14:16]
+    return text
+
+
+def sort_by_timestamp(df):
+    keys = df["Timestamp"].astype(str).map(timestamp_sort_key).to_numpy()
+    return df.iloc[np.argsort(keys, kind="stable")]
+
+
+def densify_minute_grid(df, counters, duplicates="last"):
+    """Reindex one proxy's rows onto every minute from its first to its last sample
+
+    Timestamps become datetimes floored to the minute, same-minute rows are resolved by
+    the duplicates policy, and an is_missing column marks the minutes that were filled in.
+    """
+    if duplicates not in DUPLICATE_POLICIES:
+        raise ValueError(f"unknown duplicate policy '{duplicates}'")
+    timestamps = df["Timestamp"]
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps, format=TIMESTAMP_FORMAT, errors="coerce")
+    counters = [col for col in counters if col in df.columns]
+    frame = df[counters].apply(pd.to_numeric, errors="coerce").astype(np.float64)
+    frame.index = pd.DatetimeIndex(timestamps.dt.floor("min"))
+    # Rows a dense source already marked missing carry no data; the reindex below refills them
+    keep = frame.index.notna()
+    if MISSING_COLUMN in df.columns:
+        keep &= ~df[MISSING_COLUMN].astype(bool).to_numpy()
+    frame = frame[keep].sort_index(kind="stable")
+
+    grouped = frame.groupby(level=0, sort=True)
+    if duplicates == "last":
+        resolved = grouped.nth(-1)
+    elif duplicates == "first":
+        resolved = grouped.nth(0)
+    else:
+        resolved = grouped.agg(duplicates)
+    resolved = resolved.assign(**{MISSING_COLUMN: False})
+
+    if resolved.empty:
+        grid = pd.DatetimeIndex([], name="Timestamp")
+    else:
+        grid = pd.date_range(resolved.index.min(), resolved.index.max(), freq="min", name="Timestamp")
+    dense = resolved.reindex(grid)
+    dense[MISSING_COLUMN] = dense[MISSING_COLUMN].fillna(True).astype(bool)
+    dense = dense.reset_index()
+    if "ProxyId" in df.columns and len(df):
+        dense.insert(1, "ProxyId", df["ProxyId"].iloc[0])
+    return dense
+
+
+def write_series_meta(path, meta):
+    # The file size is recorded so a sidecar left behind by a later rewrite is ignored
+    meta = dict(meta, size=os.path.getsize(path))
+    with open(f"{path}{SERIES_META_SUFFIX}", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def read_series_meta(path):
+    if is_binary_path(path):
+        meta_file = os.path.join(path, BINARY_META_FILE)
+    else:
+        meta_file = f"{path}{SERIES_META_SUFFIX}"
+    if not os.path.exists(meta_file):
+        return {}
+    with open(meta_file, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if "size" in meta and (not os.path.isfile(path) or os.path.getsize(path) != meta["size"]):
+        return {}
+    return meta
+
+
+def is_sorted_series(path):
+    return bool(read_series_meta(path).get("sorted"))
+
+
+def clear_day_partitions(dataset_folder, day_name):
+    """Remove every proxy's part files for one day so a rerun replaces it"""
+    pattern = os.path.join(dataset_folder, f"{PROXY_PARTITION_PREFIX}*", f"{DATE_PARTITION_PREFIX}{day_name}", PARTITION_FILE_PATTERN)
+    for part_file in glob.glob(pattern):
+        os.remove(part_file)
+
+
+def write_day_partitions(df, dataset_folder, day_name, part=0, compression="zstd"):
+    """Write one raw day (or one chunk of it) straight into the proxy/date partitions of the dataset"""
+    if not pd.api.types.is_datetime64_any_dtype(df["Timestamp"]):
+        df["Timestamp"] = pd.to_datetime(df["Timestamp"], format=TIMESTAMP_FORMAT, errors="coerce")
+
+    for proxy_id, group_df in df.groupby("ProxyId", observed=True):
+        partition_dir = os.path.join(proxy_partition_dir(dataset_folder, proxy_id), f"{DATE_PARTITION_PREFIX}{day_name}")
+        os.makedirs(partition_dir, exist_ok=True)
+        # ProxyId is carried by the partition directory, not stored in the file
+        group_df.drop(columns=["ProxyId"]).to_parquet(
+            os.path.join(partition_dir, f"part-{part}.parquet"), index=False, compression=compression
+        )
+
+
+def _partition_sort_key(part_file):
+    # Days in directory order, chunks of a day in the order they were written
+    part_name = os.path.basename(part_file)
+    return os.path.dirname(part_file), int(part_name[len("part-"):-len(".parquet")])
+
+
+def to_epoch_minutes(timestamps):
+    return timestamps.to_numpy(dtype="datetime64[ns]").astype("datetime64[m]").astype(np.int64)
+
+
+def _save_array(path, array):
+    # Write then rename so readers mapping the old file never see a partial one
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def write_binary_series(df, binary_folder, proxy_id, counters, dense=False, duplicates="last"):
+    """Write one proxy's history as sorted epoch-minute timestamps plus one float64 array per counter
+
+    With dense=True the series is first reindexed onto its minute grid and an is_missing
+    array is written alongside, so readers locate any minute by offset.
+    """
+    if dense:
+        df = densify_minute_grid(df, counters, duplicates)
+    elif MISSING_COLUMN in df.columns:
+        df = df[~df[MISSING_COLUMN].astype(bool)]
+    timestamps = df["Timestamp"]
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps, format=TIMESTAMP_FORMAT, errors="coerce")
+    valid = timestamps.notna().to_numpy()
+    minutes = to_epoch_minutes(timestamps[valid])
+    order = np.argsort(minutes, kind="stable")
+
+    proxy_dir = os.path.join(binary_folder, safe_proxy_name(proxy_id))
+    os.makedirs(proxy_dir, exist_ok=True)
+    _save_array(os.path.join(proxy_dir, BINARY_TIMESTAMPS_FILE), minutes[order])
+    missing_file = os.path.join(proxy_dir, BINARY_MISSING_FILE)
+    if dense:
+        _save_array(missing_file, df[MISSING_COLUMN].to_numpy(dtype=bool)[valid][order])
+    elif os.path.exists(missing_file):
+        os.remove(missing_file)
+    written_counters = []
+    for counter in counters:
+        if counter not in df.columns:
+            continue
+        values = pd.to_numeric(df[counter], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        _save_array(os.path.join(proxy_dir, f"{counter}.npy"), values[valid][order])
+        written_counters.append(counter)
+
+    meta = {"proxy_id": str(proxy_id), "counters": written_counters, "rows": int(len(order)), "sorted": True, "dense": dense}
+    if dense:
+        meta["duplicate_policy"] = duplicates
+        if len(order):
+            meta["start_minute"] = int(minutes[order][0])
+    with open(os.path.join(proxy_dir, BINARY_META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def load_binary_series(path, columns=None, start=None, end=None):
+    """Memory-map a binary proxy series and slice it to [start, end] without copying
+
+    Returns (timestamps, arrays, meta): epoch-minute timestamps and a dict of counter
+    arrays (plus is_missing for dense series), all read-only views into the mapped files.
+    """
+    with open(os.path.join(path, BINARY_META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    timestamps = np.load(os.path.join(path, BINARY_TIMESTAMPS_FILE), mmap_mode="r")
+
+    lo, hi = 0, len(timestamps)
+    dense = meta.get("dense") and "start_minute" in meta
+    if start is not None:
+        start_minute = to_epoch_minutes(pd.Series([pd.Timestamp(start).ceil("min")]))[0]
+        if dense:
+            lo = int(min(max(start_minute - meta["start_minute"], 0), len(timestamps)))
+        else:
+            lo = int(np.searchsorted(timestamps, start_minute, side="left"))
+    if end is not None:
+        end_minute = to_epoch_minutes(pd.Series([pd.Timestamp(end)]))[0]
+        if dense:
+            hi = int(min(max(end_minute - meta["start_minute"] + 1, 0), len(timestamps)))
+        else:
+            hi = int(np.searchsorted(timestamps, end_minute, side="right"))
+    hi = max(hi, lo)
+
+    counters = meta["counters"] if columns is None else [col for col in columns if col in meta["counters"]]
+    arrays = {
+        counter: np.load(os.path.join(path, f"{counter}.npy"), mmap_mode="r")[lo:hi]
+        for counter in counters
+    }
+    if meta.get("dense") and (columns is None or MISSING_COLUMN in columns):
+        arrays[MISSING_COLUMN] = np.load(os.path.join(path, BINARY_MISSING_FILE), mmap_mode="r")[lo:hi]
+    return timestamps[lo:hi], arrays, meta
+
+
+def list_proxy_paths(data_folder):
+    """Map proxy name -> per-proxy CSV file, dataset partition or binary series in data_folder"""
+    proxy_paths = {}
+    if not os.path.isdir(data_folder):
+        return proxy_paths
+    for fname in os.listdir(data_folder):
+        full_path = os.path.join(data_folder, fname)
+        if fname.endswith('.csv') or is_partition_path(full_path) or is_binary_path(full_path):
+            proxy_paths[proxy_name_from_path(full_path)] = full_path
+    return proxy_paths
+
+
+def _minute_offset(first, moment):
+    return int((moment - first) // pd.Timedelta(minutes=1))
+
+
+def day_byte_range(meta, start=None, end=None, file_size=None):
+    """(first byte, end byte, first day) of the whole days of a merged CSV covering [start, end]"""
+    offsets = meta["day_offsets"]
+    days = sorted(offsets)
+    first = 0 if start is None else bisect.bisect_left(days, pd.Timestamp(start).strftime("%Y%m%d"))
+    after = len(days) if end is None else bisect.bisect_right(days, pd.Timestamp(end).strftime("%Y%m%d"))
+    if first >= len(days) or first >= after:
+        return 0, 0, None
+    hi = offsets[days[after]] if after < len(days) else file_size
+    return offsets[days[first]], hi, days[first]
+
+
+def _read_csv_range(path, meta, usecols, start, end):
+    # Header plus only the bytes of the requested days, parsed as one small CSV
+    lo, hi, first_day = day_byte_range(meta, start, end, os.path.getsize(path))
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(lo)
+        body = f.read(max(hi - lo, 0))
+    skiprows, nrows = None, None
+    if meta.get("dense") and first_day is not None:
+        # One row per minute from the first day's first row on: trim to the exact minutes
+        first = max(pd.to_datetime(meta["first_key"], format="%Y%m%d%H%M"), pd.Timestamp(first_day))
+        lo_row = 0 if start is None else max(_minute_offset(first, pd.Timestamp(start).ceil("min")), 0)
+        skiprows = range(1, lo_row + 1)
+        nrows = None if end is None else max(_minute_offset(first, pd.Timestamp(end)) + 1 - lo_row, 0)
+    return pd.read_csv(io.BytesIO(header + body), usecols=usecols, dtype=COLUMN_DTYPES, skiprows=skiprows, nrows=nrows)
+
+
+def load_proxy_frame(path, columns=None, start=None, end=None):
+    """Load a proxy series from a per-proxy CSV file, a dataset partition or a binary series
+
+    start/end (inclusive) are pushed down: binary series and dense-grid CSVs are sliced to
+    the exact minutes, merged CSVs with a day index are read only for the days covering the
+    range, and parquet partitions skip row groups outside it. Anything else is returned whole,
+    so callers still filter to the exact range.
+    """
+    if is_binary_path(path):
+        timestamps, arrays, meta = load_binary_series(path, columns, start, end)
+        data = {"Timestamp": pd.to_datetime(timestamps.view("datetime64[m]"))}
+        if columns is None or "ProxyId" in columns:
+            data["ProxyId"] = meta["proxy_id"]
+        data.update(arrays)
+        return pd.DataFrame(data)
+
+    if not is_partition_path(path):
+        # Requested columns missing from the file are skipped rather than raising; known
+        # counters load as Int32 and ProxyId as a category instead of int64/object
+        usecols = None if columns is None else (lambda col: col in columns)
+        meta = read_series_meta(path)
+        if meta.get("day_offsets") and (start is not None or end is not None):
+            return _read_csv_range(path, meta, usecols, start, end)
+        if meta.get("dense") and meta.get("first_key") and (start is not None or end is not None):
+            # One row per minute: the range maps straight to a row offset and count
+            first = pd.to_datetime(meta["first_key"], format="%Y%m%d%H%M")
+            lo = 0 if start is None else max(_minute_offset(first, pd.Timestamp(start).ceil("min")), 0)
+            nrows = None if end is None else max(_minute_offset(first, pd.Timestamp(end)) + 1 - lo, 0)
+            return pd.read_csv(path, usecols=usecols, dtype=COLUMN_DTYPES, skiprows=range(1, lo + 1), nrows=nrows)
+        return pd.read_csv(path, usecols=usecols, dtype=COLUMN_DTYPES)
+
+    partition_files = sorted(
+        glob.glob(os.path.join(path, f"{DATE_PARTITION_PREFIX}*", PARTITION_FILE_PATTERN)), key=_partition_sort_key
+    )
+    read_columns = None
+    if columns is not None and partition_files:
+        import pyarrow.parquet as pq
+        stored_columns = pq.read_schema(partition_files[0]).names
+        read_columns = [col for col in columns if col in stored_columns]
+    # Row-group timestamp statistics let parquet skip days outside the range without decoding them
+    filters = []
+    if start is not None:
+        filters.append(("Timestamp", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("Timestamp", "<=", pd.Timestamp(end)))
+    frames = [pd.read_parquet(f, columns=read_columns, filters=filters or None) for f in partition_files]
+    if not frames:
+        return pd.DataFrame(columns=columns or ["Timestamp", "ProxyId"])
+    df = pd.concat(frames, ignore_index=True)
+    if columns is None or "ProxyId" in columns:
+        df.insert(1, "ProxyId", proxy_name_from_path(path))
+    return df
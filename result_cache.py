@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import shutil
+import hashlib
+import functools
+
+# Finished detection runs, one folder per input fingerprint, counter, date range, parameters and code version:
+#   <cache_dir>/<key>/result.pkl       the run's return value (anomaly frame, output path, ...)
+#   <cache_dir>/<key>/manifest.json    {"artifacts": {stored name: path the run wrote it to}}
+#   <cache_dir>/<key>/<n>-<name>       copies of the files the run wrote (plot, output CSV)
+RESULT_CACHE_DIR = "result_cache"
+RESULT_FILE = "result.pkl"
+MANIFEST_FILE = "manifest.json"
+# Least recently used results are evicted once the cache grows past this
+RESULT_CACHE_BUDGET_MB = 1024
+# Detection code whose changes must invalidate every cached result
+CODE_FILES = (
+    "ag.py", "anomalyisowithmonthend.py", "batched_iforest.py", "fleet_matrix.py", "model_store.py", "plot_data.py", "prescreen.py",
+    "proxy_store.py", "schema.py", "seasonal_baseline.py"
+)
+# Parameters that don't change results are left out of the key
+_UNKEYED_PARAMS = ("n_jobs", "verbose", "model_store_dir")
+
+
+@functools.lru_cache(maxsize=1)
+def code_version():
+    digest = hashlib.sha256()
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        path = os.path.join(code_dir, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(name.encode())
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def input_fingerprint(path):
+    """(relative path, size, mtime) of the input file, or of every file under a dataset/binary folder"""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+    else:
+        files = [path]
+    fingerprint = []
+    for file in files:
+        stat = os.stat(file)
+        fingerprint.append((os.path.relpath(file, path) if file != path else os.path.basename(file), stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+
+def baseline_fingerprint(baseline_dir, file_path):
+    """(size, mtime) of the proxy's seasonal baseline, or None when it has none"""
+    from seasonal_baseline import baseline_path
+    from proxy_store import proxy_name_from_path
+
+    path = baseline_path(baseline_dir, proxy_name_from_path(file_path))
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def result_key(file_path, counters, start_date=None, end_date=None, params=None, engine="ag"):
+    keyed = {name: value for name, value in (params or {}).items() if name not in _UNKEYED_PARAMS}
+    # A rebuilt or updated baseline changes the seasonal_residual feature
+    if keyed.get("baseline_dir"):
+        keyed["baseline_fingerprint"] = baseline_fingerprint(keyed["baseline_dir"], file_path)
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "input": os.path.abspath(file_path),
+        "fingerprint": input_fingerprint(file_path),
+        "counters": [counters] if isinstance(counters, str) else list(counters),
+        "range": [start_date, end_date],
+        "params": keyed,
+        "engine": engine,
+        "code": code_version(),
+    }, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:32]
+
+
+def entry_path(key, cache_dir=RESULT_CACHE_DIR):
+    return os.path.join(cache_dir, key)
+
+
+def _copy_atomic(source, target):
+    target_dir = os.path.dirname(target)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    tmp_target = f"{target}.{os.getpid()}.tmp"
+    shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
+
+
+def load_result(key, cache_dir=RESULT_CACHE_DIR):
+    """(True, value) for a cached run, with its files copied back where the run wrote them; else (False, None)"""
+    entry = entry_path(key, cache_dir)
+    if not os.path.isdir(entry):
+        return False, None
+    try:
+        with open(os.path.join(entry, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        with open(os.path.join(entry, RESULT_FILE), "rb") as f:
+            value = pickle.load(f)
+        for stored_name, target in manifest["artifacts"].items():
+            _copy_atomic(os.path.join(entry, stored_name), target)
+    except Exception as e:
+        # Evicted by another worker mid-read, or left over from an incompatible version
+        print(f"Ignoring unreadable cached result {entry}: {e}")
+        return False, None
+    # The modification time doubles as last use for eviction
+    os.utime(os.path.join(entry, RESULT_FILE))
+    return True, value
+
+
+def save_result(key, value, artifacts=(), cache_dir=RESULT_CACHE_DIR, budget_mb=RESULT_CACHE_BUDGET_MB):
+    """Store a run's return value and copies of the files it wrote under key
+
+    The entry is assembled in a private folder and renamed into place, so concurrent workers
+    never see a partial entry; when two finish the same key, the first one wins.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_entry = os.path.join(cache_dir, f".{key}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    os.makedirs(tmp_entry)
+    try:
+        stored = {}
+        for i, artifact in enumerate(artifacts):
+            if os.path.exists(artifact):
+                stored_name = f"{i}-{os.path.basename(artifact)}"
+                shutil.copyfile(artifact, os.path.join(tmp_entry, stored_name))
+                stored[stored_name] = artifact
+        with open(os.path.join(tmp_entry, RESULT_FILE), "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp_entry, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump({"artifacts": stored, "created": time.time()}, f)
+        os.rename(tmp_entry, entry_path(key, cache_dir))
+    except OSError:
+        # Another worker stored the same key first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict_results(cache_dir, budget_mb)
+
+
+def cached_run(key, compute, artifacts=(), cache_dir=RESULT_CACHE_DIR, budget_mb=RESULT_CACHE_BUDGET_MB):
+    """compute() for key, returned from the cache when the same run has been done before
+
+    artifacts are the files compute writes (plot, output CSV), or a function of its result
+    returning them; they are stored with the result and copied back to the same paths on a
+    hit. Without a cache_dir compute just runs.
+    """
+    if cache_dir is None:
+        return compute()
+    hit, value = load_result(key, cache_dir)
+    if hit:
+        return value
+    value = compute()
+    save_result(key, value, artifacts(value) if callable(artifacts) else artifacts, cache_dir, budget_mb)
+    return value
+
+
+def list_results(cache_dir=RESULT_CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        return []
+    return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if not name.startswith(".")]
+
+
+def _entry_usage(entry):
+    # (last use, size in bytes); None when the entry vanished meanwhile
+    try:
+        last_used = os.stat(os.path.join(entry, RESULT_FILE)).st_mtime
+        size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+    except OSError:
+        return None
+    return last_used, size
+
+
+def cache_size_mb(cache_dir=RESULT_CACHE_DIR):
+    return sum(usage[1] for usage in map(_entry_usage, list_results(cache_dir)) if usage) / (1024 * 1024)
+
+
+def evict_results(cache_dir=RESULT_CACHE_DIR, budget_mb=RESULT_CACHE_BUDGET_MB):
+    """Remove least recently used results until the cache fits its budget; returns how many were removed"""
+    entries = []
+    for entry in list_results(cache_dir):
+        usage = _entry_usage(entry)
+        if usage:
+            entries.append((*usage, entry))
+    total = sum(size for _, size, _ in entries)
+    budget = budget_mb * 1024 * 1024
+    removed = 0
+    for _, size, entry in sorted(entries):
+        if total <= budget:
+            break
+        # Renamed away first so readers never see a half-deleted entry
+        doomed = os.path.join(cache_dir, f".{os.path.basename(entry)}.{os.getpid()}.evicted")
+        try:
+            os.rename(entry, doomed)
+        except OSError:
+            # Another worker evicted it first
+            continue
+        shutil.rmtree(doomed, ignore_errors=True)
+        removed += 1
+        total -= size
+    return removed
+
+
+def clear_results(cache_dir=RESULT_CACHE_DIR):
+    removed = len(list_results(cache_dir))
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return removed
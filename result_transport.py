@@ -0,0 +1,120 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import pyarrow as pa
+
+# Result frames travel from pool workers to the dashboard as Arrow IPC streams in shared memory:
+# the worker writes the stream into a new block and returns only ("shm", name, size), the parent
+# copies it out, unlinks the block and rebuilds the frame. Nothing is pickled but that handle.
+# Windows frees a block once its creator closes it, so there the stream bytes are returned instead.
+USE_SHARED_MEMORY = os.name != "nt"
+# Blocks of one run share a name prefix, so the ones never received can be found and freed afterwards
+SHM_PREFIX = "jpl"
+SHM_DIR = "/dev/shm"
+
+
+def new_run_prefix():
+    """Name prefix for the frame blocks of one run; pass it to publish_frame and release_frames"""
+    return f"{SHM_PREFIX}{uuid.uuid4().hex[:8]}_"
+
+
+def _to_ipc(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def publish_frame(df, prefix=None):
+    """Handle for df that receive_frame in another process turns back into the frame"""
+    buffer = _to_ipc(df)
+    if not USE_SHARED_MEMORY:
+        return ("bytes", buffer.to_pybytes())
+    try:
+        name = f"{prefix}{uuid.uuid4().hex[:12]}" if prefix else None
+        block = shared_memory.SharedMemory(name=name, create=True, size=max(buffer.size, 1))
+    except OSError as e:
+        print(f"Shared memory unavailable, sending result bytes instead: {e}")
+        return ("bytes", buffer.to_pybytes())
+    try:
+        block.buf[:buffer.size] = memoryview(buffer).cast("B")
+    except Exception:
+        block.close()
+        block.unlink()
+        raise
+    # The receiving process unlinks the block; this worker's tracker must not remove it first
+    resource_tracker.unregister(block._name, "shared_memory")
+    block.close()
+    return ("shm", block.name, buffer.size)
+
+
+def receive_frame(handle):
+    """The frame behind a publish_frame handle; a shared memory block is freed once read"""
+    if handle[0] == "bytes":
+        return pa.ipc.open_stream(handle[1]).read_pandas()
+    _, name, size = handle
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+    return pa.ipc.open_stream(data).read_pandas()
+
+
+def release_frames(prefix):
+    """Free the blocks of a run that were published but never received; returns how many
+
+    Call it once the run's workers are done or stopped. Blocks are looked up in /dev/shm, so where
+    that doesn't exist (macOS) only receive_frame frees them.
+    """
+    if not prefix or not USE_SHARED_MEMORY or not os.path.isdir(SHM_DIR):
+        return 0
+    released = 0
+    for name in os.listdir(SHM_DIR):
+        if not name.startswith(prefix):
+            continue
+        try:
+            os.unlink(os.path.join(SHM_DIR, name))
+            released += 1
+        except OSError:
+            pass
+    return released
+
+
+def _write_csv(df, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+class AsyncResultWriter:
+    """Writes results (CSVs, anomaly store writes) on one background thread, so the caller doesn't wait on disk"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-writer")
+        self._pending = []
+
+    def submit(self, func, *args, **kwargs):
+        self._pending.append(self._executor.submit(func, *args, **kwargs))
+
+    def write(self, df, path):
+        self.submit(_write_csv, df, path)
+
+    def wait(self):
+        """Block until every queued write is done; returns the error messages of failed ones"""
+        errors = []
+        for future in self._pending:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f"Error writing result: {e}")
+        self._pending = []
+        return errors
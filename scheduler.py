@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import multiprocessing
+
+# Per-task timings from previous runs, used to refine cost estimates:
+#   {kind: {"seconds_per_mb": float, "tasks": {path: {"seconds": float, "bytes": int}}}}
+TIMINGS_FILE = "task_timings.json"
+# Weight of the newest run when updating the per-kind seconds/MB rate
+RATE_SMOOTHING = 0.3
+# Share of currently available memory the pool may plan to use
+MEMORY_HEADROOM = 0.8
+# Seconds between pool health checks while waiting for a task to finish
+CHECK_INTERVAL = 5
+
+
+def path_size_bytes(path):
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path) for f in files
+        )
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def available_memory_mb():
+    # MemAvailable is what the kernel can hand out without swapping; None when it can't be read
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES") / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def load_timings(timings_file=TIMINGS_FILE):
+    if not os.path.exists(timings_file):
+        return {}
+    try:
+        with open(timings_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_timings(timings, timings_file=TIMINGS_FILE):
+    tmp_file = f"{timings_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, timings_file)
+
+
+def largest_task_memory_mb(paths, expansion):
+    # Worst case for one worker: the biggest input times how much it grows once loaded
+    return max((path_size_bytes(path) for path in paths), default=0) / (1024 * 1024) * expansion
+
+
+def estimate_task_cost(path, kind, timings, size_bytes=None):
+    """Estimated seconds for one task: its last measured time scaled to its current size,
+    else size times the learned rate for this kind of task"""
+    if size_bytes is None:
+        size_bytes = path_size_bytes(path)
+    kind_timings = timings.get(kind, {})
+    previous = kind_timings.get("tasks", {}).get(path)
+    if previous and previous.get("bytes"):
+        return previous["seconds"] * size_bytes / previous["bytes"]
+    # Without any history the size alone still orders tasks correctly
+    return size_bytes / (1024 * 1024) * kind_timings.get("seconds_per_mb", 1.0)
+
+
+def choose_pool_size(num_tasks, task_memory_mb=None, memory_budget_mb=None, max_processes=None):
+    """Pool size bounded by cores, task count and how many of the largest tasks fit in memory"""
+    size = min(os.cpu_count() or 1, max(num_tasks, 1))
+    if max_processes:
+        size = min(size, max_processes)
+    if memory_budget_mb is None:
+        available = available_memory_mb()
+        memory_budget_mb = available * MEMORY_HEADROOM if available else None
+    if task_memory_mb and memory_budget_mb:
+        size = min(size, max(1, int(memory_budget_mb // task_memory_mb)))
+    return size
+
+
+def _timed_call(task):
+    func, path, arg = task
+    start = time.time()
+    result = func(arg)
+    return path, result, time.time() - start
+
+
+def iter_scheduled(pool, func, tasks, kind, timings_file=TIMINGS_FILE, timing_scale=1, check=None):
+    """Run func(arg) for (path, arg) or (path, arg, size_bytes) tasks on pool, largest estimated cost first
+
+    Tasks are handed out one at a time so a large task started early never leaves the
+    other workers idle at the end. Yields (path, result, seconds) as tasks finish and
+    folds the measured times back into the timings file once all have finished; tasks
+    that ran on several cores are recorded at timing_scale times their wall time. check,
+    if given, is called every CHECK_INTERVAL seconds while waiting and may raise to stop
+    waiting on a broken pool.
+    """
+    timings = load_timings(timings_file)
+    sizes = {task[0]: task[2] if len(task) > 2 else path_size_bytes(task[0]) for task in tasks}
+    ordered = sorted(tasks, key=lambda task: estimate_task_cost(task[0], kind, timings, sizes[task[0]]), reverse=True)
+
+    records = []
+    results = pool.imap_unordered(_timed_call, [(func, task[0], task[1]) for task in ordered], chunksize=1)
+    while len(records) < len(ordered):
+        try:
+            record = results.next(CHECK_INTERVAL if check else None)
+        except multiprocessing.TimeoutError:
+            check()
+            continue
+        records.append(record)
+        yield record
+
+    record_timings([(path, result, seconds * timing_scale) for path, result, seconds in records], kind, sizes, timings_file)
+
+
+def run_scheduled(pool, func, tasks, kind, timings_file=TIMINGS_FILE, check=None):
+    return list(iter_scheduled(pool, func, tasks, kind, timings_file, check=check))
+
+
+def split_jobs(n_jobs, weights):
+    """Share n_jobs cores between parts in proportion to their weights, at least one each (n_jobs >= parts)"""
+    total = sum(weights) or 1
+    jobs = [max(1, int(n_jobs * weight / total)) for weight in weights]
+    # Cores lost to rounding down go to the heaviest parts
+    for index in sorted(range(len(weights)), key=lambda i: weights[i], reverse=True):
+        if sum(jobs) >= n_jobs:
+            break
+        jobs[index] += 1
+    return jobs
+
+
+def plan_hybrid(tasks, kind, pool_size, max_cores=None, timings_file=TIMINGS_FILE):
+    """Split tasks into oversized ones, to run first on several cores each, and the rest
+
+    A task is oversized when it is estimated to take longer than an even share of the whole
+    run across max_cores (all cores by default), i.e. it alone would set the run time. Returns
+    (oversized, rest, jobs): at most pool_size oversized tasks run at once, so giving each
+    jobs cores keeps the total at max_cores. When splitting gains nothing, all tasks are rest.
+    """
+    max_cores = max_cores or os.cpu_count() or 1
+    timings = load_timings(timings_file)
+    costs = {task[0]: estimate_task_cost(task[0], kind, timings, task[2] if len(task) > 2 else None) for task in tasks}
+    share = sum(costs.values()) / max_cores
+    oversized = [task for task in tasks if costs[task[0]] > share]
+    rest = [task for task in tasks if costs[task[0]] <= share]
+    jobs = max_cores // max(min(len(oversized), pool_size), 1)
+    if not oversized or jobs < 2:
+        return [], list(tasks), 1
+    return oversized, rest, jobs
+
+
+def iter_hybrid(pool, func, tasks, kind, with_jobs, pool_size, max_cores=None, timings_file=TIMINGS_FILE, check=None):
+    """iter_scheduled with oversized tasks first, each given several cores through with_jobs(arg, jobs)
+
+    The oversized tasks run as their own phase, at most pool_size at once and jobs cores
+    each, then the rest run one core per process, so the two levels never use more than
+    max_cores together.
+    """
+    oversized, rest, jobs = plan_hybrid(tasks, kind, pool_size, max_cores, timings_file)
+    if oversized:
+        print(f"Running {len(oversized)} oversized tasks on {jobs} cores each")
+        widened = [(task[0], with_jobs(task[1], jobs), *task[2:]) for task in oversized]
+        yield from iter_scheduled(pool, func, widened, kind, timings_file, timing_scale=jobs, check=check)
+    yield from iter_scheduled(pool, func, rest, kind, timings_file, check=check)
+
+
+def record_timings(records, kind, sizes, timings_file=TIMINGS_FILE):
+    timings = load_timings(timings_file)
+    kind_timings = timings.setdefault(kind, {"tasks": {}})
+    total_seconds = sum(seconds for _, _, seconds in records)
+    total_mb = sum(sizes[path] for path, _, _ in records) / (1024 * 1024)
+    for path, _, seconds in records:
+        kind_timings.setdefault("tasks", {})[path] = {"seconds": round(seconds, 4), "bytes": sizes[path]}
+    if total_mb > 0:
+        rate = total_seconds / total_mb
+        previous = kind_timings.get("seconds_per_mb")
+        kind_timings["seconds_per_mb"] = rate if previous is None else (1 - RATE_SMOOTHING) * previous + RATE_SMOOTHING * rate
+    save_timings(timings, timings_file)
+
+
+def format_timing_report(records, top=5):
+    # Parent folder included so the same day or proxy name from two directions can be told apart
+    slowest = sorted(records, key=lambda record: record[2], reverse=True)[:top]
+    return ", ".join(
+        f"{os.path.join(*os.path.normpath(path).split(os.sep)[-2:])} ({seconds:.2f}s)" for path, _, seconds in slowest
+    )
@@ -0,0 +1,80 @@
+import pandas as pd
+
+# One registry of the proxy counter columns, their compact dtypes and the timestamp formats,
+# shared by preprocessing, detection, summaries and the dashboard
+
+# Raw and per-proxy files carry minute timestamps as text, e.g. 24-04-2025-13-05
+TIMESTAMP_FORMAT = "%d-%m-%Y-%H-%M"
+# Anomaly result files are written from parsed datetimes; pandas writes them date-only when every
+# one falls at midnight, so any ISO 8601 form is accepted
+RESULT_TIMESTAMP_FORMAT = "ISO8601"
+
+KEY_COLUMNS = ["Timestamp", "ProxyId"]
+PROXY_DTYPE = "category"
+COUNTER_DTYPE = "Int32"
+
+COUNTERS = {
+    "inbound": [
+        "response1xxForwardedCounter",
+        "response2xxForwardedCounter",
+        "response3xxForwardedCounter",
+        "response4xxForwardedCounter",
+        "response5xxForwardedCounter",
+        "response400ForwardedCounter",
+        "response404ForwardedCounter",
+        "response408ForwardedCounter",
+        "response424ForwardedCounter",
+        "response429ForwardedCounter"
+    ],
+    "outbound": [
+        "response1xxReceivedCounter",
+        "response2xxReceivedCounter",
+        "response3xxReceivedCounter",
+        "response4xxReceivedCounter",
+        "response5xxReceivedCounter",
+        "response400ReceivedCounter",
+        "response404ReceivedCounter",
+        "response408ReceivedCounter",
+        "response424ReceivedCounter",
+        "response429ReceivedCounter"
+    ]
+}
+
+COLUMN_DTYPES = {"ProxyId": PROXY_DTYPE}
+COLUMN_DTYPES.update({counter: COUNTER_DTYPE for counters in COUNTERS.values() for counter in counters})
+
+
+def columns_to_extract(direction):
+    return KEY_COLUMNS + COUNTERS[direction]
+
+
+def dtype_map(direction):
+    return {col: COLUMN_DTYPES[col] for col in columns_to_extract(direction) if col in COLUMN_DTYPES}
+
+
+def dtypes_for(columns):
+    """Compact dtypes for whichever of columns the registry knows"""
+    return {col: COLUMN_DTYPES[col] for col in columns if col in COLUMN_DTYPES}
+
+
+def parse_timestamps(values, source="", timestamp_format=TIMESTAMP_FORMAT):
+    """Parse timestamps with an exact format; values that don't match are reported, then left as NaT"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    parsed = pd.to_datetime(values, format=timestamp_format, errors="coerce")
+    failed = parsed.isna() & values.notna()
+    if failed.any():
+        print(f"Warning: {int(failed.sum())} timestamps in {source or 'input'} don't match {timestamp_format}, "
+              f"e.g. '{values[failed].iloc[0]}'; those rows are skipped")
+    return parsed
+
+
+def read_result_csv(path, columns=None):
+    """Read an anomaly result file with typed columns and parsed timestamps"""
+    # Registry columns absent from the file are ignored by read_csv
+    usecols = None if columns is None else (lambda col: col in columns)
+    df = pd.read_csv(path, usecols=usecols, dtype=COLUMN_DTYPES)
+    if "Timestamp" in df.columns:
+        df["Timestamp"] = parse_timestamps(df["Timestamp"], path, RESULT_TIMESTAMP_FORMAT)
+        df = df.dropna(subset=["Timestamp"])
+    return df
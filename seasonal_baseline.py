@@ -0,0 +1,179 @@
+import os
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from proxy_store import MISSING_COLUMN, load_proxy_frame, proxy_name_from_path, safe_proxy_name
+from schema import parse_timestamps
+
+# Per-proxy seasonal baseline, one compressed file per proxy:
+#   <baseline_folder>/<proxy>.npz   days: int64 days since the epoch, ascending
+#                                   <counter>: float32 (days, 24, quantiles), each hour's quantiles of its minutes
+# The hour-of-week table detection uses is derived from the most recent days on load, so new
+# days only add rows and a rerun recomputes just the days that changed
+BASELINE_SUFFIX = ".npz"
+BASELINE_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+MEDIAN_INDEX = BASELINE_QUANTILES.index(0.5)
+LOWER_QUARTILE_INDEX = BASELINE_QUANTILES.index(0.25)
+UPPER_QUARTILE_INDEX = BASELINE_QUANTILES.index(0.75)
+HOURS_PER_WEEK = 7 * 24
+# Only the most recent weeks shape the table, so it follows slow drifts in traffic
+BASELINE_WEEKS = 8
+# Residuals are scaled by the hour's interquartile range, but never by less than this
+MIN_SPREAD = 1.0
+# 1970-01-01 was a Thursday (dayofweek 3)
+EPOCH_WEEKDAY = 3
+
+
+def baseline_path(baseline_folder, proxy_name):
+    return os.path.join(baseline_folder, f"{safe_proxy_name(proxy_name)}{BASELINE_SUFFIX}")
+
+
+def daily_hour_quantiles(df, counters):
+    """(days, {counter: (days, 24, quantiles) float32}) from a frame of parsed timestamps and counters"""
+    timestamps = df['Timestamp']
+    keep = timestamps.notna().to_numpy()
+    if MISSING_COLUMN in df.columns:
+        keep &= ~df[MISSING_COLUMN].astype(bool).to_numpy()
+    timestamps = timestamps[keep]
+    day = timestamps.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]").astype(np.int64)
+    hour = timestamps.dt.hour.to_numpy()
+    days = np.unique(day)
+    day_index = np.searchsorted(days, day)
+
+    arrays = {}
+    for counter in counters:
+        daily = np.full((len(days), 24, len(BASELINE_QUANTILES)), np.nan, dtype=np.float32)
+        if counter in df.columns and len(days):
+            values = pd.to_numeric(df[counter][keep], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+            quantiles = pd.Series(values).groupby([day_index, hour]).quantile(list(BASELINE_QUANTILES)).unstack()
+            rows, hours = (quantiles.index.get_level_values(i).to_numpy() for i in (0, 1))
+            daily[rows, hours] = quantiles.to_numpy(dtype=np.float32)
+        arrays[counter] = daily
+    return days, arrays
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable baseline {path}: {e}")
+        return None
+
+
+def save_baseline(path, baseline):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **baseline)
+    os.replace(tmp_path, path)
+
+
+def update_baseline(source_path, baseline_folder, counters, rebuild=False):
+    """Add the days of a per-proxy series that are not in its baseline yet; returns how many days were computed
+
+    The last stored day is always recomputed, since it may have been partial. With rebuild (the
+    series was rewritten, not appended to) every day is recomputed.
+    """
+    path = baseline_path(baseline_folder, proxy_name_from_path(source_path))
+    existing = None if rebuild else load_baseline(path)
+    start = None
+    if existing is not None and len(existing["days"]):
+        start = pd.Timestamp(int(existing["days"][-1]), unit="D")
+
+    # Only the days from the last stored one on are read; the per-day index makes this a seek
+    df = load_proxy_frame(source_path, columns=['Timestamp', *counters, MISSING_COLUMN], start=start)
+    df['Timestamp'] = parse_timestamps(df['Timestamp'], source_path)
+    if start is not None:
+        df = df[df['Timestamp'] >= start]
+    days, arrays = daily_hour_quantiles(df, counters)
+    computed = len(days)
+
+    if existing is not None:
+        kept = existing["days"] < (days[0] if len(days) else np.iinfo(np.int64).max)
+        for counter in counters:
+            previous = existing.get(counter)
+            if previous is None:
+                previous = np.full((len(existing["days"]), 24, len(BASELINE_QUANTILES)), np.nan, dtype=np.float32)
+            arrays[counter] = np.concatenate([previous[kept], arrays[counter]])
+        days = np.concatenate([existing["days"][kept], days])
+    save_baseline(path, {"days": days.astype(np.int64), **arrays})
+    return computed
+
+
+def hour_of_week_table(days, daily, weeks=BASELINE_WEEKS):
+    """(168, quantiles) table: per hour of week, the median over recent days of each hourly quantile"""
+    table = np.full((HOURS_PER_WEEK, len(BASELINE_QUANTILES)), np.nan, dtype=np.float32)
+    if not len(days):
+        return table
+    recent = days > days[-1] - weeks * 7 if weeks else np.ones(len(days), dtype=bool)
+    weekdays = (days + EPOCH_WEEKDAY) % 7
+    with warnings.catch_warnings():
+        # Hours never seen on a weekday stay NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for weekday in range(7):
+            selected = recent & (weekdays == weekday)
+            if selected.any():
+                table[weekday * 24:(weekday + 1) * 24] = np.nanmedian(daily[selected], axis=0)
+    return table
+
+
+def load_table(baseline_folder, proxy_name, counter, weeks=BASELINE_WEEKS):
+    baseline = load_baseline(baseline_path(baseline_folder, proxy_name))
+    if baseline is None or counter not in baseline:
+        return None
+    return hour_of_week_table(baseline["days"], baseline[counter], weeks)
+
+
+def seasonal_residual(timestamps, values, table):
+    """How far each value is from its hour of week's median, in interquartile ranges (0 where unknown)"""
+    hour_of_week = (timestamps.dt.dayofweek * 24 + timestamps.dt.hour).to_numpy()
+    median = table[hour_of_week, MEDIAN_INDEX]
+    spread = np.maximum(table[hour_of_week, UPPER_QUARTILE_INDEX] - table[hour_of_week, LOWER_QUARTILE_INDEX], MIN_SPREAD)
+    values = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    residual = (values - median) / spread
+    return np.nan_to_num(residual, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def add_seasonal_residual(df, column_name, baseline_dir, proxy_name):
+    """Add a seasonal_residual column from the proxy's baseline; returns False when it has none"""
+    table = load_table(baseline_dir, proxy_name, column_name)
+    if table is None:
+        return False
+    df['seasonal_residual'] = seasonal_residual(df['Timestamp'], df[column_name], table)
+    return True
+
+
+def update_baseline_task(args):
+    source_path, baseline_folder, counters, rebuild = args
+    try:
+        days = update_baseline(source_path, baseline_folder, counters, rebuild)
+        print(f"Baseline: {proxy_name_from_path(source_path)} ({days} days)")
+    except Exception as e:
+        print(f"Error updating baseline for {source_path}: {e}")
+
+
+def main():
+    from unified_preprocess import CONFIG, get_input_dir, plan_baseline_tasks
+    from schema import COUNTERS
+
+    parser = argparse.ArgumentParser(description="Build or update the per-proxy seasonal baselines")
+    parser.add_argument("--direction", choices=sorted(CONFIG), default="inbound")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute every day instead of only new ones")
+    args = parser.parse_args()
+
+    source_folder = get_input_dir(args.direction)
+    baseline_folder = CONFIG[args.direction]["baseline_folder"]
+    tasks = plan_baseline_tasks(source_folder, baseline_folder, COUNTERS[args.direction], rebuild_all=args.rebuild)
+    for _, task_args in tasks:
+        update_baseline_task(task_args)
+    print(f"Updated {len(tasks)} baselines in {baseline_folder}")
+
+
+if __name__ == "__main__":
+    main()
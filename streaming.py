@@ -0,0 +1,325 @@
+import os
+import csv
+import sys
+import time
+import socket
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import IsolationForest
+
+from ag import load_detection_frame
+from model_store import MODEL_STORE_DIR, fit_or_load
+from proxy_store import list_proxy_paths, safe_proxy_name
+from schema import COUNTERS, TIMESTAMP_FORMAT
+from summary import BURST_THRESHOLD, PLATEAU_THRESHOLD, TIME_WINDOW_MINUTES
+from unified_preprocess import get_input_dir
+
+# Online scoring of newly arriving minute rows. Each proxy keeps a constant amount of state:
+# its fitted segment models, the last ROLLING_WINDOW values with their running mean and squared
+# deviations for the rolling mean/std z-score of anomalyisowithmonthend.py, and the anomalies of
+# the open burst/plateau window
+
+# Same features, window and model defaults as anomalyisowithmonthend.detect_anomalies
+ROLLING_WINDOW = 200
+STREAM_ISO_PARAMS = dict(
+    n_estimators=25, max_samples=0.0075, contamination=0.001, max_features=0.8, bootstrap=True, n_jobs=1, random_state=42
+)
+# History used to fit a proxy's models at startup, and rows buffered for proxies without history
+HISTORY_DAYS = 30
+WARMUP_ROWS = 1440
+STREAM_OUTPUT_COLUMNS = ["event", "Timestamp", "ProxyId", "value", "z_score", "score", "end", "anomaly_count", "latency_ms"]
+
+
+def _is_monthend(timestamp):
+    return 26 <= timestamp.day <= 30
+
+
+def _calendar_row(timestamp, value, z_score):
+    day_of_week = timestamp.weekday()
+    return [value, timestamp.hour, day_of_week, day_of_week >= 5, z_score]
+
+
+class RollingStats:
+    """Mean and sample std of the last `window` values, updated in O(1) per value
+
+    Welford updates of the mean and the sum of squared deviations: a running sum of squares
+    cancels once the counter is large next to its spread.
+    """
+
+    def __init__(self, window=ROLLING_WINDOW):
+        self.values = deque(maxlen=window)
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def push(self, value):
+        value = float(value)
+        n = len(self.values)
+        if n == self.values.maxlen:
+            # The new value replaces the oldest one
+            oldest = self.values[0]
+            mean = self.mean + (value - oldest) / n
+            self.m2 = max(self.m2 + (value - oldest) * (value - mean + oldest - self.mean), 0.0)
+            self.mean = mean
+        else:
+            delta = value - self.mean
+            self.mean += delta / (n + 1)
+            self.m2 += delta * (value - self.mean)
+        self.values.append(value)
+
+    def z_score(self, value):
+        # Like rolling(window).mean()/std() with fillna(0): no score until the window is full
+        n = len(self.values)
+        if n < self.values.maxlen:
+            return 0.0
+        std = (self.m2 / (n - 1)) ** 0.5
+        return (value - self.mean) / std if std > 0 else 0.0
+
+
+class BurstTracker:
+    """Streaming form of summary.classify_bursts_plateaus over the anomalies of one proxy and day
+
+    Windows start at the earliest unclaimed anomaly; once the stream passes its end the window
+    is classified and its anomalies claimed, or the start moves on to the next anomaly.
+    """
+
+    def __init__(self):
+        self.pending = deque()
+
+    def add(self, timestamp):
+        if self.pending and self.pending[0].date() != timestamp.date():
+            # Batch summaries group by day, so windows never span midnight
+            yield from self.flush()
+        self.pending.append(timestamp)
+
+    def advance(self, now):
+        window = timedelta(minutes=TIME_WINDOW_MINUTES)
+        while self.pending and now >= self.pending[0] + window:
+            yield from self._resolve_first(window)
+
+    def flush(self):
+        window = timedelta(minutes=TIME_WINDOW_MINUTES)
+        while self.pending:
+            yield from self._resolve_first(window)
+
+    def _resolve_first(self, window):
+        start = self.pending[0]
+        in_window = [t for t in self.pending if t < start + window]
+        if len(in_window) >= BURST_THRESHOLD:
+            for _ in in_window:
+                self.pending.popleft()
+            event = "plateau" if len(in_window) >= PLATEAU_THRESHOLD else "burst"
+            yield event, start, in_window[-1], len(in_window)
+        else:
+            self.pending.popleft()
+
+
+class ProxyStream:
+    """Per-proxy streaming state: segment models, rolling z-score window and burst/plateau window"""
+
+    def __init__(self, proxy_id, counter, iso_params, model_store_dir=MODEL_STORE_DIR):
+        self.proxy_id = proxy_id
+        self.counter = counter
+        self.iso_params = iso_params
+        self.model_store_dir = model_store_dir
+        self.models = {}
+        self.rolling = RollingStats()
+        self.bursts = BurstTracker()
+        self.warmup = []
+
+    def fit(self, history, prime_window=True):
+        """Fit (or load cached) segment models on a frame of Timestamp and counter values"""
+        values = pd.to_numeric(history[self.counter], errors="coerce").fillna(0).astype(float)
+        rolling_mean = values.rolling(ROLLING_WINDOW).mean()
+        rolling_std = values.rolling(ROLLING_WINDOW).std()
+        features = pd.DataFrame({
+            self.counter: values,
+            "hour": history["Timestamp"].dt.hour,
+            "day_of_week": history["Timestamp"].dt.dayofweek,
+            "is_weekend": history["Timestamp"].dt.dayofweek >= 5,
+            "z_score": ((values - rolling_mean) / rolling_std).replace([np.inf, -np.inf], np.nan).fillna(0)
+        })
+        monthend = history["Timestamp"].dt.day.between(26, 30).to_numpy()
+        for segment_name, segment in (("regular", ~monthend), ("monthend", monthend)):
+            if segment.any():
+                model = IsolationForest(**self.iso_params)
+                self.models[segment_name] = fit_or_load(
+                    # Fitted on plain arrays so single-row scoring below needs no column names
+                    model, features[segment].to_numpy(dtype=np.float64), self.proxy_id, self.counter, f"stream-{segment_name}", self.model_store_dir
+                )
+        if prime_window:
+            # The rolling window continues from the end of the history
+            for value in values.iloc[-ROLLING_WINDOW:]:
+                self.rolling.push(value)
+
+    def process(self, timestamp, value):
+        """Score one new minute; returns the events it produced (anomaly, burst, plateau)"""
+        self.rolling.push(value)
+        z_score = self.rolling.z_score(value)
+        events = list(self.bursts.advance(timestamp))
+
+        if not self.models:
+            # No history: buffer a bounded warm-up, then fit on it
+            self.warmup.append((timestamp, value))
+            if len(self.warmup) >= WARMUP_ROWS:
+                history = pd.DataFrame(self.warmup, columns=["Timestamp", self.counter])
+                self.warmup = []
+                self.fit(history, prime_window=False)
+            return events
+
+        model = self.models.get("monthend" if _is_monthend(timestamp) else "regular") or next(iter(self.models.values()))
+        features = np.array([_calendar_row(timestamp, value, z_score)], dtype=np.float64)
+        score = float(model.score_samples(features)[0])
+        if score < model.offset_:
+            events.append(("anomaly", timestamp, value, z_score, score))
+            events.extend(self.bursts.add(timestamp))
+        return events
+
+
+class StreamingDetector:
+    """Routes incoming rows to per-proxy state and writes every event as it happens"""
+
+    def __init__(self, direction, counter, output_file, iso_params=None, model_store_dir=MODEL_STORE_DIR, preload=True):
+        self.direction = direction
+        self.counter = counter
+        self.iso_params = dict(STREAM_ISO_PARAMS, **(iso_params or {}))
+        self.model_store_dir = model_store_dir
+        self.proxies = {}
+        self.latencies = deque(maxlen=10000)
+        new_file = not os.path.exists(output_file)
+        self.output = open(output_file, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.output)
+        if new_file:
+            self.writer.writerow(STREAM_OUTPUT_COLUMNS)
+        self.history_paths = list_proxy_paths(get_input_dir(direction))
+        if preload:
+            # Fitting up front keeps the first row of each known proxy as fast as the rest
+            for proxy_id in self.history_paths:
+                self._proxy_state(proxy_id)
+
+    def _proxy_state(self, proxy_id):
+        # States and history are keyed by the file-safe name, as the preprocessed files are named
+        proxy_name = safe_proxy_name(proxy_id)
+        state = self.proxies.get(proxy_name)
+        if state is None:
+            state = ProxyStream(proxy_name, self.counter, self.iso_params, self.model_store_dir)
+            history_path = self.history_paths.get(proxy_name)
+            if history_path:
+                history = load_detection_frame(history_path, [self.counter])
+                if len(history):
+                    start = history["Timestamp"].iloc[-1] - pd.Timedelta(days=HISTORY_DAYS)
+                    state.fit(history[history["Timestamp"] > start].reset_index(drop=True))
+            self.proxies[proxy_name] = state
+        return state
+
+    def process_row(self, row):
+        started = time.perf_counter()
+        try:
+            timestamp = datetime.strptime(row["Timestamp"], TIMESTAMP_FORMAT)
+            value = float(row.get(self.counter) or 0)
+        except (ValueError, TypeError) as e:
+            print(f"Skipping unparseable row {row}: {e}")
+            return
+        proxy_id = row["ProxyId"]
+        events = self._proxy_state(proxy_id).process(timestamp, value)
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.latencies.append(latency_ms)
+        self._write_events(proxy_id, events, latency_ms)
+
+    def _write_events(self, proxy_id, events, latency_ms):
+        for event in events:
+            if event[0] == "anomaly":
+                _, timestamp, value, z_score, score = event
+                self.writer.writerow(["anomaly", timestamp, proxy_id, value, round(z_score, 4), round(score, 6), "", "", round(latency_ms, 3)])
+                print(f"Anomaly: {proxy_id} {timestamp} {self.counter}={value}")
+            else:
+                kind, start, end, count = event
+                self.writer.writerow([kind, start, proxy_id, "", "", "", end, count, round(latency_ms, 3)])
+                print(f"{kind.capitalize()}: {proxy_id} {start} - {end} ({count} anomalies)")
+        if events:
+            self.output.flush()
+
+    def run(self, lines):
+        """Consume CSV lines (header first) until the source ends"""
+        header = None
+        for line in lines:
+            if not line.strip():
+                continue
+            fields = next(csv.reader([line]))
+            if header is None or fields[0] == "Timestamp":
+                header = fields
+                continue
+            self.process_row(dict(zip(header, fields)))
+
+    def close(self):
+        # Windows still open at shutdown are classified with what they have
+        for proxy_id, state in self.proxies.items():
+            self._write_events(proxy_id, list(state.bursts.flush()), 0.0)
+        self.output.close()
+
+    def latency_report(self):
+        if not self.latencies:
+            return "No rows processed"
+        latencies = np.array(self.latencies)
+        return (f"{len(latencies)} rows, latency ms: mean {latencies.mean():.2f}, "
+                f"p99 {np.percentile(latencies, 99):.2f}, max {latencies.max():.2f}")
+
+
+def tail_file(file_path, poll_interval=1.0, follow=True):
+    """Yield lines of a file as they are appended, starting from its beginning"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        partial = ""
+        while True:
+            line = f.readline()
+            if line:
+                partial += line
+                if partial.endswith("\n"):
+                    yield partial
+                    partial = ""
+            elif follow:
+                time.sleep(poll_interval)
+            else:
+                if partial:
+                    yield partial
+                return
+
+
+def socket_lines(host="127.0.0.1", port=9009):
+    """Yield lines sent by clients of a local TCP socket, one client after another"""
+    with socket.create_server((host, port)) as server:
+        print(f"Listening on {host}:{port}")
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile("r", encoding="utf-8") as stream:
+                yield from stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream new minute rows through per-proxy anomaly detection")
+    parser.add_argument("--direction", choices=list(COUNTERS), default="inbound")
+    parser.add_argument("--counter", default=None, help="Counter column (default: the direction's 2xx counter)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="Raw CSV file to tail")
+    source.add_argument("--port", type=int, help="Local TCP port to accept CSV lines on")
+    parser.add_argument("--no-follow", action="store_true", help="Stop at the end of --file instead of waiting for more")
+    parser.add_argument("--output", default=None, help="Events CSV (default: stream_anomalies_<direction>_<counter>.csv)")
+    args = parser.parse_args()
+
+    counter = args.counter or COUNTERS[args.direction][1]
+    output_file = args.output or f"stream_anomalies_{args.direction}_{counter}.csv"
+    detector = StreamingDetector(args.direction, counter, output_file)
+    lines = tail_file(args.file, follow=not args.no_follow) if args.file else socket_lines(port=args.port)
+    try:
+        detector.run(lines)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        detector.close()
+        print(detector.latency_report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,28 @@
 import streamlit as st
 import os
-import glob
 import time
 from datetime import datetime
 from collections import defaultdict
 import pandas as pd
-import multiprocessing
 import importlib
 from streamlit.components.v1 import html  # Add this import
 
-from ag import detect_anomalies, filter_anomalies_df
-from summary import generate_proxy_summary
+from ag import detect_anomalies, detect_anomalies_multi, detection_range, filter_anomaly_columns, resolve_plot_dir
+from batched_iforest import PROXIES_PER_BATCH, detect_anomalies_batch
+from fleet_matrix import default_matrix_dir, fleet_matrix, load_fleet_matrix
+from summary import summarize_anomaly_frames
 from anomalyisowithmonthend import detect_anomalies as detect_anomalies_ind
 from filteringusingrollingmean import filter_anomalies as filter_anomalies_ind
+from proxy_store import list_proxy_paths, proxy_name_from_path
+from unified_preprocess import get_baseline_dir, get_input_dir
+from scheduler import choose_pool_size, iter_hybrid, iter_scheduled, largest_task_memory_mb, path_size_bytes
+from schema import COUNTERS
+from model_store import MODEL_STORE_DIR, invalidate_models, store_size_mb
+from warm_pool import WarmPool
+from anomaly_store import counter_dir, list_proxies, read_anomalies, write_anomalies
+from plot_data import PLOT_CONFIG, anomaly_figure, load_plot_data, plot_file_path, prerender_plots
+from result_transport import AsyncResultWriter, new_run_prefix, publish_frame, receive_frame, release_frames
+from result_cache import RESULT_CACHE_DIR, cache_size_mb, cached_run, clear_results, result_key
 
 # Page configuration
 st.set_page_config(
@@ -72,13 +82,26 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+@st.cache_resource(show_spinner=False)
+def dashboard_pool():
+    """The dashboard's warm worker pool, shared by every rerun, tab and session of this process"""
+    return WarmPool()
+
+
+def worker_pool_controls():
+    st.sidebar.markdown("**Worker pool**")
+    warm = dashboard_pool()
+    st.sidebar.caption(warm.status())
+    if st.sidebar.button("Restart worker pool", key="restart_worker_pool"):
+        if warm.restart():
+            st.sidebar.success(warm.status())
+        else:
+            st.sidebar.warning("The worker pool is in use by a running batch; try again when it finishes")
+
+
 def get_all_proxies(data_folder):
     """Get all proxy files from the data folder"""
-    proxies = []
-    for fname in os.listdir(data_folder):
-        if fname.endswith('.csv'):
-            proxies.append(fname[:-4])
-    return proxies
+    return list(list_proxy_paths(data_folder).keys())
 
 
 def build_proxy_hierarchy(all_proxies):
@@ -97,47 +120,147 @@ def build_proxy_hierarchy(all_proxies):
 
 
 def process_file_streamlit(args):
-    """Process a single file for anomaly detection"""
-    file_path, column_name, output_dir, plot_dir, start_date, end_date, iso_params = args
+    """Process a single file for anomaly detection
+
+    Workers don't write results: each returns {"file", "outputs": [(counter, frame handle)]} and the
+    dashboard receives the frames through shared memory and stores them in the anomaly store.
+    """
+    file_path, column_name, output_dir, plot_dir, start_date, end_date, iso_params, model_options, result_cache_dir, frame_prefix = args
     try:
-        anomaly_df = detect_anomalies(
-            file_path, column_name, plot_dir=plot_dir, start_date=start_date, end_date=end_date, **iso_params
+        base_name = proxy_name_from_path(file_path)
+        # A rerun with the same input, counter, range and parameters reuses the stored frame and plot
+        plot_file = plot_file_path(
+            resolve_plot_dir(plot_dir, file_path, column_name), base_name, column_name, model_options.get("plot_format", "html")
         )
-        # Save in the output_dir, not anomaly_excels
-        base_name = os.path.splitext(os.path.basename(file_path))[0]
-        final_output = os.path.join(output_dir, f"{base_name}_{column_name}.csv")
-        filter_anomalies_df(anomaly_df, final_output, column_name)
-        return final_output
+        anomaly_df = cached_run(
+            result_key(file_path, column_name, start_date, end_date, {**iso_params, **model_options}),
+            lambda: detect_anomalies(
+                file_path, column_name, plot_dir=plot_dir, start_date=start_date, end_date=end_date, **iso_params, **model_options
+            ),
+            artifacts=[plot_file], cache_dir=result_cache_dir
+        )
+        return {"file": file_path, "outputs": [(column_name, publish_frame(filter_anomaly_columns(anomaly_df, column_name), frame_prefix))]}
     except Exception as e:
         return f"Error processing {file_path}: {e}"
 
 
-# List of all counters as per the counters file
-INBOUND_COUNTERS = [
-    "response1xxForwardedCounter",
-    "response2xxForwardedCounter",
-    "response3xxForwardedCounter",
-    "response4xxForwardedCounter",
-    "response5xxForwardedCounter",
-    "response400ForwardedCounter",
-    "response404ForwardedCounter",
-    "response408ForwardedCounter",
-    "response424ForwardedCounter",
-    "response429ForwardedCounter"
-]
-
-OUTBOUND_COUNTERS = [
-    "response1xxReceivedCounter",
-    "response2xxReceivedCounter",
-    "response3xxReceivedCounter",
-    "response4xxReceivedCounter",
-    "response5xxReceivedCounter",
-    "response400ReceivedCounter",
-    "response404ReceivedCounter",
-    "response408ReceivedCounter",
-    "response424ReceivedCounter",
-    "response429ReceivedCounter"
-]
+def process_file_streamlit_multi(args):
+    """Process every selected counter of a single file from one load"""
+    file_path, column_names, output_dir_base, plot_dir_base, start_date, end_date, iso_params, model_options, result_cache_dir, frame_prefix = args
+    try:
+        base_name = proxy_name_from_path(file_path)
+        plot_files = [
+            plot_file_path(
+                resolve_plot_dir(plot_dir_base, file_path, column_name), base_name, column_name, model_options.get("plot_format", "html")
+            )
+            for column_name in column_names
+        ]
+        anomaly_dfs = cached_run(
+            result_key(file_path, column_names, start_date, end_date, {**iso_params, **model_options}),
+            lambda: detect_anomalies_multi(
+                file_path, column_names, plot_dir=plot_dir_base, start_date=start_date, end_date=end_date, **iso_params, **model_options
+            ),
+            artifacts=plot_files, cache_dir=result_cache_dir
+        )
+        return {"file": file_path, "outputs": [
+            (column_name, publish_frame(filter_anomaly_columns(anomaly_df, column_name), frame_prefix))
+            for column_name, anomaly_df in anomaly_dfs.items()
+        ]}
+    except Exception as e:
+        return f"Error processing {file_path}: {e}"
+
+
+def _detect_chunk(file_paths, column_name, plot_dir_base, start_date, end_date, iso_params, model_options):
+    # Matrices were built before the pool started; each worker only maps them
+    fleet_dirs = model_options.get("fleet_dirs") or {}
+    fleet = load_fleet_matrix(fleet_dirs[column_name]) if column_name in fleet_dirs else None
+    return detect_anomalies_batch(
+        file_paths, column_name, plot_dir=plot_dir_base, start_date=start_date, end_date=end_date,
+        train_end=model_options["train_end"], fleet=fleet, plot_format=model_options.get("plot_format", "html"), **iso_params
+    )
+
+
+def process_chunk_streamlit_batched(args):
+    """Process a chunk of files with the vectorized engine; returns one result per file (not result-cached)"""
+    file_paths, column_names, output_dir_base, plot_dir_base, start_date, end_date, iso_params, model_options, _, frame_prefix = args
+    anomaly_frames = {file_path: [] for file_path in file_paths}
+    errors = {}
+    for column_name in column_names:
+        pending = [file_path for file_path in file_paths if file_path not in errors]
+        try:
+            anomaly_dfs = _detect_chunk(pending, column_name, plot_dir_base, start_date, end_date, iso_params, model_options)
+        except Exception:
+            # One bad proxy fails the whole chunk: retry its files one at a time so only that one is an error
+            anomaly_dfs = {}
+            for file_path in pending:
+                try:
+                    anomaly_dfs.update(_detect_chunk([file_path], column_name, plot_dir_base, start_date, end_date, iso_params, model_options))
+                except Exception as e:
+                    errors[file_path] = f"Error processing {file_path}: {e}"
+        for file_path, anomaly_df in anomaly_dfs.items():
+            anomaly_frames[file_path].append((column_name, filter_anomaly_columns(anomaly_df, column_name)))
+    # Frames are published last, so a file failing a later counter leaves none behind unreceived
+    return [
+        errors[file_path] if file_path in errors else
+        {"file": file_path, "outputs": [(column_name, publish_frame(df, frame_prefix)) for column_name, df in anomaly_frames[file_path]]}
+        for file_path in file_paths
+    ]
+
+
+# List of all counters as per the counters file, from the shared schema registry
+INBOUND_COUNTERS = COUNTERS["inbound"]
+OUTBOUND_COUNTERS = COUNTERS["outbound"]
+
+
+def model_cache_controls(key_prefix, direction):
+    """Model options for detection: reuse fitted forests, optional training cutoff, seasonal baseline, clear"""
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        reuse_models = st.checkbox(
+            "Reuse cached models", value=False, key=f"{key_prefix}_reuse_models",
+            help="Score with forests already fitted on the same rows and parameters instead of refitting; "
+                 "changing only contamination re-thresholds the cached scores"
+        )
+    with col2:
+        train_end = st.date_input(
+            "Train until (optional)", value=None, key=f"{key_prefix}_train_end",
+            help="Fit only on data up to this day; later days are scored with that model"
+        )
+    with col3:
+        use_baseline = st.checkbox(
+            "Seasonal baseline residual", value=False, key=f"{key_prefix}_use_baseline",
+            help="Add each minute's distance from the proxy's hour-of-week median (built during preprocessing) as a feature"
+        )
+    with col4:
+        st.caption(f"Model cache: {store_size_mb():.1f} MB")
+        if st.button("Clear model cache", key=f"{key_prefix}_clear_models"):
+            st.info(f"Removed {invalidate_models()} cached models")
+    return dict(
+        model_store_dir=MODEL_STORE_DIR if reuse_models else None,
+        # Whole training day included
+        train_end=f"{train_end:%Y-%m-%d} 23:59:59" if train_end else None,
+        baseline_dir=get_baseline_dir(direction) if use_baseline else None
+    )
+
+
+def result_cache_controls(key_prefix):
+    """Result cache options: reuse finished runs, clear; returns the cache folder or None"""
+    col1, col2 = st.columns(2)
+    with col1:
+        reuse_results = st.checkbox(
+            "Reuse cached results", value=True, key=f"{key_prefix}_reuse_results",
+            help="Return the stored anomalies and plot when the same input, counter, date range and parameters were run before"
+        )
+    with col2:
+        st.caption(f"Result cache: {cache_size_mb():.1f} MB")
+        if st.button("Clear result cache", key=f"{key_prefix}_clear_results"):
+            st.info(f"Removed {clear_results()} cached results")
+    return RESULT_CACHE_DIR if reuse_results else None
+
+
+# A proxy file loaded for detection (features, segment copies, model input) takes
+# roughly this many times its on-disk size in memory
+DETECT_MEMORY_EXPANSION = 6
 
 
 def batch_mode():
@@ -163,11 +286,36 @@ def batch_mode():
             else:
                 counter_options = outbound_counters
             counter_choice = st.selectbox("Select Counter Type", counter_options, key="batch_counter")
+            all_counters = st.checkbox(
+                "All counters in one pass", value=False, key="batch_all_counters",
+                help="Load each proxy once and detect every counter; results below are shown for the selected counter"
+            )
+            vectorized = st.checkbox(
+                "Vectorized engine", value=False, key="batch_vectorized",
+                help="Build the forests of many proxies together in NumPy instead of one sklearn model per proxy; "
+                     "faster on many small proxies, same thresholding, does not use the model cache or seasonal baselines"
+            )
+            use_fleet_matrix = st.checkbox(
+                "Fleet matrix", value=False, key="batch_fleet_matrix", disabled=not vectorized,
+                help="Vectorized engine only: assemble each counter of all proxies into one memory-mapped proxy x minute "
+                     "array once, and slice proxies from it instead of reading every file in every worker"
+            )
 
         with col3:
             st.markdown("**Number of Processes**")
             num_processes = st.number_input(
-                "Number of processes", min_value=1, max_value=os.cpu_count(), value=os.cpu_count(), key="batch_num_proc"
+                "Number of processes (0 = auto)", min_value=0, max_value=os.cpu_count(), value=0, key="batch_num_proc"
+            )
+            hybrid = st.checkbox(
+                "Split oversized proxies across cores", value=False, key="batch_hybrid", disabled=vectorized,
+                help="Proxies estimated to take longer than an even share of the run are processed first, each on "
+                     "several cores (segments, counters and trees in parallel); the rest stay one per process. "
+                     "Total cores used stay within the process count"
+            )
+            prerender_top = st.number_input(
+                "Pre-render plots of the N worst proxies", min_value=0, max_value=1000, value=0, key="batch_prerender_top",
+                help="Batch runs keep only plot data and draw a proxy's plot when it is selected; the plots of the N "
+                     "proxies with the most anomalies are also written as HTML in the background"
             )
 
     # Isolation Forest parameter tuning
@@ -182,6 +330,14 @@ def batch_mode():
         with col3:
             bootstrap = st.checkbox("bootstrap", value=True, key="batch_bootstrap")
             random_state = st.number_input("random_state", min_value=0, max_value=9999, value=42, step=1, key="batch_random_state")
+            prescreen = st.checkbox(
+                "Prescreen", value=False, key="batch_prescreen",
+                help="Score only minutes a rolling/robust z-score marks as candidates, plus a background sample "
+                     "for the threshold; check recall with 'python prescreen.py <folder> <counter>'"
+            )
+        # Only the plot data is kept; figures are drawn when a proxy is opened below
+        model_options = dict(model_cache_controls("batch", direction), plot_format="data")
+        result_cache_dir = result_cache_controls("batch")
 
     iso_params = dict(
         n_estimators=int(n_estimators),
@@ -190,22 +346,23 @@ def batch_mode():
         max_features=float(max_features),
         bootstrap=bootstrap,
         n_jobs=1,
-        random_state=int(random_state)
+        random_state=int(random_state),
+        prescreen=prescreen
     )
 
     # Directory and column setup
+    input_dir = get_input_dir(direction)
     if direction == "inbound":
-        input_dir = "individual_proxy_inbound"
         output_dir_base = "anomaly_output_inbound"
         plot_dir_base = "anomaly_plots_inbound"
     else:
-        input_dir = "individual_proxy_outbound"
         output_dir_base = "anomaly_output_outbound"
         plot_dir_base = "anomaly_plots_outbound"
 
     column_name = counter_choice
     output_dir = f"{output_dir_base}_{counter_choice}"
     plot_dir = f"{plot_dir_base}_{counter_choice}"
+    column_names = counter_options if all_counters else [column_name]
 
     # Date range selection
     st.markdown("**Date Range (Optional)**")
@@ -220,7 +377,7 @@ def batch_mode():
 
     # File count preview
     if os.path.exists(input_dir):
-        file_count = len(glob.glob(os.path.join(input_dir, "*.csv")))
+        file_count = len(list_proxy_paths(input_dir))
         st.info(f"Found {file_count} files to process in {input_dir}")
     else:
         st.error(f"Input directory {input_dir} not found!")
@@ -236,14 +393,42 @@ def batch_mode():
 
     if run_batch:
         with st.spinner("Initializing batch processing..."):
-            os.makedirs(output_dir, exist_ok=True)
-            all_files = glob.glob(os.path.join(input_dir, "*.csv"))
+            all_files = list(list_proxy_paths(input_dir).values())
             os.makedirs(plot_dir, exist_ok=True)
-
-            args_list = [
-                (file_path, column_name, output_dir, plot_dir, start_date, end_date, iso_params)
-                for file_path in all_files
-            ]
+            # Names this run's result blocks, so any left unreceived are freed when it ends
+            frame_prefix = new_run_prefix()
+
+            if vectorized:
+                # One task per chunk of proxies, each chunk scored by a single engine call
+                process_func = process_chunk_streamlit_batched
+                batch_options = model_options
+                if use_fleet_matrix:
+                    range_start, range_end = detection_range(start_date, end_date)
+                    for counter in column_names:
+                        fleet_matrix(input_dir, counter, range_start, range_end)
+                    batch_options = dict(model_options, fleet_dirs={
+                        counter: default_matrix_dir(input_dir, counter) for counter in column_names
+                    })
+                args_list = [
+                    (all_files[i:i + PROXIES_PER_BATCH], column_names, output_dir_base, plot_dir_base, start_date, end_date,
+                     iso_params, batch_options, result_cache_dir, frame_prefix)
+                    for i in range(0, len(all_files), PROXIES_PER_BATCH)
+                ]
+            elif all_counters:
+                # One task per proxy covering every counter; outputs and plots go to the per-counter folders
+                process_func = process_file_streamlit_multi
+                args_list = [
+                    (file_path, column_names, output_dir_base, plot_dir_base, start_date, end_date, iso_params, model_options,
+                     result_cache_dir, frame_prefix)
+                    for file_path in all_files
+                ]
+            else:
+                process_func = process_file_streamlit
+                args_list = [
+                    (file_path, column_name, output_dir, plot_dir, start_date, end_date, iso_params, model_options,
+                     result_cache_dir, frame_prefix)
+                    for file_path in all_files
+                ]
 
         # Processing with progress tracking
         start_time = time.time()
@@ -258,50 +443,108 @@ def batch_mode():
             status_text = st.empty()
 
         results = []
+        timings = []
         success_count = 0
-
-        with multiprocessing.Pool(num_processes) as pool:
-            for i, result in enumerate(pool.imap_unordered(process_file_streamlit, args_list)):
-                results.append(result)
-                if not result.startswith("Error"):
-                    success_count += 1
-
-                # Update progress
-                progress = (i + 1) / len(args_list)
-                progress_bar.progress(progress)
-                status_text.text(f"Processed {i + 1}/{len(args_list)} files | Success: {success_count}")
+        # {counter: {proxy: anomaly frame}}, received from the workers; stored once, after the run
+        frames = defaultdict(dict)
+
+        # Largest proxies (or chunks of proxies) are started first so one big task doesn't finish alone at the end
+        if vectorized:
+            tasks = [(args[0][0], args, sum(path_size_bytes(f) for f in args[0])) for args in args_list]
+            task_memory_mb = max(task[2] for task in tasks) / (1024 * 1024) * DETECT_MEMORY_EXPANSION
+        else:
+            tasks = [(args[0], args) for args in args_list]
+            task_memory_mb = largest_task_memory_mb(all_files, DETECT_MEMORY_EXPANSION)
+        # Auto: as many workers as cores allow and the largest task fits in memory
+        pool_size = int(num_processes) or choose_pool_size(len(args_list), task_memory_mb=task_memory_mb)
+        # The dashboard's warm workers are reused (only restarted when resized or unhealthy) and held for
+        # the whole run; a run started while another holds them gets its own pool
+        with dashboard_pool().lease() as warm:
+            pool = warm.get(pool_size)
+            if hybrid and not vectorized:
+                # iso_params is the 7th field of every per-file task
+                scheduled = iter_hybrid(
+                    pool, process_func, tasks, "detect", lambda args, jobs: (*args[:6], dict(args[6], n_jobs=jobs), *args[7:]),
+                    pool_size, max_cores=int(num_processes) or None, check=warm.check
+                )
+            else:
+                scheduled = iter_scheduled(pool, process_func, tasks, kind="detect-batched" if vectorized else "detect", check=warm.check)
+            finished = False
+            try:
+                for file_path, result, seconds in scheduled:
+                    # Vectorized tasks cover a chunk of files and report one result per file
+                    chunk_results = result if isinstance(result, list) else [result]
+                    for chunk_result in chunk_results:
+                        if isinstance(chunk_result, str):
+                            results.append(chunk_result)
+                            continue
+                        proxy_name = proxy_name_from_path(chunk_result["file"])
+                        for counter, handle in chunk_result["outputs"]:
+                            frames[counter][proxy_name] = receive_frame(handle)
+                        results.append(chunk_result["file"])
+                        success_count += 1
+                    timings.append({"proxy": proxy_name_from_path(file_path), "seconds": round(seconds, 2)})
+
+                    # Update progress
+                    progress = len(results) / len(all_files)
+                    progress_bar.progress(progress)
+                    status_text.text(f"Processed {len(results)}/{len(all_files)} files | Success: {success_count}")
+                finished = True
+            except RuntimeError as e:
+                # A worker died mid-task; files it had are counted as errors
+                st.error(str(e))
+            finally:
+                if not finished:
+                    # A dead worker or a rerun left tasks queued whose results nobody will receive: stop them
+                    warm.restart()
+                release_frames(frame_prefix)
 
         elapsed = time.time() - start_time
 
+        # Each counter is appended to the anomaly store in one write, in the background, while the summaries below use the frames
+        writer = AsyncResultWriter()
+        for counter, proxy_frames in frames.items():
+            writer.submit(write_anomalies, proxy_frames, direction, counter, start_date, end_date)
+            if prerender_top:
+                counts = {proxy_name: len(frame) for proxy_name, frame in proxy_frames.items()}
+                writer.submit(prerender_plots, f"{plot_dir_base}_{counter}", counter, counts, int(prerender_top))
+
         # Results summary
         with status_container:
             st.markdown("### Processing Results")
             col1, col2, col3, col4 = st.columns(4)
 
             with col1:
-                st.metric("Total Files", len(args_list))
+                st.metric("Total Files", len(all_files))
             with col2:
                 st.metric("Successful", success_count)
             with col3:
-                st.metric("Errors", len(args_list) - success_count)
+                st.metric("Errors", len(all_files) - success_count)
             with col4:
                 st.metric("Time (seconds)", f"{elapsed:.1f}")
 
+            with st.expander(f"Per-proxy timings ({pool_size} processes)"):
+                st.dataframe(
+                    pd.DataFrame(timings).sort_values("seconds", ascending=False), use_container_width=True
+                )
+
         # Success message
         if success_count > 0:
-            st.success(f"Successfully processed {success_count} files! Output saved to '{output_dir}'")
-            st.info(f"Plots saved in the folder: '{plot_dir}'")
+            st.success(f"Successfully processed {success_count} files! Anomalies stored in '{counter_dir(direction, counter_choice)}'")
+            st.info(f"Plot data saved in the folder: '{plot_dir}'; plots are drawn when a proxy is selected below")
 
             # Generate summary
             with st.spinner("Generating summary report..."):
+                for summary_counter in column_names:
+                    if summary_counter != counter_choice:
+                        summarize_anomaly_frames(frames[summary_counter].items(), f"final_summary_{summary_counter}.csv")
                 summary_output_file = f"final_summary_{counter_choice}.csv"
-                generate_proxy_summary(output_dir, summary_output_file)
+                df_summary = summarize_anomaly_frames(frames[counter_choice].items(), summary_output_file)
                 st.success(f"Summary report saved to {summary_output_file}")
 
                 # Show summary preview
-                if os.path.exists(summary_output_file):
+                if df_summary is not None:
                     st.markdown("**Summary Preview**")
-                    df_summary = pd.read_csv(summary_output_file)
                     st.dataframe(df_summary, use_container_width=True)
                     csv_data = df_summary.to_csv(index=False)
                     st.download_button(
@@ -316,15 +559,16 @@ def batch_mode():
             # --- Store batch state in session_state for persistent navigation ---
             st.session_state["batch_done"] = True
             st.session_state["batch_state"] = {
-                "output_dir": output_dir,
                 "counter_choice": counter_choice,
                 "direction": direction
             }
+            # Later navigation reads these instead of the anomaly store
+            st.session_state["batch_frames"] = frames[counter_choice]
 
-            batch_individual_analysis(output_dir, counter_choice, direction)
+            batch_individual_analysis(counter_choice, direction, frames[counter_choice])
 
         # Show errors if any
-        error_logs = [r for r in results if isinstance(r, str) and r.startswith("Error")]
+        error_logs = [r for r in results if isinstance(r, str) and r.startswith("Error")] + writer.wait()
         if error_logs:
             with st.expander(f"View {len(error_logs)} Error(s)"):
                 for err in error_logs:
@@ -333,31 +577,22 @@ def batch_mode():
     # --- If batch was previously run, allow navigation without rerunning batch ---
     elif batch_done and batch_state:
         batch_individual_analysis(
-            batch_state["output_dir"],
             batch_state["counter_choice"],
-            batch_state["direction"]
+            batch_state["direction"],
+            st.session_state.get("batch_frames")
         )
 
 
-def batch_individual_analysis(output_dir, counter_choice, direction):
+def batch_individual_analysis(counter_choice, direction, frames=None):
+    """frames ({proxy: anomaly frame}) are the batch's results in memory; without them the anomaly store is read"""
     st.markdown('<div class="section-header">Analyze Individual Proxy (from Batch Output)</div>', unsafe_allow_html=True)
 
-    # Get all proxies from the batch output directory
-    if not os.path.exists(output_dir):
-        st.warning(f"No output directory found: {output_dir}")
+    # Proxies of the batch, or every proxy the store has results for (from its index)
+    all_proxies = list(frames) if frames else list(list_proxies(direction, counter_choice))
+    if not all_proxies:
+        st.warning(f"No stored anomalies found for {direction}/{counter_choice}")
         return
 
-    # List all CSVs in output_dir, strip .csv and trailing _{counter_choice} if present
-    all_proxies = []
-    for fname in os.listdir(output_dir):
-        if fname.endswith('.csv'):
-            proxy_id = fname[:-4]
-            # Remove trailing _{counter_choice} if present
-            suffix = f"_{counter_choice}"
-            if proxy_id.endswith(suffix):
-                proxy_id = proxy_id[: -len(suffix)]
-            all_proxies.append(proxy_id)
-
     # Only keep proxies for which the plot file exists
     if direction == "inbound":
         plot_dir = f"anomaly_plots_inbound_{counter_choice}"
@@ -366,8 +601,7 @@ def batch_individual_analysis(output_dir, counter_choice, direction):
 
     proxies_with_plot = []
     for proxy_id in all_proxies:
-        plot_file_html = os.path.join(plot_dir, f"{proxy_id}_{counter_choice}_plot.html")
-        if os.path.exists(plot_file_html):
+        if any(os.path.exists(plot_file_path(plot_dir, proxy_id, counter_choice, plot_format)) for plot_format in ("data", "html")):
             proxies_with_plot.append(proxy_id)
 
     if not proxies_with_plot:
@@ -388,36 +622,42 @@ def batch_individual_analysis(output_dir, counter_choice, direction):
         proxies = sorted(hierarchy[city][nf_type])
         proxy_id = st.selectbox("Proxy ID", proxies, key="batch_ind_proxy")
 
-    # File path for selected proxy (add back _{counter_choice})
-    proxy_file = os.path.join(output_dir, f"{proxy_id}_{counter_choice}.csv")
-    if not os.path.exists(proxy_file):
-        st.error(f"Proxy file not found: {proxy_file}")
-        return
-
     # Show preview and download
     st.markdown("---")
     st.markdown("**Anomaly Data Preview**")
-    df_results = pd.read_csv(proxy_file)
+    if frames and proxy_id in frames:
+        df_results = frames[proxy_id]
+    else:
+        df_results = read_anomalies(direction, counter_choice, proxies=[proxy_id])
     st.dataframe(df_results.head(100), use_container_width=True)
     st.metric("Total Anomalies", len(df_results))
-    st.metric("Output File", proxy_file)
+    st.metric("Stored In", counter_dir(direction, counter_choice))
 
     csv_data = df_results.to_csv(index=False)
     st.download_button(
         label="Download Results CSV",
         data=csv_data,
-        file_name=os.path.basename(proxy_file),
+        file_name=f"{proxy_id}_{counter_choice}.csv",
         mime="text/csv",
         use_container_width=True,
         key=f"batch_proxy_download_{proxy_id}"
     )
 
-    # Show plot (guaranteed to exist)
-    plot_file_html = os.path.join(plot_dir, f"{proxy_id}_{counter_choice}_plot.html")
+    # Show plot (guaranteed to exist): pre-rendered HTML when it is at least as new as the plot data,
+    # otherwise drawn from the plot data now
+    plot_file_html = plot_file_path(plot_dir, proxy_id, counter_choice, "html")
+    plot_file_data = plot_file_path(plot_dir, proxy_id, counter_choice, "data")
     st.markdown("**Anomaly Detection Plot**")
-    with open(plot_file_html, "r") as f:
-        plot_html = f.read()
-    html(plot_html, height=500)
+    if os.path.exists(plot_file_html) and (
+        not os.path.exists(plot_file_data) or os.path.getmtime(plot_file_html) >= os.path.getmtime(plot_file_data)
+    ):
+        with open(plot_file_html, "r") as f:
+            plot_html = f.read()
+        html(plot_html, height=500)
+    else:
+        st.plotly_chart(
+            anomaly_figure(load_plot_data(plot_file_data), counter_choice), use_container_width=True, config=PLOT_CONFIG
+        )
 
 
 def individual_mode():
@@ -438,11 +678,10 @@ def individual_mode():
 
         with col2:
             st.markdown("**Column Name**")
+            data_folder = get_input_dir(direction)
             if direction == "inbound":
-                data_folder = "individual_proxy_inbound"
                 counter_options = inbound_counters
             else:
-                data_folder = "individual_proxy_outbound"
                 counter_options = outbound_counters
             column_name = st.selectbox("Select column name", counter_options, key="ind_column")
 
@@ -458,6 +697,13 @@ def individual_mode():
         with col3:
             bootstrap = st.checkbox("bootstrap", value=True, key="ind_bootstrap")
             random_state = st.number_input("random_state", min_value=0, max_value=9999, value=42, step=1, key="ind_random_state")
+            prescreen = st.checkbox(
+                "Prescreen", value=False, key="ind_prescreen",
+                help="Score only minutes a rolling/robust z-score marks as candidates, plus a background sample "
+                     "for the threshold; check recall with 'python prescreen.py <folder> <counter>'"
+            )
+        model_options = model_cache_controls("ind", direction)
+        result_cache_dir = result_cache_controls("ind")
 
     iso_params = dict(
         n_estimators=int(n_estimators),
@@ -466,7 +712,8 @@ def individual_mode():
         max_features=float(max_features),
         bootstrap=bootstrap,
         n_jobs=1,
-        random_state=int(random_state)
+        random_state=int(random_state),
+        prescreen=prescreen
     )
 
     # Proxy selection
@@ -508,16 +755,17 @@ def individual_mode():
     end_date = end_date.strftime("%Y-%m-%d") if end_date else None
 
     # File existence check only (no preview)
-    excel_file = os.path.join(data_folder, f"{proxy_id}.csv")
+    excel_file = list_proxy_paths(data_folder).get(proxy_id, os.path.join(data_folder, f"{proxy_id}.csv"))
     if os.path.exists(excel_file):
-        st.success(f"Data file found: {proxy_id}.csv")
+        st.success(f"Data found: {os.path.basename(excel_file)}")
         # Warn if file is very large
-        try:
-            row_count = sum(1 for _ in open(excel_file, encoding="utf-8")) - 1
-            if row_count > 1_000_000:
-                st.warning(f"Selected file has {row_count:,} rows. Plotting may be slow or limited to a sample for performance.")
-        except Exception:
-            pass
+        if excel_file.endswith(".csv"):
+            try:
+                row_count = sum(1 for _ in open(excel_file, encoding="utf-8")) - 1
+                if row_count > 1_000_000:
+                    st.warning(f"Selected file has {row_count:,} rows. Plotting may be slow or limited to a sample for performance.")
+            except Exception:
+                pass
     else:
         st.error(f"Data file not found: {excel_file}")
         return
@@ -542,17 +790,24 @@ def individual_mode():
             step_progress.progress(0.33)
 
             try:
-                step2_output = detect_anomalies_ind(
-                    excel_file, column_name, plot_dir=plot_dir,
-                    start_date=start_date, end_date=end_date, **iso_params
+                # A rerun with the same input, counter, range and parameters restores the stored output and plot
+                plot_file_html = os.path.join(plot_dir, f"{proxy_id}_{column_name}_plot.html")
+                step2_output = cached_run(
+                    result_key(excel_file, column_name, start_date, end_date, {**iso_params, **model_options}, engine="monthend"),
+                    lambda: detect_anomalies_ind(
+                        excel_file, column_name, plot_dir=plot_dir,
+                        start_date=start_date, end_date=end_date, **iso_params, **model_options
+                    ),
+                    artifacts=lambda output_file: [output_file, plot_file_html], cache_dir=result_cache_dir
                 )
 
                 # Step 2: Filtering
                 step_status.info("Step 2/3: Filtering anomalies...")
                 step_progress.progress(0.66)
 
-                final_output = os.path.join("anomaly_excels", direction, f"{proxy_id}_{column_name}.csv")
-                filter_anomalies_ind(step2_output, final_output, column_name=column_name)
+                final_output = filter_anomalies_ind(
+                    step2_output, f"{proxy_id}_{column_name}.csv", column_name=column_name, start_date=start_date, end_date=end_date
+                )
 
                 # Step 3: Results
                 step_status.info("Step 3/3: Preparing results...")
@@ -565,13 +820,14 @@ def individual_mode():
 
                 # Show filtered results
                 if os.path.exists(final_output):
-                    df_results = pd.read_csv(final_output)
+                    # Only this run's days, not every stored run of the proxy
+                    df_results = read_anomalies(direction, column_name, proxies=[proxy_id], start_date=start_date, end_date=end_date)
 
                     col1, col2 = st.columns(2)
                     with col1:
                         st.metric("Total Anomalies", len(df_results))
                     with col2:
-                        st.metric("Output File", final_output)
+                        st.metric("Stored In", final_output)
 
                     # Data preview
                     st.markdown("**Anomaly Data Preview**")
@@ -582,14 +838,13 @@ def individual_mode():
                     st.download_button(
                         label="Download Results CSV",
                         data=csv_data,
-                        file_name=os.path.basename(final_output),
+                        file_name=f"{proxy_id}_{column_name}.csv",
                         mime="text/csv",
                         use_container_width=True,
                         key=f"ind_proxy_download_{proxy_id}"
                     )
 
                 # Show plot
-                plot_file_html = os.path.join(plot_dir, f"{proxy_id}_{column_name}_plot.html")
                 if os.path.exists(plot_file_html):
                     st.markdown("**Anomaly Detection Plot**")
                     with open(plot_file_html, "r") as f:
@@ -604,31 +859,71 @@ def individual_mode():
                 step_status.empty()
 
 
-def run_preprocessing(direction, num_processes):
+def run_preprocessing(direction, num_processes, output_format="csv", memory_budget_mb=None, incremental=True,
+                      write_binary=False, dense_grid=False, duplicate_policy="last", update_baselines=True):
     # Dynamically import the unified preprocessing module
     preprocess = importlib.import_module("unified_preprocess")
     try:
-        result = preprocess.run_preprocessing(direction, num_processes)
-        return result
+        # "both" ingests inbound and outbound together on one shared pool
+        directions = ("inbound", "outbound") if direction == "both" else (direction,)
+        # Held for the whole run, like batch detection
+        with dashboard_pool().lease() as warm:
+            return preprocess.run_preprocessing_all(
+                directions, num_processes, output_format, memory_budget_mb, incremental, write_binary, dense_grid, duplicate_policy,
+                update_baselines, warm_pool=warm
+            )
     except Exception as e:
         return f"Error: {e}"
 
 
 def preprocessing_tab():
     st.markdown('<div class="section-header">Data Preprocessing</div>', unsafe_allow_html=True)
-    st.info("Preprocess raw inbound or outbound data files into per-proxy files for anomaly detection.")
+    st.info("Preprocess raw inbound and/or outbound data files into per-proxy files for anomaly detection.")
 
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     with col1:
-        direction = st.selectbox("Select Data Direction", ["inbound", "outbound"], key="preprocess_direction")
+        direction = st.selectbox("Select Data Direction", ["inbound", "outbound", "both"], key="preprocess_direction")
     with col2:
         num_processes = st.number_input(
-            "Number of processes", min_value=1, max_value=os.cpu_count(), value=min(8, os.cpu_count()), key="preprocess_num_proc"
+            "Number of processes (0 = auto)", min_value=0, max_value=os.cpu_count(), value=0, key="preprocess_num_proc"
+        )
+    with col3:
+        output_format = st.selectbox(
+            "Output Format", ["csv", "parquet"], key="preprocess_output_format",
+            help="parquet writes a partitioned proxy/date dataset in one pass, without the temp-file merge"
+        )
+    memory_budget_mb = st.number_input(
+        "Memory budget per worker (MB, 0 = load each raw file whole)", min_value=0, max_value=65536, value=0, step=128,
+        key="preprocess_memory_budget"
+    )
+    incremental = st.checkbox(
+        "Incremental (only ingest new or changed raw files)", value=True, key="preprocess_incremental"
+    )
+    write_binary = st.checkbox(
+        "Also write memory-mapped binary series (fastest loading for detection)", value=False, key="preprocess_write_binary"
+    )
+    update_baselines = st.checkbox(
+        "Update seasonal baselines", value=True, key="preprocess_update_baselines",
+        help="Per-proxy hour-of-week quantiles; only new days are computed for proxies that were appended to"
+    )
+    col4, col5 = st.columns(2)
+    with col4:
+        dense_grid = st.checkbox(
+            "Dense one-minute grid", value=False, key="preprocess_dense_grid",
+            help="One row per minute in the merged CSVs and binary series, gaps marked with is_missing"
+        )
+    with col5:
+        duplicate_policy = st.selectbox(
+            "Duplicate minutes", ["last", "first", "max", "mean"], key="preprocess_duplicate_policy",
+            help="How several rows for the same proxy and minute are combined"
         )
 
     if st.button("Run Preprocessing", type="primary", use_container_width=True):
         with st.spinner(f"Running preprocessing for {direction}..."):
-            result = run_preprocessing(direction, int(num_processes))
+            result = run_preprocessing(
+                direction, int(num_processes) or None, output_format, int(memory_budget_mb) or None, incremental, write_binary,
+                dense_grid, duplicate_policy, update_baselines
+            )
             if isinstance(result, str) and result.startswith("Error"):
                 st.error(result)
             else:
@@ -639,6 +934,7 @@ def preprocessing_tab():
 def main():
     # Header
     st.markdown('<div class="main-header">Proxy Anomaly Detection Dashboard</div>', unsafe_allow_html=True)
+    worker_pool_controls()
 
     # Navigation bar at the top using tabs (Preprocessing first)
     tabs = st.tabs(["Preprocessing", "Batch Processing", "Individual Analysis"])
@@ -3,6 +3,9 @@ import os
 import glob
 import time
 
+from schema import read_result_csv
+from anomaly_store import ANOMALY_STORE_DIR, counter_dir, read_anomalies
+
 # Parameters for burst/plateau detection
 TIME_WINDOW_MINUTES = 10  # window size in minutes
 BURST_THRESHOLD = 3       # anomalies >= this in window => burst
@@ -62,20 +65,41 @@ def extract_plateaus(df, time_col='Timestamp'):
             i += 1
     return plateaus
 
+def _read_result_files(directory_path):
+    for file in glob.glob(os.path.join(directory_path, '*.csv')):
+        try:
+            # Only the columns the summary uses, typed, with timestamps parsed once
+            yield file, read_result_csv(file, columns=['Timestamp', 'ProxyId'])
+        except Exception as e:
+            print(f"Error processing file {file}: {str(e)}")
+
 def generate_proxy_summary(directory_path, output_file):
+    return summarize_anomaly_frames(_read_result_files(directory_path), output_file)
+
+def generate_store_summary(direction, counter, output_file, store_dir=ANOMALY_STORE_DIR):
+    """generate_proxy_summary for a counter's anomalies in the anomaly store, read in one scan"""
+    df = read_anomalies(direction, counter, columns=['Timestamp', 'ProxyId'], store_dir=store_dir)
+    source = counter_dir(direction, counter, store_dir)
+    return summarize_anomaly_frames(((source, proxy_df) for _, proxy_df in df.groupby('ProxyId', observed=True)), output_file)
+
+def summarize_anomaly_frames(frames, output_file):
+    """generate_proxy_summary for anomaly frames already in memory, given as (source, frame) pairs
+
+    Returns the summary frame it saves, or None when there was nothing to summarize.
+    """
     all_data = []
     burst_plateau_data = []
     plateau_details = []
-    csv_files = glob.glob(os.path.join(directory_path, '*.csv'))
 
-    for file in csv_files:
+    for source, df in frames:
         try:
-            df = pd.read_csv(file)
-            df['date'] = pd.to_datetime(df['Timestamp']).dt.date
-            grouped = df.groupby(['ProxyId', 'date']).size().reset_index(name='count')
+            # Indexed like a freshly read result file; the burst/plateau scan mixes positions and labels
+            df = df[['Timestamp', 'ProxyId']].reset_index(drop=True)
+            df['date'] = df['Timestamp'].dt.date
+            grouped = df.groupby(['ProxyId', 'date'], observed=True).size().reset_index(name='count')
             all_data.append(grouped)
 
-            for (proxy, date), group in df.groupby(['ProxyId', 'date']):
+            for (proxy, date), group in df.groupby(['ProxyId', 'date'], observed=True):
                 burst, plateau = classify_bursts_plateaus(group)
                 burst_plateau_data.append({
                     'ProxyId': proxy,
@@ -97,7 +121,7 @@ def generate_proxy_summary(directory_path, output_file):
                     })
 
         except Exception as e:
-            print(f"Error processing file {file}: {str(e)}")
+            print(f"Error processing file {source}: {str(e)}")
             continue
 
     if not all_data:
@@ -137,4 +161,5 @@ def generate_proxy_summary(directory_path, output_file):
         plateau_df = pd.DataFrame(plateau_details)
         plateau_df = plateau_df.sort_values(['ProxyId', 'date', 'plateau_start'])
         plateau_df.to_csv("plateau_details.csv", index=False)
-        print("Plateau details saved to plateau_details.csv")
\ No newline at end of file
+        print("Plateau details saved to plateau_details.csv")
+    return merged
\ No newline at end of file
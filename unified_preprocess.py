@@ -2,108 +2,350 @@ import pandas as pd
 import os
 import glob
 import time
+import shutil
+import csv
+import json
+import heapq
+import hashlib
+from datetime import datetime, timedelta
 from multiprocessing import Pool
 
+from scheduler import choose_pool_size, format_timing_report, largest_task_memory_mb, run_scheduled
+
+import schema
+from schema import COUNTERS, TIMESTAMP_FORMAT
+
+from proxy_store import (
+    BINARY_META_FILE, DUPLICATE_POLICIES, MISSING_COLUMN, SERIES_META_SUFFIX, clear_day_partitions,
+    list_proxy_paths, load_proxy_frame, read_series_meta, sort_by_timestamp, timestamp_sort_key, write_binary_series,
+    write_day_partitions, write_series_meta
+)
+from seasonal_baseline import baseline_path, update_baseline_task
+
+# Chunked ingestion: parsing and the per-chunk groupby hold a few copies of each chunk
+CHUNK_MEMORY_OVERHEAD = 4
+CHUNK_SAMPLE_ROWS = 10000
+MIN_CHUNK_ROWS = 1000
+
+# Raw daily files may arrive compressed; pandas decompresses them as a stream while parsing.
+# Expansion factors are rough uncompressed/compressed ratios for CSV, used for cost and memory estimates
+RAW_FILE_SUFFIXES = {".csv": 1, ".csv.gz": 6, ".csv.zst": 6, ".csv.bz2": 8}
+
+# Raw files already ingested, per output folder, keyed by path with size/mtime/sha256
+MANIFEST_FILE = "preprocess_manifest.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
 CONFIG = {
     "inbound": {
         "input_folder": "inbound",
         "temp_base_folder": "temp_output_inbound",
         "final_output_folder": "individual_proxy_inbound",
-        "columns_to_extract": [
-            "Timestamp", "ProxyId",
-            "response1xxForwardedCounter",
-            "response2xxForwardedCounter",
-            "response3xxForwardedCounter",
-            "response4xxForwardedCounter",
-            "response5xxForwardedCounter",
-            "response400ForwardedCounter",
-            "response404ForwardedCounter",
-            "response408ForwardedCounter",
-            "response424ForwardedCounter",
-            "response429ForwardedCounter"
-        ],
-        "dtype_map": {
-            'ProxyId': 'category',
-            'response1xxForwardedCounter': 'Int32',
-            'response2xxForwardedCounter': 'Int32',
-            'response3xxForwardedCounter': 'Int32',
-            'response4xxForwardedCounter': 'Int32',
-            'response5xxForwardedCounter': 'Int32',
-            'response400ForwardedCounter': 'Int32',
-            'response404ForwardedCounter': 'Int32',
-            'response408ForwardedCounter': 'Int32',
-            'response424ForwardedCounter': 'Int32',
-            'response429ForwardedCounter': 'Int32'
-        }
+        "dataset_folder": "dataset_inbound",
+        "binary_folder": "binary_proxy_inbound",
+        "baseline_folder": "seasonal_baseline_inbound",
+        "columns_to_extract": schema.columns_to_extract("inbound"),
+        "dtype_map": schema.dtype_map("inbound")
     },
     "outbound": {
         "input_folder": "outbound",
         "temp_base_folder": "temp_output_outbound",
         "final_output_folder": "individual_proxy_outbound",
-        "columns_to_extract": [
-            "Timestamp", "ProxyId",
-            "response1xxReceivedCounter",
-            "response2xxReceivedCounter",
-            "response3xxReceivedCounter",
-            "response4xxReceivedCounter",
-            "response5xxReceivedCounter",
-            "response400ReceivedCounter",
-            "response404ReceivedCounter",
-            "response408ReceivedCounter",
-            "response424ReceivedCounter",
-            "response429ReceivedCounter"
-        ],
-        "dtype_map": {
-            'ProxyId': 'category',
-            'response1xxReceivedCounter': 'Int32',
-            'response2xxReceivedCounter': 'Int32',
-            'response3xxReceivedCounter': 'Int32',
-            'response4xxReceivedCounter': 'Int32',
-            'response5xxReceivedCounter': 'Int32',
-            'response400ReceivedCounter': 'Int32',
-            'response404ReceivedCounter': 'Int32',
-            'response408ReceivedCounter': 'Int32',
-            'response424ReceivedCounter': 'Int32',
-            'response429ReceivedCounter': 'Int32'
-        }
+        "dataset_folder": "dataset_outbound",
+        "binary_folder": "binary_proxy_outbound",
+        "baseline_folder": "seasonal_baseline_outbound",
+        "columns_to_extract": schema.columns_to_extract("outbound"),
+        "dtype_map": schema.dtype_map("outbound")
     }
 }
 
+def find_raw_files(input_folder):
+    # One file per day: a day found both plain and compressed would be ingested twice into the
+    # same day folder, so only its newest file is used
+    files_by_day = {}
+    for suffix in RAW_FILE_SUFFIXES:
+        for file_path in glob.glob(os.path.join(input_folder, f"*{suffix}")):
+            files_by_day.setdefault(raw_day_name(file_path), []).append(file_path)
+    all_files = []
+    for day_name, day_files in files_by_day.items():
+        newest = max(day_files, key=lambda f: (os.path.getmtime(f), f))
+        ignored = sorted(f for f in day_files if f != newest)
+        if ignored:
+            print(f"Warning: several raw files for {day_name}; using {newest}, ignoring {', '.join(ignored)}")
+        all_files.append(newest)
+    return sorted(all_files)
+
+def _raw_suffix(file_path):
+    # Longest match first so "x.csv.gz" is not taken for a plain ".csv"
+    for suffix in sorted(RAW_FILE_SUFFIXES, key=len, reverse=True):
+        if file_path.endswith(suffix):
+            return suffix
+    return ""
+
+def raw_day_name(file_path):
+    base = os.path.basename(file_path)
+    suffix = _raw_suffix(base)
+    return base[:-len(suffix)] if suffix else base
+
+def raw_size_bytes(file_path):
+    # Estimated uncompressed size, which is what parsing time and memory scale with
+    return os.path.getsize(file_path) * RAW_FILE_SUFFIXES.get(_raw_suffix(file_path), 1)
+
+def estimate_chunk_rows(file_path, columns_to_extract, dtype_map, memory_budget_mb):
+    # Size chunks from the in-memory footprint of a sample of rows
+    sample = pd.read_csv(file_path, usecols=columns_to_extract, dtype=dtype_map, nrows=CHUNK_SAMPLE_ROWS)
+    if sample.empty:
+        return CHUNK_SAMPLE_ROWS
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    budget_bytes = memory_budget_mb * 1024 * 1024
+    return max(MIN_CHUNK_ROWS, int(budget_bytes / (bytes_per_row * CHUNK_MEMORY_OVERHEAD)))
+
+def read_raw_chunks(file_path, columns_to_extract, dtype_map, memory_budget_mb=None):
+    # Whole file at once when no budget is set, otherwise fixed-size chunks that fit the budget
+    read_kwargs = dict(
+        usecols=columns_to_extract,
+        dtype=dtype_map,
+        parse_dates=["Timestamp"],
+        date_format="%Y-%m-%d %H:%M:%S"
+    )
+    if not memory_budget_mb:
+        yield pd.read_csv(file_path, **read_kwargs)
+        return
+
+    chunk_rows = estimate_chunk_rows(file_path, columns_to_extract, dtype_map, memory_budget_mb)
+    with pd.read_csv(file_path, chunksize=chunk_rows, **read_kwargs) as reader:
+        for chunk in reader:
+            yield chunk
+
 def process_one_file(args):
-    file_path, temp_base_folder, columns_to_extract, dtype_map = args
+    file_path, temp_base_folder, columns_to_extract, dtype_map, memory_budget_mb = args
+    day_output_folder = None
     try:
-        day_name = os.path.basename(file_path).replace(".csv", "")
+        day_name = raw_day_name(file_path)
         day_output_folder = os.path.join(temp_base_folder, day_name)
         os.makedirs(day_output_folder, exist_ok=True)
+        # A re-ingested day replaces its previous per-proxy pieces entirely
+        for stale_file in glob.glob(os.path.join(day_output_folder, "*.csv")):
+            os.remove(stale_file)
 
-        df = pd.read_csv(
-            file_path,
-            usecols=columns_to_extract,
-            dtype=dtype_map,
-            parse_dates=["Timestamp"],
-            date_format="%Y-%m-%d %H:%M:%S"
-        )
+        # Rows are routed to per-proxy files as each chunk arrives; the first chunk
+        # holding a proxy creates its file, later chunks append without a header
+        started_proxies = set()
+        multi_chunk_proxies = set()
+        for df in read_raw_chunks(file_path, columns_to_extract, dtype_map, memory_budget_mb):
+            for proxy_id, group_df in df.groupby("ProxyId", observed=True):
+                safe_proxy_id = str(proxy_id).replace("/", "_").replace("\\", "_")
+                output_path = os.path.join(day_output_folder, f"{safe_proxy_id}.csv")
+                is_new = safe_proxy_id not in started_proxies
+                sort_by_timestamp(group_df).to_csv(output_path, mode="w" if is_new else "a", header=is_new, index=False)
+                started_proxies.add(safe_proxy_id)
+                if not is_new:
+                    multi_chunk_proxies.add(safe_proxy_id)
 
-        for proxy_id, group_df in df.groupby("ProxyId", observed=True):
-            safe_proxy_id = str(proxy_id).replace("/", "_").replace("\\", "_")
+        # Day pieces must each be time-sorted for the merge; pieces built from several chunks are re-sorted
+        for safe_proxy_id in multi_chunk_proxies:
             output_path = os.path.join(day_output_folder, f"{safe_proxy_id}.csv")
-            group_df.to_csv(output_path, index=False)
+            piece_df = pd.read_csv(output_path, dtype=str, keep_default_na=False)
+            sort_by_timestamp(piece_df).to_csv(output_path, index=False)
 
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
+        # Partial pieces of a failed day must not be merged
+        if day_output_folder:
+            shutil.rmtree(day_output_folder, ignore_errors=True)
+        return None
     else:
         print(f"Done: {file_path}")
+        return file_path
+
+def process_one_file_to_dataset(args):
+    file_path, dataset_folder, columns_to_extract, dtype_map, memory_budget_mb = args
+    day_name = None
+    try:
+        day_name = raw_day_name(file_path)
+
+        # Each chunk becomes one more part file in the day's partitions
+        clear_day_partitions(dataset_folder, day_name)
+        for part, df in enumerate(read_raw_chunks(file_path, columns_to_extract, dtype_map, memory_budget_mb)):
+            write_day_partitions(df, dataset_folder, day_name, part=part)
 
-def merge_one_proxy(proxy_file_and_paths, final_output_folder):
+    except Exception as e:
+        print(f"Error processing {file_path}: {e}")
+        # Partial partitions of a failed day must not be read
+        if day_name:
+            clear_day_partitions(dataset_folder, day_name)
+        return None
+    else:
+        print(f"Done: {file_path}")
+        return file_path
+
+def _sorted_piece_rows(file_path):
+    # (sort key, row) for every row of a time-sorted day piece, streamed from disk
+    with open(file_path, "r", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        timestamp_index = header.index("Timestamp")
+        for row in reader:
+            yield timestamp_sort_key(row[timestamp_index]), row
+
+def _piece_header(file_path):
+    with open(file_path, "r", newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), None)
+
+def _key_minute(key):
+    # Sort keys of well-formed timestamps are YYYYmmddHHMM; anything else can't be placed on the grid
+    if len(key) == 12 and key.isdigit():
+        return datetime.strptime(key, "%Y%m%d%H%M")
+    return None
+
+def _format_number(value):
+    return str(int(value)) if value == int(value) else repr(value)
+
+def _resolve_duplicate_rows(group, duplicates, counter_indexes):
+    """One row for several rows with the same timestamp, in piece order"""
+    if duplicates == "last":
+        return group[-1]
+    if duplicates == "first":
+        return group[0]
+    row = list(group[-1])
+    for index in counter_indexes:
+        values = [float(r[index]) for r in group if r[index] != ""]
+        if values:
+            row[index] = _format_number(max(values) if duplicates == "max" else sum(values) / len(values))
+    return row
+
+def kway_merge_pieces(file_list, output_file, mode="w", dense=False, duplicates="last", previous_key=None):
+    """Stream already-sorted day pieces into one time-ordered file with one row per timestamp
+
+    Only one row per piece (plus one timestamp's duplicates) is held in memory. Rows sharing a
+    timestamp are resolved by the duplicates policy, by default keeping the latest piece's row.
+    With dense=True every minute between samples gets a row, gaps filled with empty counters and
+    is_missing set; previous_key continues the grid from a file being appended to.
+    Returns the rows written, duplicates dropped, minutes filled, first/last sort keys and the
+    byte offset where each day's rows start (day_offsets, {YYYYmmdd: offset}).
+    """
+    if duplicates not in DUPLICATE_POLICIES:
+        raise ValueError(f"unknown duplicate policy '{duplicates}'")
+    headers = [h for h in (_piece_header(f) for f in file_list) if h is not None]
+    if any(h != headers[0] for h in headers):
+        raise ValueError("day pieces have different columns")
+    header = headers[0] if headers else []
+    fixed_columns = ("Timestamp", "ProxyId")
+    counter_indexes = [i for i, col in enumerate(header) if col not in fixed_columns]
+
+    stats = {"rows": 0, "duplicates_removed": 0, "missing_filled": 0, "first_key": None, "last_key": None, "day_offsets": {}}
+    previous_minute = _key_minute(previous_key) if previous_key else None
+    previous_day = previous_key[:8] if previous_key else None
+    with open(output_file, mode, newline="", encoding="utf-8") as out:
+        writer = csv.writer(out, lineterminator=os.linesep)
+        if mode == "w" and headers:
+            writer.writerow(header + [MISSING_COLUMN] if dense else header)
+
+        def mark_day(key):
+            # Rows are written in time order, so a day's rows run from its offset to the next day's
+            nonlocal previous_day
+            day = key[:8]
+            if day != previous_day and _key_minute(key) is not None:
+                stats["day_offsets"][day] = out.tell()
+                previous_day = day
+
+        def write_row(key, row):
+            nonlocal previous_minute
+            if dense:
+                minute = _key_minute(key)
+                if minute is not None and previous_minute is not None:
+                    # Empty rows for every minute with no sample since the previous row
+                    for step in range(1, int((minute - previous_minute) / timedelta(minutes=1))):
+                        gap_minute = previous_minute + timedelta(minutes=step)
+                        mark_day(gap_minute.strftime("%Y%m%d%H%M"))
+                        gap_row = [""] * len(header)
+                        gap_row[header.index("Timestamp")] = gap_minute.strftime(TIMESTAMP_FORMAT)
+                        if "ProxyId" in header:
+                            gap_row[header.index("ProxyId")] = row[header.index("ProxyId")]
+                        writer.writerow(gap_row + [True])
+                        stats["missing_filled"] += 1
+                        stats["rows"] += 1
+                if minute is not None:
+                    previous_minute = minute
+                row = row + [False]
+            mark_day(key)
+            writer.writerow(row)
+            stats["rows"] += 1
+            stats["first_key"] = stats["first_key"] or key
+            stats["last_key"] = key
+
+        pending_key, pending_rows = None, []
+        for key, row in heapq.merge(*[_sorted_piece_rows(f) for f in file_list], key=lambda item: item[0]):
+            if pending_rows and pending_key == key:
+                stats["duplicates_removed"] += 1
+                pending_rows.append(row)
+                continue
+            if pending_rows:
+                write_row(pending_key, _resolve_duplicate_rows(pending_rows, duplicates, counter_indexes))
+            pending_key, pending_rows = key, [row]
+        if pending_rows:
+            write_row(pending_key, _resolve_duplicate_rows(pending_rows, duplicates, counter_indexes))
+    return stats
+
+def merge_one_proxy(proxy_file_and_paths, final_output_folder, dense=False, duplicates="last"):
     proxy_file, file_list = proxy_file_and_paths
     try:
-        combined_df = pd.concat([pd.read_csv(f) for f in file_list])
-        combined_df.to_csv(os.path.join(final_output_folder, proxy_file), index=False)
+        output_path = os.path.join(final_output_folder, proxy_file)
+        tmp_path = f"{output_path}.tmp"
+        stats = kway_merge_pieces(file_list, tmp_path, dense=dense, duplicates=duplicates)
+        os.replace(tmp_path, output_path)
+        write_series_meta(output_path, dict(stats, sorted=True, dense=dense, duplicate_policy=duplicates))
         print(f"Merged: {proxy_file}")
+        return "merged"
     except Exception as e:
         print(f"Error merging {proxy_file}: {e}")
 
-def merge_all_proxy_files_parallel(temp_base_folder, final_output_folder, num_processes):
+def append_one_proxy(proxy_file_and_paths, final_output_folder, dense=False, duplicates="last"):
+    proxy_file, new_file_list, all_file_list = proxy_file_and_paths
+    try:
+        output_path = os.path.join(final_output_folder, proxy_file)
+        meta = read_series_meta(output_path)
+        first_keys = [key for key, _ in (next(_sorted_piece_rows(f), (None, None)) for f in new_file_list) if key is not None]
+        # New days can only be appended when they all start after the merged history ends and the file
+        # was written with the same grid settings; anything else goes through a full merge
+        if (not meta.get("sorted") or meta.get("last_key") is None or (first_keys and min(first_keys) <= meta["last_key"])
+                or meta.get("dense", False) != dense or meta.get("duplicate_policy", "last") != duplicates):
+            return merge_one_proxy((proxy_file, all_file_list), final_output_folder, dense, duplicates)
+        stats = kway_merge_pieces(new_file_list, output_path, mode="a", dense=dense, duplicates=duplicates,
+                                  previous_key=meta["last_key"])
+        meta = dict(
+            meta,
+            rows=meta.get("rows", 0) + stats["rows"],
+            duplicates_removed=meta.get("duplicates_removed", 0) + stats["duplicates_removed"],
+            missing_filled=meta.get("missing_filled", 0) + stats["missing_filled"],
+            last_key=stats["last_key"] or meta["last_key"]
+        )
+        # A day index is only kept when it covers the existing rows too
+        if "day_offsets" in meta:
+            meta["day_offsets"] = {**stats["day_offsets"], **meta["day_offsets"]}
+        write_series_meta(output_path, meta)
+        print(f"Appended: {proxy_file}")
+        return "appended"
+    except Exception as e:
+        print(f"Error appending {proxy_file}: {e}")
+
+def _merge_task(task):
+    action, item, final_output_folder, dense, duplicates = task
+    # What actually happened ("merged" or "appended", None on error), so later phases know what was rewritten
+    if action == "append":
+        return append_one_proxy(item, final_output_folder, dense, duplicates)
+    return merge_one_proxy(item, final_output_folder, dense, duplicates)
+
+def _grid_settings_differ(output_path, dense, duplicates):
+    meta = read_series_meta(output_path)
+    if not meta:
+        return False
+    return meta.get("dense", False) != dense or (dense and meta.get("duplicate_policy", "last") != duplicates)
+
+def plan_merge_tasks(temp_base_folder, final_output_folder, new_days=None, changed_days=None, changed_day_proxies=None,
+                     dense=False, duplicates="last"):
+    """Scheduler tasks (output path, _merge_task args, bytes to read) for the proxies that need merging"""
     day_folders = sorted(os.listdir(temp_base_folder))
     proxy_map = {}
 
@@ -114,35 +356,354 @@ def merge_all_proxy_files_parallel(temp_base_folder, final_output_folder, num_pr
                 proxy_map[file] = []
             proxy_map[file].append(os.path.join(full_path, file))
 
-    proxy_items = list(proxy_map.items())
+    if new_days is None and changed_days is None:
+        merge_items = list(proxy_map.items())
+        append_items = []
+    else:
+        # Incremental run: proxies touched by a changed day (before or after re-ingestion) are re-merged
+        # from every day folder, proxies touched only by new days get just those days appended
+        new_days = set(new_days or [])
+        changed_days = set(changed_days or [])
+        changed_day_proxies = set(changed_day_proxies or [])
+        merge_items = []
+        append_items = []
+        for proxy_file in changed_day_proxies - set(proxy_map):
+            # The proxy only ever appeared in days that no longer contain it
+            stale_output = os.path.join(final_output_folder, proxy_file)
+            for stale_file in (stale_output, f"{stale_output}{SERIES_META_SUFFIX}"):
+                if os.path.exists(stale_file):
+                    os.remove(stale_file)
+        for proxy_file, file_list in proxy_map.items():
+            file_days = [os.path.basename(os.path.dirname(f)) for f in file_list]
+            output_path = os.path.join(final_output_folder, proxy_file)
+            merged_exists = os.path.exists(output_path)
+            # Outputs written with other grid settings are rebuilt even without new data
+            if (proxy_file in changed_day_proxies or any(day in changed_days for day in file_days)
+                    or (not merged_exists and any(day in new_days for day in file_days))
+                    or (merged_exists and _grid_settings_differ(output_path, dense, duplicates))):
+                merge_items.append((proxy_file, file_list))
+            elif any(day in new_days for day in file_days):
+                append_items.append((proxy_file, [f for f, day in zip(file_list, file_days) if day in new_days], file_list))
 
-    with Pool(processes=num_processes) as pool:
-        pool.starmap(merge_one_proxy, [(item, final_output_folder) for item in proxy_items])
+    # Each merge streams its pieces, so memory doesn't bound the pool; cost is the bytes it reads
+    tasks = [
+        (os.path.join(final_output_folder, item[0]), ("merge", item, final_output_folder, dense, duplicates),
+         sum(os.path.getsize(f) for f in item[1]))
+        for item in merge_items
+    ] + [
+        (os.path.join(final_output_folder, item[0]), ("append", item, final_output_folder, dense, duplicates),
+         sum(os.path.getsize(f) for f in item[1]))
+        for item in append_items
+    ]
+    return tasks
 
-def run_preprocessing(direction, num_processes=8):
-    if direction not in CONFIG:
-        return f"Error: Unknown direction '{direction}'"
+def merge_all_proxy_files_parallel(temp_base_folder, final_output_folder, num_processes=None, new_days=None, changed_days=None,
+                                   changed_day_proxies=None, dense=False, duplicates="last"):
+    tasks = plan_merge_tasks(temp_base_folder, final_output_folder, new_days, changed_days, changed_day_proxies, dense, duplicates)
+    if not tasks:
+        return
+    with Pool(processes=num_processes or choose_pool_size(len(tasks))) as pool:
+        run_scheduled(pool, _merge_task, tasks, kind="merge")
+
+def _source_mtime(source_path):
+    # Newest modification among the files backing a merged CSV or a dataset partition
+    if os.path.isdir(source_path):
+        part_files = glob.glob(os.path.join(source_path, "*", "*.parquet"))
+        return max((os.path.getmtime(f) for f in part_files), default=0.0)
+    return os.path.getmtime(source_path)
+
+def convert_one_proxy_to_binary(args):
+    proxy_name, source_path, binary_folder, counters, dense, duplicates = args
+    try:
+        df = load_proxy_frame(source_path)
+        write_binary_series(df, binary_folder, proxy_name, counters, dense, duplicates)
+        print(f"Binary: {proxy_name}")
+    except Exception as e:
+        print(f"Error writing binary series for {proxy_name}: {e}")
+
+def plan_binary_tasks(source_folder, binary_folder, counters, dense=False, duplicates="last"):
+    # Only proxies whose source changed since their binary series was written, or whose grid setting changed, are rebuilt
+    os.makedirs(binary_folder, exist_ok=True)
+    args_list = []
+    for proxy_name, source_path in list_proxy_paths(source_folder).items():
+        binary_path = os.path.join(binary_folder, proxy_name)
+        meta_file = os.path.join(binary_path, BINARY_META_FILE)
+        if (os.path.exists(meta_file) and os.path.getmtime(meta_file) >= _source_mtime(source_path)
+                and not _grid_settings_differ(binary_path, dense, duplicates)):
+            continue
+        args_list.append((proxy_name, source_path, binary_folder, counters, dense, duplicates))
+    return [(args[1], args) for args in args_list]
+
+def write_binary_outputs(source_folder, binary_folder, counters, num_processes=None, dense=False, duplicates="last"):
+    tasks = plan_binary_tasks(source_folder, binary_folder, counters, dense, duplicates)
+    if not tasks:
+        return
+    # Each conversion loads a whole proxy, so the largest one bounds how many run at once
+    pool_size = num_processes or choose_pool_size(
+        len(tasks), task_memory_mb=largest_task_memory_mb([task[0] for task in tasks], CHUNK_MEMORY_OVERHEAD)
+    )
+    with Pool(processes=pool_size) as pool:
+        run_scheduled(pool, convert_one_proxy_to_binary, tasks, kind="binary")
 
+def plan_baseline_tasks(source_folder, baseline_folder, counters, rebuilt=(), rebuild_all=False):
+    # Proxies whose source changed since their baseline was saved; appended sources only add days,
+    # rewritten ones (in rebuilt) and partitioned datasets, whose past days may change, are recomputed
+    os.makedirs(baseline_folder, exist_ok=True)
+    rebuilt = set(rebuilt)
+    args_list = []
+    for proxy_name, source_path in list_proxy_paths(source_folder).items():
+        target = baseline_path(baseline_folder, proxy_name)
+        if not rebuild_all and os.path.exists(target) and os.path.getmtime(target) >= _source_mtime(source_path):
+            continue
+        rebuild = rebuild_all or source_path in rebuilt or os.path.isdir(source_path)
+        args_list.append((source_path, baseline_folder, counters, rebuild))
+    return [(args[0], args) for args in args_list]
+
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    # Write to a temp file first so an interrupted run never leaves a truncated manifest
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def select_changed_files(all_files, ingested):
+    """Split raw files into new and changed ones against the manifest entries of one output"""
+    new_files, changed_files, fingerprints = [], [], {}
+    for file_path in all_files:
+        stat = os.stat(file_path)
+        previous = ingested.get(file_path)
+        # Unchanged size and mtime means unchanged content; only hash when either moved
+        if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+            continue
+        fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": _file_sha256(file_path)}
+        fingerprints[file_path] = fingerprint
+        if previous is None:
+            new_files.append(file_path)
+        elif previous["sha256"] != fingerprint["sha256"]:
+            changed_files.append(file_path)
+        else:
+            # Touched but identical: refresh the stat fields so it is not hashed again
+            ingested[file_path] = fingerprint
+    return new_files, changed_files, fingerprints
+
+def _newest_mtime(folder):
+    # Newest modification among every file under folder; 0 for a missing or empty one
+    return max((os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names), default=0.0)
+
+def get_input_dir(direction):
+    # The most recently written of the memory-mapped binary series, the partitioned dataset and the
+    # merged per-proxy CSVs, preferred in that order when equally fresh: a run that updated the CSVs
+    # without rewriting the binaries (or after switching output format) must not leave detection on stale data
     cfg = CONFIG[direction]
-    os.makedirs(cfg["temp_base_folder"], exist_ok=True)
-    os.makedirs(cfg["final_output_folder"], exist_ok=True)
+    candidates = [cfg["binary_folder"], cfg["dataset_folder"], cfg["final_output_folder"]]
+    newest = {folder: _newest_mtime(folder) for folder in candidates}
+    freshest = max(newest.values())
+    if not freshest:
+        return cfg["final_output_folder"]
+    return next(folder for folder in candidates if newest[folder] == freshest)
 
-    all_files = sorted(glob.glob(os.path.join(cfg["input_folder"], "*.csv")))
-    if not all_files:
-        return f"Error: No files found in {cfg['input_folder']}"
+def get_baseline_dir(direction):
+    return CONFIG[direction]["baseline_folder"]
 
-    start_time = time.time()
+def _plan_ingest(direction, manifest, output_format, memory_budget_mb, incremental):
+    """New and changed raw files of one direction, with their worker args and what the merge needs to know"""
+    cfg = CONFIG[direction]
+    all_files = find_raw_files(cfg["input_folder"])
+    output_folder = cfg["dataset_folder"] if output_format == "parquet" else cfg["final_output_folder"]
+    # Manifest entries are kept per output folder; a missing or empty output means a full rebuild
+    if not incremental or not os.path.isdir(output_folder) or not os.listdir(output_folder):
+        manifest[output_folder] = {}
+    ingested = manifest.setdefault(output_folder, {})
+
+    new_files, changed_files, fingerprints = select_changed_files(all_files, ingested)
+    files_to_process = sorted(new_files + changed_files)
+    plan = {
+        "direction": direction, "all_files": all_files, "output_folder": output_folder, "ingested": ingested,
+        "new_files": new_files, "changed_files": changed_files, "fingerprints": fingerprints,
+        "files_to_process": files_to_process, "skipped": len(all_files) - len(files_to_process),
+        "changed_day_proxies": set(), "args_list": []
+    }
+    if not files_to_process:
+        return plan
+
+    if output_format == "parquet":
+        # Single pass: each raw day goes straight into its proxy/date partitions, no temp files or merge
+        os.makedirs(cfg["dataset_folder"], exist_ok=True)
+        target_folder = cfg["dataset_folder"]
+    else:
+        os.makedirs(cfg["temp_base_folder"], exist_ok=True)
+        os.makedirs(cfg["final_output_folder"], exist_ok=True)
+        target_folder = cfg["temp_base_folder"]
+        # Proxies present in a changed day before it is re-ingested also need re-merging
+        for file_path in changed_files:
+            day_output_folder = os.path.join(cfg["temp_base_folder"], raw_day_name(file_path))
+            if os.path.isdir(day_output_folder):
+                plan["changed_day_proxies"].update(os.listdir(day_output_folder))
 
-    args_list = [
-        (file_path, cfg["temp_base_folder"], cfg["columns_to_extract"], cfg["dtype_map"])
-        for file_path in all_files
+    plan["args_list"] = [
+        (file_path, target_folder, cfg["columns_to_extract"], cfg["dtype_map"], memory_budget_mb)
+        for file_path in files_to_process
     ]
+    return plan
+
+def _plan_merge(plan, dense_grid, duplicate_policy):
+    cfg = CONFIG[plan["direction"]]
+    if not os.path.isdir(cfg["temp_base_folder"]):
+        return []
+    if plan["files_to_process"] and not plan["skipped"]:
+        return plan_merge_tasks(cfg["temp_base_folder"], cfg["final_output_folder"], dense=dense_grid, duplicates=duplicate_policy)
+    # Incremental: only proxies touched by new or changed days, or written with other grid settings
+    return plan_merge_tasks(
+        cfg["temp_base_folder"], cfg["final_output_folder"],
+        new_days=[raw_day_name(f) for f in plan["new_files"]],
+        changed_days=[raw_day_name(f) for f in plan["changed_files"]],
+        changed_day_proxies=plan["changed_day_proxies"], dense=dense_grid, duplicates=duplicate_policy
+    )
+
+def run_preprocessing_all(directions=("inbound", "outbound"), num_processes=None, output_format="csv", memory_budget_mb=None,
+                          incremental=True, write_binary=False, dense_grid=False, duplicate_policy="last", update_baselines=True,
+                          warm_pool=None):
+    """Preprocess several directions in one run: one shared worker pool, one manifest update and one report
+
+    Raw files of all directions are scheduled together largest-first, then all merges, then all
+    binary conversions and seasonal baseline updates, so the run takes about as long as the slowest
+    direction rather than the sum. Each phase is sized for its own tasks. With warm_pool (a
+    warm_pool.WarmPool) its workers are used and left running instead of starting a pool of its own.
+    """
+    for direction in directions:
+        if direction not in CONFIG:
+            return f"Error: Unknown direction '{direction}'"
+    if output_format not in ("csv", "parquet"):
+        return f"Error: Unknown output format '{output_format}'"
+    if duplicate_policy not in DUPLICATE_POLICIES:
+        return f"Error: Unknown duplicate policy '{duplicate_policy}'"
+
+    start_time = time.time()
+    manifest = load_manifest()
+    plans = [_plan_ingest(direction, manifest, output_format, memory_budget_mb, incremental) for direction in directions]
+    missing = [CONFIG[plan["direction"]]["input_folder"] for plan in plans if not plan["all_files"]]
+    plans = [plan for plan in plans if plan["all_files"]]
+    if not plans:
+        return f"Error: No files found in {', '.join(missing)}"
+
+    files_to_process = [f for plan in plans for f in plan["files_to_process"]]
+    ingest_tasks = [(args[0], args, raw_size_bytes(args[0])) for plan in plans for args in plan["args_list"]]
+    fingerprints = {f: plan["fingerprints"][f] for plan in plans for f in plan["files_to_process"]}
+    ingested_by_file = {f: plan["ingested"] for plan in plans for f in plan["files_to_process"]}
+    skipped = sum(plan["skipped"] for plan in plans)
+    output_folders = ", ".join(plan["output_folder"] for plan in plans)
+
+    # Without an explicit size, each phase is sized from cores, its own task count and how many of
+    # its workers fit in memory: chunked ingest workers stay within their budget, whole-file workers
+    # scale with the largest file
+    def phase_size(num_tasks, task_memory_mb=None):
+        return num_processes or choose_pool_size(num_tasks, task_memory_mb=task_memory_mb)
 
-    with Pool(processes=num_processes) as pool:
-        pool.map(process_one_file, args_list)
+    # The pool is started on first use, shared by every direction and replaced when a phase needs another size
+    check = warm_pool.check if warm_pool is not None else None
+    pool = None
+    pool_size = 0
+    sizes_used = []
 
-    merge_all_proxy_files_parallel(cfg["temp_base_folder"], cfg["final_output_folder"], num_processes)
+    def phase_pool(num_tasks, size):
+        nonlocal pool, pool_size
+        # A running pool (the dashboard's warm one included) is kept when it runs as many of this
+        # phase's tasks at once as the phase was sized for, so a small phase never shrinks it
+        running = warm_pool.processes if warm_pool is not None else pool_size
+        if running and min(running, num_tasks) == min(size, num_tasks):
+            size = running
+        if warm_pool is not None:
+            pool = warm_pool.get(size)
+        elif pool is None or size != pool_size:
+            if pool is not None:
+                pool.terminate()
+            pool = Pool(processes=size)
+        pool_size = size
+        sizes_used.append(size)
+        return pool
+
+    records = []
+    merge_records = []
+    try:
+        if ingest_tasks:
+            largest_raw_mb = max(raw_size_bytes(f) for f in files_to_process) / (1024 * 1024)
+            phase_pool(len(ingest_tasks), phase_size(len(ingest_tasks), memory_budget_mb or largest_raw_mb * CHUNK_MEMORY_OVERHEAD))
+            ingest_func = process_one_file_to_dataset if output_format == "parquet" else process_one_file
+            records = run_scheduled(pool, ingest_func, ingest_tasks, kind="ingest", check=check)
+
+        # Only files that were ingested without error are recorded
+        for _, file_path, _ in records:
+            if file_path:
+                ingested_by_file[file_path][file_path] = fingerprints[file_path]
+        save_manifest(manifest)
+
+        merge_tasks = []
+        if output_format == "csv":
+            merge_tasks = [task for plan in plans for task in _plan_merge(plan, dense_grid, duplicate_policy)]
+        if merge_tasks:
+            # Each merge streams its pieces, so memory doesn't bound its workers
+            phase_pool(len(merge_tasks), phase_size(len(merge_tasks)))
+            merge_records = run_scheduled(pool, _merge_task, merge_tasks, kind="merge", check=check)
+
+        if write_binary:
+            # Planned after the merges, since the merged outputs are what gets converted
+            binary_tasks = [
+                task for plan in plans
+                for task in plan_binary_tasks(plan["output_folder"], CONFIG[plan["direction"]]["binary_folder"],
+                                              COUNTERS[plan["direction"]], dense_grid, duplicate_policy)
+            ]
+            if binary_tasks:
+                phase_pool(len(binary_tasks), phase_size(
+                    len(binary_tasks), largest_task_memory_mb([task[0] for task in binary_tasks], CHUNK_MEMORY_OVERHEAD)
+                ))
+                run_scheduled(pool, convert_one_proxy_to_binary, binary_tasks, kind="binary", check=check)
+
+        if update_baselines:
+            # Fully re-merged proxies may have changed past days; appended ones only gained new days
+            rebuilt = {path for path, result, _ in merge_records if result == "merged"}
+            baseline_tasks = [
+                task for plan in plans
+                for task in plan_baseline_tasks(plan["output_folder"], CONFIG[plan["direction"]]["baseline_folder"],
+                                                COUNTERS[plan["direction"]], rebuilt)
+            ]
+            if baseline_tasks:
+                phase_pool(len(baseline_tasks), phase_size(
+                    len(baseline_tasks), largest_task_memory_mb([task[0] for task in baseline_tasks], CHUNK_MEMORY_OVERHEAD)
+                ))
+                run_scheduled(pool, update_baseline_task, baseline_tasks, kind="baseline", check=check)
+    finally:
+        if pool is not None and warm_pool is None:
+            pool.terminate()
+
+    input_folders = ", ".join(CONFIG[plan["direction"]]["input_folder"] for plan in plans)
+    note = f" No files found in {', '.join(missing)}." if missing else ""
+    if not files_to_process:
+        return f"No new or changed files in {input_folders} ({skipped} already ingested). Output: {output_folders}{note}"
 
     end_time = time.time()
-    return f"Processed {len(all_files)} files in {end_time - start_time:.2f} seconds. Output: {cfg['final_output_folder']}"
+    return (
+        f"Processed {len(files_to_process)} files ({skipped} already ingested) in {end_time - start_time:.2f} seconds "
+        f"with up to {max(sizes_used, default=0)} processes. Output: {output_folders}. Slowest: {format_timing_report(records)}{note}"
+    )
 
+def run_preprocessing(direction, num_processes=None, output_format="csv", memory_budget_mb=None, incremental=True,
+                      write_binary=False, dense_grid=False, duplicate_policy="last", update_baselines=True, warm_pool=None):
+    if direction not in CONFIG:
+        return f"Error: Unknown direction '{direction}'"
+    return run_preprocessing_all(
+        (direction,), num_processes, output_format, memory_budget_mb, incremental, write_binary, dense_grid, duplicate_policy,
+        update_baselines, warm_pool
+    )
\ No newline at end of file
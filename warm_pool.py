@@ -0,0 +1,140 @@
+import os
+import glob
+import atexit
+import importlib
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+# Long-lived worker pool for the dashboard. Workers import the heavy libraries once at start, so
+# a run only pays for its own work; the pool is replaced when it is resized, when a worker died,
+# when it stops answering pings, or when the code it was started with has changed on disk
+WARM_MODULES = ("numpy", "pandas", "sklearn.ensemble", "plotly.graph_objs", "ag", "anomalyisowithmonthend", "proxy_store")
+# Seconds every worker has to answer a ping before the pool counts as hung
+PING_TIMEOUT = 10
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _warm_worker(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"Warm worker could not import {module}: {e}")
+
+
+def _ping(_):
+    return os.getpid()
+
+
+def code_mtime(code_dir=CODE_DIR):
+    # Forked workers keep the code they started with, so any edited module means a fresh pool
+    return max((os.path.getmtime(path) for path in glob.glob(os.path.join(code_dir, "*.py"))), default=0.0)
+
+
+class WarmPool:
+    """A multiprocessing pool kept alive between runs, checked and restarted as needed"""
+
+    def __init__(self, modules=WARM_MODULES, ping_timeout=PING_TIMEOUT):
+        self.modules = tuple(modules)
+        self.ping_timeout = ping_timeout
+        self.pool = None
+        self.processes = 0
+        self.restarts = 0
+        self._pids = set()
+        self._code_mtime = 0.0
+        self._running = False
+        # Held by the run using the pool (reentrant, so that run can restart it)
+        self._lock = threading.RLock()
+        self._leased = False
+        atexit.register(self.close)
+
+    def _worker_pids(self):
+        # Pool replaces a worker that exits, so a changed pid set means one crashed or was killed
+        return {process.pid for process in self.pool._pool}
+
+    def start(self, processes):
+        self.close()
+        self.pool = Pool(processes=processes, initializer=_warm_worker, initargs=(self.modules,))
+        self.processes = processes
+        self._code_mtime = code_mtime()
+        self._running = True
+        self.ping()
+        self._pids = self._worker_pids()
+        return self.pool
+
+    def ping(self):
+        """True when every worker answers within ping_timeout (once the imports are done)"""
+        if not self._running:
+            return False
+        try:
+            self.pool.map_async(_ping, range(self.processes), chunksize=1).get(self.ping_timeout)
+            return True
+        except multiprocessing.TimeoutError:
+            return False
+
+    def crashed(self):
+        return self._running and self._worker_pids() != self._pids
+
+    def check(self):
+        """Raise when a worker died, since the task it was running will never report back"""
+        if self.crashed():
+            raise RuntimeError("A worker process died (out of memory or crashed); the pool will be restarted")
+
+    def healthy(self):
+        return self._running and not self.crashed() and code_mtime() <= self._code_mtime and self.ping()
+
+    def get(self, processes):
+        """A ready pool of this many processes, reusing the warm one when it is healthy"""
+        if self.processes == processes and self.healthy():
+            return self.pool
+        if self._running:
+            self.restarts += 1
+        return self.start(processes)
+
+    @contextmanager
+    def lease(self):
+        """This pool, held for the length of one run; a caller finding it busy gets a pool of its own
+
+        Sessions never share workers, so a pool running someone's tasks is never pinged (and
+        taken for hung) or restarted under them. The private pool is closed when the run ends.
+        """
+        if self._lock.acquire(blocking=False):
+            self._leased = True
+            try:
+                yield self
+            finally:
+                self._leased = False
+                self._lock.release()
+            return
+        own = WarmPool(self.modules, self.ping_timeout)
+        try:
+            yield own
+        finally:
+            own.close()
+            atexit.unregister(own.close)
+
+    def restart(self):
+        """Start the pool afresh, unless another run holds it; returns whether it was restarted"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.restarts += 1
+            self.start(self.processes or os.cpu_count() or 1)
+        finally:
+            self._lock.release()
+        return True
+
+    def close(self):
+        if self._running:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self._running = False
+
+    def status(self):
+        if not self._running:
+            return "not started"
+        state = "crashed worker" if self.crashed() else "in use" if self._leased else "ready"
+        return f"{self.processes} processes, {state}, {self.restarts} restarts"